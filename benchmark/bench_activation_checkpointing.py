@@ -0,0 +1,58 @@
+import os
+import sys
+__package__ = "benchmark"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+from contextlib import nullcontext
+import torch
+from model.MyLlama import Transformer, LLMConfig
+from benchmark.common import peak_memory_mb, reset_peak_memory, time_steps, run_isolated, print_table
+
+'''
+对比默认配置(hidden_size=512)下不同激活重计算设置的单步训练耗时与峰值内存
+    python benchmark/bench_activation_checkpointing.py --batch_size 16 --max_seq_len 1024 --autocast
+'''
+
+def run(every, mode, args):
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = Transformer(LLMConfig(activation_checkpointing=every, activation_checkpointing_mode=mode)).to(device)
+    model.train()
+    input_ids = torch.randint(0, model.args.vocab_size, (args.batch_size, args.max_seq_len), device=device)
+    labels = torch.randint(0, model.args.vocab_size, (args.batch_size, args.max_seq_len), device=device)
+    ctx = torch.amp.autocast(device, dtype=torch.bfloat16) if args.autocast else nullcontext()
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        with ctx:
+            loss = model(input_ids, labels=labels, return_logits=False)["loss"]
+        loss.backward()
+
+    reset_peak_memory()
+    base_memory = peak_memory_mb()
+    step_time = time_steps(step, args.warmup, args.iters)
+    return step_time, peak_memory_mb() - base_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Activation checkpointing benchmark")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_seq_len", type=int, default=1024)
+    parser.add_argument("--every", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--autocast", action="store_true", help="使用bf16 autocast，与训练脚本一致")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=3)
+    args = parser.parse_args()
+
+    configs = [(0, "full")] + [(every, mode) for mode in ("full", "selective") for every in args.every]
+    rows = []
+    base_time = base_peak = None
+    for every, mode in configs:
+        step_time, peak = run_isolated(run, every, mode, args)
+        if every == 0:
+            base_time, base_peak = step_time, peak
+        rows.append(["none" if every == 0 else mode, "-" if every == 0 else every,
+                     f"{step_time:.1f}", f"{step_time / base_time:.2f}x",
+                     f"{peak:.1f}", f"{peak / base_peak:.2f}x"])
+    print_table(["recompute", "k", "step time (ms)", "time", "peak memory (MB)", "memory"], rows)
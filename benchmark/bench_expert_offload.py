@@ -0,0 +1,85 @@
+import os
+import sys
+__package__ = "benchmark"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+import argparse
+import tempfile
+import torch
+from model.MiniMind import MiniMindConfig, MiniMindForCausalLM, enable_expert_offload, disable_expert_offload
+from model.ExpertCache import ExpertStore, summarize
+from benchmark.common import print_table
+
+'''
+专家卸载(moe_layout='offload')在不同缓存大小下的命中率和解码速度，与所有专家常驻内存的模型对比
+    python benchmark/bench_expert_offload.py --n_routed_experts 16 --cache_sizes 1 2 4 8 16
+默认使用随机初始化的权重（路由接近均匀，命中率偏低），--checkpoint 指定训练好的MoE权重(moe_layout='list')时更接近实际。
+命中率只统计prefill之后的解码阶段；专家文件刚写入时在系统的页缓存中，冷启动时未命中的代价更高。
+'''
+
+
+@torch.no_grad()
+def decode(model, input_ids, new_tokens, caches=None):
+    """greedy解码new_tokens个token，返回解码阶段的tokens/s"""
+    out = model(input_ids=input_ids, use_cache=True, logits_to_keep=1)
+    past_key_values = out.past_key_values
+    token = out.logits[:, -1].argmax(dim=-1, keepdim=True)
+    for cache in caches or []:
+        cache.reset_stats()
+    start = time.perf_counter()
+    for _ in range(new_tokens):
+        out = model(input_ids=token, past_key_values=past_key_values, use_cache=True, logits_to_keep=1)
+        past_key_values = out.past_key_values
+        token = out.logits[:, -1].argmax(dim=-1, keepdim=True)
+    return new_tokens * input_ids.shape[0] / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MoE expert offloading benchmark")
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--num_hidden_layers", type=int, default=8)
+    parser.add_argument("--n_routed_experts", type=int, default=16)
+    parser.add_argument("--top_k", type=int, default=2)
+    parser.add_argument("--cache_sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=64)
+    parser.add_argument("--new_tokens", type=int, default=64)
+    parser.add_argument("--num_threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = MiniMindConfig(use_moe=True, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                            n_routed_experts=args.n_routed_experts, num_experts_per_tok=args.top_k)
+    model = MiniMindForCausalLM(config).eval()
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location="cpu"), strict=False)
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, args.prompt_len))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # float32保存，卸载后的输出与常驻模型一致
+        store = ExpertStore.write(model.state_dict(), os.path.join(tmp, "experts.bin"), "float32")
+        offload_config = MiniMindConfig(**{**config.to_dict(), "moe_layout": "offload"})
+        offload_model = MiniMindForCausalLM(offload_config).eval()
+        offload_model.load_state_dict(model.state_dict())
+
+        rows = [["resident", "-", f"{store.n_experts * store.num_layers * store.expert_bytes / 1024 ** 2:.1f}",
+                 "-", "-", f"{decode(model, input_ids, args.new_tokens):.1f}"]]
+        for cache_size in args.cache_sizes:
+            for prefetch in (False, True):
+                caches = enable_expert_offload(offload_model, store, cache_size, prefetch, args.num_threads)
+                # 每种配置都检查卸载后的输出与常驻模型一致
+                with torch.no_grad():
+                    torch.testing.assert_close(offload_model(input_ids=input_ids).logits,
+                                               model(input_ids=input_ids).logits, rtol=1e-4, atol=1e-4)
+                tokens_per_sec = decode(offload_model, input_ids, args.new_tokens, caches)
+                stats = summarize(caches)
+                rows.append([cache_size, "on" if prefetch else "off",
+                             f"{cache_size * store.num_layers * store.expert_bytes / 1024 ** 2:.1f}",
+                             f"{stats['hit_rate']:.3f}",
+                             f"{stats['prefetch_accuracy']:.3f}" if prefetch else "-",
+                             f"{tokens_per_sec:.1f}"])
+                disable_expert_offload(offload_model)
+
+    print_table(["cache size", "prefetch", "expert MB", "hit rate", "prefetch acc", "tokens/s"], rows)
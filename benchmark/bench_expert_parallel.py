@@ -0,0 +1,65 @@
+import os
+import sys
+__package__ = "benchmark"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import torch
+import torch.distributed as dist
+from model.MyLlama import LLMConfig
+from model.MyMoE import MoETransformer, load_expert_parallel_state_dict, allreduce_dense_grads
+from benchmark.common import time_steps, print_table
+
+'''
+对比专家并行的MoETransformer与每个rank保存全部专家的模型一次前向+反向(含梯度同步)的耗时
+    torchrun --nproc_per_node 4 benchmark/bench_expert_parallel.py --n_routed_experts 8
+CPU上使用gloo，有GPU时使用nccl；两者结果一致的检查见 tests/test_expert_parallel.py
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expert parallel MoE benchmark")
+    parser.add_argument("--n_routed_experts", type=int, default=8)
+    parser.add_argument("--top_k", type=int, default=2)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=256)
+    args = parser.parse_args()
+
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    device = torch.device(f"cuda:{int(os.environ['LOCAL_RANK'])}" if backend == "nccl" else "cpu")
+    if backend == "nccl":
+        torch.cuda.set_device(device)
+
+    config = LLMConfig(use_moe=True, top_k=args.top_k, n_routed_experts=args.n_routed_experts,
+                       hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers, flash_attn=False)
+    torch.manual_seed(0)
+    ref_model = MoETransformer(config).to(device)
+    ep_model = MoETransformer(config, ep_group=dist.group.WORLD).to(device)
+    load_expert_parallel_state_dict(ep_model, ref_model.state_dict())
+
+    torch.manual_seed(rank + 1)
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, args.seq_len), device=device)
+
+    def step(model):
+        def run():
+            model.zero_grad(set_to_none=True)
+            model(input_ids=input_ids, labels=input_ids)["loss"].backward()
+            allreduce_dense_grads(model)
+        return run
+
+    rows = []
+    for name, model in (("all experts", ref_model), ("expert parallel", ep_model)):
+        num_params = sum(p.numel() for p in model.parameters())
+        rows.append([name, f"{num_params / 1e6:.2f}M", f"{time_steps(step(model)):.1f}"])
+    if rank == 0:
+        print(f"world_size={world_size} backend={backend}")
+        print_table(["model", "params per rank", "fwd+bwd ms"], rows)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
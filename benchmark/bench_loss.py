@@ -0,0 +1,55 @@
+import os
+import sys
+__package__ = "benchmark"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+from contextlib import nullcontext
+import torch
+from model.MyLlama import Transformer, LLMConfig
+from benchmark.common import peak_memory_mb, reset_peak_memory, time_steps, run_isolated, print_table
+
+'''
+对比预训练中完整logits的交叉熵和分块交叉熵(loss_chunk_size)的峰值内存与单步耗时
+    python benchmark/bench_loss.py --batch_size 8 --max_seq_len 512
+'''
+
+def run(loss_chunk_size, args):
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = Transformer(LLMConfig(loss_chunk_size=loss_chunk_size)).to(device)
+    model.train()
+    input_ids = torch.randint(0, model.args.vocab_size, (args.batch_size, args.max_seq_len), device=device)
+    labels = torch.randint(0, model.args.vocab_size, (args.batch_size, args.max_seq_len), device=device)
+    ctx = torch.amp.autocast(device, dtype=torch.bfloat16) if args.autocast else nullcontext()
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        with ctx:
+            if loss_chunk_size > 0:
+                loss = model(input_ids, labels=labels, return_logits=False)["loss"]
+            else:
+                loss = model(input_ids, labels=labels)["loss"]
+        loss.backward()
+
+    reset_peak_memory()
+    base_memory = peak_memory_mb()
+    step_time = time_steps(step, args.warmup, args.iters)
+    return step_time, peak_memory_mb() - base_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunked cross-entropy benchmark")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_seq_len", type=int, default=512)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[0, 4096, 1024, 256])
+    parser.add_argument("--autocast", action="store_true", help="使用bf16 autocast，与训练脚本一致")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = []
+    for chunk_size in args.chunk_sizes:
+        step_time, peak = run_isolated(run, chunk_size, args)
+        rows.append(["full logits" if chunk_size == 0 else f"chunk={chunk_size}", f"{step_time:.1f}", f"{peak:.1f}"])
+    print_table(["loss", "step time (ms)", "peak memory (MB)"], rows)
@@ -0,0 +1,101 @@
+import os
+import sys
+__package__ = "benchmark"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import torch
+from model.MiniMind import MiniMindConfig, MOEFeedForward, StackedMOEFeedForward
+from benchmark.common import time_steps, print_table
+
+'''
+对比MoE层原来的逐专家布尔索引实现、按专家排序分组(moe_dispatch)和堆叠专家权重(StackedMOEFeedForward)的耗时，
+n_routed_experts从4增加到64；decode为每次decode_tokens个token的推理
+    python benchmark/bench_moe_dispatch.py --tokens 4096 --decode_tokens 1
+'''
+
+def legacy_train_forward(moe, x):
+    # 原来的训练路径：repeat_interleave之后每个专家做两次布尔比较并按布尔索引写回
+    topk_idx, topk_weight, _ = moe.gate(x)
+    orig_shape = x.shape
+    x = x.view(-1, x.shape[-1]).repeat_interleave(moe.config.num_experts_per_tok, dim=0)
+    flat_topk_idx = topk_idx.view(-1)
+    y = torch.empty_like(x)
+    for i, expert in enumerate(moe.experts):
+        y[flat_topk_idx == i] = expert(x[flat_topk_idx == i]).to(y.dtype)
+    return (y.view(*topk_weight.shape, -1) * topk_weight.unsqueeze(-1)).sum(dim=1).view(*orig_shape)
+
+
+@torch.no_grad()
+def legacy_infer(moe, x):
+    # 原来的moe_infer：bincount之后拷贝到CPU上求前缀和
+    topk_idx, topk_weight, _ = moe.gate(x)
+    orig_shape = x.shape
+    x = x.view(-1, x.shape[-1])
+    flat_expert_indices, flat_expert_weights = topk_idx.view(-1), topk_weight.view(-1, 1)
+    expert_cache = torch.zeros_like(x)
+    idxs = flat_expert_indices.argsort()
+    tokens_per_expert = flat_expert_indices.bincount().cpu().numpy().cumsum(0)
+    token_idxs = idxs // moe.config.num_experts_per_tok
+    for i, end_idx in enumerate(tokens_per_expert):
+        start_idx = 0 if i == 0 else tokens_per_expert[i - 1]
+        if start_idx == end_idx:
+            continue
+        exp_token_idx = token_idxs[start_idx:end_idx]
+        expert_out = moe.experts[i](x[exp_token_idx]).to(expert_cache.dtype)
+        expert_out.mul_(flat_expert_weights[idxs[start_idx:end_idx]])
+        expert_cache.scatter_add_(0, exp_token_idx.view(-1, 1).repeat(1, x.shape[-1]), expert_out)
+    return expert_cache.view(*orig_shape)
+
+
+def bench(n_experts, args, device):
+    torch.manual_seed(0)
+    config = MiniMindConfig(use_moe=True, n_routed_experts=n_experts, n_shared_experts=0,
+                            num_experts_per_tok=args.top_k, hidden_size=args.hidden_size)
+    moe = MOEFeedForward(config).to(device)
+    x = torch.randn(1, args.tokens, args.hidden_size, device=device, requires_grad=True)
+
+    def train_step(forward):
+        def step():
+            moe.zero_grad(set_to_none=True)
+            x.grad = None
+            forward(x).sum().backward()
+        return step
+
+    moe.train()
+    legacy_train = time_steps(train_step(lambda x: legacy_train_forward(moe, x)), args.warmup, args.iters)
+    sorted_train = time_steps(train_step(moe), args.warmup, args.iters)
+    # 从列表格式的权重加载，加载时自动堆叠
+    stacked = StackedMOEFeedForward(config).to(device)
+    stacked.load_state_dict(moe.state_dict())
+    moe.eval()
+    stacked.eval()
+    decode_x = x[:, :args.decode_tokens]
+    with torch.no_grad():
+        torch.testing.assert_close(stacked(x), moe(x), rtol=1e-4, atol=1e-4)
+        legacy = time_steps(lambda: legacy_infer(moe, x), args.warmup, args.iters)
+        grouped = time_steps(lambda: moe(x), args.warmup, args.iters)
+        stacked_time = time_steps(lambda: stacked(x), args.warmup, args.iters)
+        decode_legacy = time_steps(lambda: legacy_infer(moe, decode_x), args.warmup, args.iters)
+        decode_stacked = time_steps(lambda: stacked(decode_x), args.warmup, args.iters)
+    return [n_experts, f"{legacy_train:.2f}", f"{sorted_train:.2f}",
+            f"{legacy:.2f}", f"{grouped:.2f}", f"{stacked_time:.2f}",
+            f"{decode_legacy:.3f}", f"{decode_stacked:.3f}"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MoE dispatch benchmark")
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--top_k", type=int, default=2)
+    parser.add_argument("--decode_tokens", type=int, default=1)
+    parser.add_argument("--experts", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=5)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    rows = [bench(n, args, device) for n in args.experts]
+    print_table(["experts", "train legacy (ms)", "train sorted (ms)",
+                 "infer legacy (ms)", "infer sorted (ms)", "infer stacked (ms)",
+                 "decode legacy (ms)", "decode stacked (ms)"], rows)
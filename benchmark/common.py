@@ -0,0 +1,57 @@
+import resource
+import time
+import multiprocessing as mp
+
+import torch
+
+
+def peak_memory_mb() -> float:
+    # CUDA上用显存分配器的峰值，CPU上用进程的最大常驻内存（Linux下ru_maxrss的单位是KB）
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def time_steps(step_fn, warmup: int = 2, iters: int = 5) -> float:
+    """返回step_fn平均每次的耗时（毫秒）"""
+    for _ in range(warmup):
+        step_fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        step_fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def _worker(fn, args, queue):
+    queue.put(fn(*args))
+
+
+def run_isolated(fn, *args):
+    """
+    在独立的子进程中运行fn(*args)并返回结果
+    CPU上的峰值内存是进程级别的高水位，每个配置单独一个进程才能互不影响
+    """
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_worker, args=(fn, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(headers, *rows)]
+    print(" | ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    print("-+-".join("-" * w for w in widths))
+    for row in rows:
+        print(" | ".join(str(x).ljust(w) for x, w in zip(row, widths)))
@@ -0,0 +1,173 @@
+import re
+import json
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import torch
+
+# MOEFeedForward (experts.{i}.*_proj.weight) 和 StackedMOEFeedForward (*_proj) 的专家权重
+LIST_EXPERT_PATTERN = re.compile(r"(?:^|\.)layers\.(\d+)\.mlp\.experts\.(\d+)\.(gate_proj|up_proj|down_proj)\.weight$")
+STACKED_EXPERT_PATTERN = re.compile(r"(?:^|\.)layers\.(\d+)\.mlp\.(gate_proj|up_proj|down_proj)$")
+PROJ_INDEX = {"gate_proj": 0, "up_proj": 1, "down_proj": 2}
+
+
+class ExpertStore:
+    """
+    所有MoE层路由专家权重的内存映射文件
+
+    数据形状为 [num_layers, n_experts, 3, intermediate_size, hidden_size]，第3维依次是
+    gate_proj、up_proj 和 down_proj 的转置，每个专家是一段连续的数据，加载一个专家只读这一段。
+    形状和dtype记录在同名的 .json 文件中；numpy没有bf16，文件只支持float16/float32。
+    """
+    def __init__(self, path: str):
+        with open(path + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.path = path
+        self.shape = tuple(meta["shape"])
+        # 'c'(copy-on-write)可以直接交给torch.from_numpy，不会写回文件
+        self.data = np.memmap(path, dtype=meta["dtype"], mode="c", shape=self.shape)
+
+    @property
+    def num_layers(self) -> int:
+        return self.shape[0]
+
+    @property
+    def n_experts(self) -> int:
+        return self.shape[1]
+
+    @property
+    def expert_bytes(self) -> int:
+        return self.data[0, 0].nbytes
+
+    def load(self, layer_id: int, expert_id: int, dtype: torch.dtype,
+             device: torch.device) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """从文件读出一个专家，返回与nn.Linear.weight方向一致的 (gate_proj, up_proj, down_proj)"""
+        weight = torch.from_numpy(self.data[layer_id, expert_id]).to(device=device, dtype=dtype, copy=True)
+        return weight[0], weight[1], weight[2].t()
+
+    @staticmethod
+    def write(state_dict: Dict[str, torch.Tensor], path: str, dtype: str = "float16") -> "ExpertStore":
+        """把state_dict中所有路由专家（list或stacked格式）写入path，返回对应的ExpertStore"""
+        experts = {}
+        for key, value in state_dict.items():
+            match = LIST_EXPERT_PATTERN.search(key)
+            if match:
+                layer_id, expert_id, name = int(match.group(1)), int(match.group(2)), match.group(3)
+                experts[(layer_id, expert_id, name)] = value
+                continue
+            match = STACKED_EXPERT_PATTERN.search(key)
+            if match:
+                for expert_id, expert_weight in enumerate(value):
+                    experts[(int(match.group(1)), expert_id, match.group(2))] = expert_weight
+        assert experts, "state_dict中没有MoE路由专家的权重"
+        num_layers = max(k[0] for k in experts) + 1
+        n_experts = max(k[1] for k in experts) + 1
+        intermediate_size, hidden_size = experts[(0, 0, "gate_proj")].shape
+        shape = (num_layers, n_experts, 3, intermediate_size, hidden_size)
+        data = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+        for (layer_id, expert_id, name), value in experts.items():
+            value = value.t() if name == "down_proj" else value
+            data[layer_id, expert_id, PROJ_INDEX[name]] = value.float().numpy()
+        data.flush()
+        del data
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump({"shape": list(shape), "dtype": dtype}, f)
+        return ExpertStore(path)
+
+
+class ExpertCache:
+    """
+    一个MoE层的专家缓存，最多保存capacity个专家，按LRU淘汰
+
+    get()取出本层要计算的专家，不在缓存中时同步从ExpertStore加载（miss）；
+    prefetch()在后台线程中提前加载预测会用到的专家，缓存中先放入Future，get()时再等待加载完成。
+    缓存的读写只在调用方线程中进行，后台线程只负责读文件和拷贝。
+    """
+    def __init__(self, store: ExpertStore, layer_id: int, capacity: int, dtype: torch.dtype,
+                 device: torch.device, executor=None):
+        assert capacity > 0, "专家缓存的容量至少为1"
+        self.store = store
+        self.layer_id = layer_id
+        self.capacity = capacity
+        self.dtype = dtype
+        self.device = device
+        self.executor = executor
+        # expert_id -> (gate_proj, up_proj, down_proj) 或加载中的Future，最近使用的在后
+        self.entries = OrderedDict()
+        # 已预取、还没有被get()用到的专家
+        self.pending_prefetch = set()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.prefetch_used = 0
+
+    def _load(self, expert_id: int):
+        return self.store.load(self.layer_id, expert_id, self.dtype, self.device)
+
+    def _insert(self, expert_id: int, value):
+        self.entries[expert_id] = value
+        while len(self.entries) > self.capacity:
+            evicted, _ = self.entries.popitem(last=False)
+            self.pending_prefetch.discard(evicted)
+
+    def get(self, expert_id: int):
+        value = self.entries.get(expert_id)
+        if value is None:
+            self.misses += 1
+            value = self._load(expert_id)
+            self._insert(expert_id, value)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(expert_id)
+        if expert_id in self.pending_prefetch:
+            self.pending_prefetch.discard(expert_id)
+            self.prefetch_used += 1
+        if isinstance(value, Future):
+            value = value.result()
+            self.entries[expert_id] = value
+        return value
+
+    def prefetch(self, expert_ids: Iterable[int]):
+        for expert_id in expert_ids:
+            if expert_id in self.entries:
+                continue
+            if self.executor is not None:
+                value = self.executor.submit(self._load, expert_id)
+            else:
+                value = self._load(expert_id)
+            self._insert(expert_id, value)
+            self.pending_prefetch.add(expert_id)
+            self.prefetched += 1
+
+    def reset_stats(self):
+        self.hits = self.misses = self.prefetched = self.prefetch_used = 0
+        self.pending_prefetch.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "layer": self.layer_id,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "prefetched": self.prefetched,
+            # 预取的专家中在被淘汰前用到的比例
+            "prefetch_accuracy": self.prefetch_used / self.prefetched if self.prefetched else 0.0,
+        }
+
+
+def summarize(caches: List[ExpertCache]) -> dict:
+    """汇总所有层的缓存统计"""
+    hits = sum(c.hits for c in caches)
+    misses = sum(c.misses for c in caches)
+    prefetched = sum(c.prefetched for c in caches)
+    prefetch_used = sum(c.prefetch_used for c in caches)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "prefetched": prefetched,
+        "prefetch_accuracy": prefetch_used / prefetched if prefetched else 0.0,
+    }
@@ -0,0 +1,196 @@
+import itertools
+from collections import deque
+from typing import Optional, List, Dict, Iterator, Tuple, Union
+
+import torch
+
+from model.MyLlama import Transformer, SlotKVCache
+from model.Sampler import Sampler
+
+SAMPLING_KEYS = ("temperature", "top_k", "top_p", "min_p",
+                 "repetition_penalty", "presence_penalty", "frequency_penalty")
+# 各采样参数不生效时的取值，batch中混合不同设置时用它填充
+SAMPLING_DEFAULTS = dict(temperature=1.0, top_k=0, top_p=1.0, min_p=0.0,
+                         repetition_penalty=1.0, presence_penalty=0.0, frequency_penalty=0.0)
+PENALTY_KEYS = ("repetition_penalty", "presence_penalty", "frequency_penalty")
+
+
+class Request:
+    def __init__(self, request_id, prompt_ids: List[int], max_new_tokens: int, sampling: dict):
+        self.request_id = request_id
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.output_ids: List[int] = []
+        self.finished = False
+        self.finish_reason: Optional[str] = None  # "eos" 或 "length"
+
+
+class LLMEngine:
+    """
+    连续批处理(continuous batching)推理引擎
+
+    引擎持有一个按slot划分的SlotKVCache，每个正在生成的请求占用一个slot。
+    每次step先对所有运行中的请求做一次批量解码，到达EOS或最大长度的请求立即退出并释放slot，
+    然后把等待队列中的新请求逐个prefill进空闲slot。
+    每个请求可以有自己的采样参数，同一个batch内由Sampler逐行处理。
+    退出时把最后一个活跃slot搬到空出的位置，保证活跃请求总是占据前n个slot，解码时直接使用缓存的连续视图。
+
+    用法:
+        engine = LLMEngine(model, max_batch_size=8, max_seq_len=2048)
+        engine.submit(prompt_ids, max_new_tokens=128)
+        for request_id, token_id, finished in engine.stream():
+            ...
+    """
+    def __init__(self,
+                 model: Transformer,
+                 max_batch_size: int = 8,
+                 max_seq_len: int = 2048,
+                 eos_token_id: Optional[int] = None,
+                 do_sample: bool = True,
+                 prefill_chunk_size: Optional[int] = None,
+                 **sampling):
+        self.model = model.eval()
+        param = next(model.parameters())
+        self.device = param.device
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.eos_token_id = model.args.eos_token_id if eos_token_id is None else eos_token_id
+        # 长prompt分块prefill，限制单次前向的峰值内存
+        self.prefill_chunk_size = prefill_chunk_size
+        # 引擎级别的默认采样参数，do_sample=False等价于temperature=0的贪心解码
+        self.default_sampling = dict(SAMPLING_DEFAULTS)
+        self.default_sampling.update(self._check_sampling(sampling))
+        if not do_sample:
+            self.default_sampling["temperature"] = 0.0
+        self.cache = SlotKVCache(model.args, max_batch_size, max_seq_len, device=param.device, dtype=param.dtype)
+
+        self.waiting: deque = deque()
+        # running[i]占用cache的第i个slot
+        self.running: List[Request] = []
+        # 未结束的请求，结束后移除
+        self.requests: Dict[object, Request] = {}
+        self._request_counter = itertools.count()
+
+    def submit(self,
+               prompt_ids: Union[List[int], torch.Tensor],
+               max_new_tokens: int = 100,
+               request_id=None,
+               **sampling):
+        if isinstance(prompt_ids, torch.Tensor):
+            prompt_ids = prompt_ids.view(-1).tolist()
+        assert 0 < len(prompt_ids) < self.max_seq_len, f"prompt长度必须在(0, {self.max_seq_len})之间"
+        request_id = next(self._request_counter) if request_id is None else request_id
+        assert request_id not in self.requests, f"重复的request_id: {request_id}"
+        request = Request(request_id, list(prompt_ids), max_new_tokens,
+                          dict(self.default_sampling, **self._check_sampling(sampling)))
+        self.requests[request_id] = request
+        self.waiting.append(request)
+        return request_id
+
+    @staticmethod
+    def _check_sampling(sampling: dict) -> dict:
+        unknown = set(sampling) - set(SAMPLING_KEYS)
+        assert not unknown, f"不支持的采样参数: {unknown}"
+        return {k: v for k, v in sampling.items() if v is not None}
+
+    def has_unfinished(self) -> bool:
+        return bool(self.waiting or self.running)
+
+    @torch.inference_mode()
+    def step(self) -> List[Tuple[object, int, bool]]:
+        """
+        执行一次调度：批量解码运行中的请求，再把等待的请求放入空闲slot
+        返回本次产生的 (request_id, token_id, finished) 列表
+        """
+        outputs = []
+        if self.running:
+            outputs += self._decode()
+        while self.waiting and len(self.running) < self.max_batch_size:
+            outputs += self._prefill(self.waiting.popleft())
+        return outputs
+
+    def stream(self) -> Iterator[Tuple[object, int, bool]]:
+        while self.has_unfinished():
+            yield from self.step()
+
+    def __iter__(self):
+        return self.stream()
+
+    def generate(self, prompts: List[List[int]], max_new_tokens: int = 100) -> List[List[int]]:
+        # 便捷接口：提交所有prompt并运行到结束，按提交顺序返回生成的token
+        requests = [self.requests[self.submit(prompt, max_new_tokens)] for prompt in prompts]
+        for _ in self.stream():
+            pass
+        return [request.output_ids for request in requests]
+
+    def _prefill(self, request: Request):
+        slot = len(self.running)
+        self.running.append(request)
+        self.cache.reset_slot(slot)
+        self.cache.select(slot, slot + 1)
+        input_ids = torch.tensor([request.prompt_ids], dtype=torch.long, device=self.device)
+        if self.prefill_chunk_size is not None:
+            logits = self.model.prefill(input_ids, self.cache, chunk_size=self.prefill_chunk_size)
+        else:
+            logits = self.model(input_ids=input_ids, past_key_values=self.cache, use_cache=True,
+                                logits_to_keep=1)["logits"][:, -1, :]
+        next_tokens = self._sample(logits, [request])
+        return self._append_tokens([slot], next_tokens.view(-1).tolist())
+
+    def _decode(self):
+        n = len(self.running)
+        self.cache.select(0, n)
+        input_ids = torch.tensor([[request.output_ids[-1]] for request in self.running],
+                                 dtype=torch.long, device=self.device)
+        logits = self.model(input_ids=input_ids, past_key_values=self.cache, use_cache=True,
+                            logits_to_keep=1)["logits"]
+        next_tokens = self._sample(logits[:, -1, :], self.running)
+        return self._append_tokens(list(range(n)), next_tokens.view(-1).tolist())
+
+    def _sample(self, logits: torch.Tensor, requests: List[Request]) -> torch.Tensor:
+        # 把每个请求的采样参数拼成逐行参数，一次完成整个batch的采样
+        params = {}
+        for key in SAMPLING_KEYS:
+            values = [request.sampling[key] for request in requests]
+            # 所有行相同时传标量，未生效的参数可以整体跳过
+            params[key] = values[0] if all(v == values[0] for v in values) else values
+        sampler = Sampler(**params)
+        token_ids = None
+        if any(request.sampling[key] != SAMPLING_DEFAULTS[key] for request in requests for key in PENALTY_KEYS):
+            # 惩罚需要历史token，长度不齐的部分用-1填充
+            histories = [request.prompt_ids + request.output_ids for request in requests]
+            max_len = max(len(history) for history in histories)
+            token_ids = torch.tensor([history + [-1] * (max_len - len(history)) for history in histories],
+                                     dtype=torch.long, device=self.device)
+        return sampler(logits, token_ids)
+
+    def _append_tokens(self, slots: List[int], tokens: List[int]):
+        outputs, finished_slots = [], []
+        for slot, token in zip(slots, tokens):
+            request = self.running[slot]
+            request.output_ids.append(token)
+            if token == self.eos_token_id:
+                request.finish_reason = "eos"
+            elif len(request.output_ids) >= request.max_new_tokens or \
+                    len(request.prompt_ids) + len(request.output_ids) >= self.max_seq_len:
+                # 缓存中已没有位置写入下一个token
+                request.finish_reason = "length"
+            if request.finish_reason is not None:
+                request.finished = True
+                finished_slots.append(slot)
+                del self.requests[request.request_id]
+            outputs.append((request.request_id, token, request.finished))
+        # 从大到小释放，被搬动的最后一个slot一定是未结束的请求
+        for slot in sorted(finished_slots, reverse=True):
+            self._release(slot)
+        return outputs
+
+    def _release(self, slot: int):
+        last = len(self.running) - 1
+        if slot != last:
+            self.cache.move(last, slot)
+            self.running[slot] = self.running[last]
+        else:
+            self.cache.reset_slot(slot)
+        self.running.pop()
@@ -36,6 +36,15 @@ class MiniMindConfig(PretrainedConfig):
             aux_loss_alpha: float = 0.1,
             seq_aux: bool = True,
             norm_topk_prob: bool = True,
+            moe_layout: str = 'list',
+            capacity_factor: float = 0.0,
+            eval_capacity_factor: float = 0.0,
+            overflow_policy: str = 'drop',
+            ####################################################
+            # 训练相关
+            ####################################################
+            activation_checkpointing: int = 0,
+            activation_checkpointing_mode: str = 'full',
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -65,20 +74,40 @@ class MiniMindConfig(PretrainedConfig):
         self.aux_loss_alpha = aux_loss_alpha  # 辅助损失的alpha参数
         self.seq_aux = seq_aux  # 是否在序列级别上计算辅助损失
         self.norm_topk_prob = norm_topk_prob  # 是否标准化top-k概率
+        # 'list': 每个专家一个FeedForward；'stacked': 所有专家的权重堆叠成 [n_experts, ...] 的张量；
+        # 'offload': 只用于推理，路由专家的权重在内存映射文件中，每层只缓存部分专家（见enable_expert_offload）
+        self.moe_layout = moe_layout
+        # 训练时每个专家最多处理 capacity_factor * token数 * top_k / 专家数 个分配，<=0表示不限制
+        self.capacity_factor = capacity_factor
+        # 推理（eval/generate）时的容量因子，默认不限制，避免输出随batch的组成变化
+        self.eval_capacity_factor = eval_capacity_factor
+        self.overflow_policy = overflow_policy  # 超出容量的分配：'drop'丢弃，'reroute'改由排名第 top_k + j 的专家处理，仍然超出再丢弃
+        ####################################################
+        # 训练相关
+        ####################################################
+        # 激活重计算：>0时每activation_checkpointing层中的第一层在反向时重新计算前向
+        # 'full'重算整个MiniMindBlock，只保存层的输入；'selective'只重算注意力分数和MLP的中间结果，不重算线性层
+        self.activation_checkpointing = activation_checkpointing
+        self.activation_checkpointing_mode = activation_checkpointing_mode
 
 
 # 📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘
 #                                             MiniMind Model
 # 📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘📘
 
+import re
 import math
 import torch
 from torch import nn
 from transformers.activations import ACT2FN
 from typing import Optional, Tuple, List, Union
 import torch.nn.functional as F
-from transformers import PreTrainedModel, GenerationMixin, PretrainedConfig
+from torch.utils.checkpoint import checkpoint
+from transformers import PreTrainedModel, GenerationMixin, PretrainedConfig, LogitsProcessor
 from transformers.modeling_outputs import CausalLMOutputWithPast
+from model.Sampler import Sampler
+from model.ExpertCache import ExpertStore, ExpertCache
+from model.MoERouting import MoEGate, moe_dispatch
 
 
 class RMSNorm(torch.nn.Module):
@@ -124,9 +153,138 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+class PagedKVCache:
+    """
+    分页KV Cache
+
+    KV按固定大小的token块(block)存放在每层共享的块池中，块池形状为 [num_blocks, block_size, n_kv_heads, head_dim]。
+    空闲块用free list管理，每个序列维护自己的块表(block table)，按需逐块分配，序列结束后归还，
+    因此占用的显存与实际存活的token数成正比，而不是与最大长度成正比。
+    注意力计算前把本次batch用到的块拷贝进一个各层复用的缓冲区（只用于推理），
+    拷贝量为 batch × ceil(kv_len / block_size) 个块，不随num_blocks增长，也不在每层重新分配。
+
+    用法:
+        cache = PagedKVCache(config, num_blocks=1024, block_size=16)
+        cache.add_sequence(seq_id)
+        cache.select([seq_id, ...])            # 本次前向涉及的序列，按batch顺序
+        model(input_ids, past_key_values=cache, use_cache=True)
+        cache.free_sequence(seq_id)
+    """
+    def __init__(self,
+                 config: MiniMindConfig,
+                 num_blocks: int,
+                 block_size: int = 16,
+                 device: Optional[torch.device] = None,
+                 dtype: torch.dtype = torch.float32):
+        n_kv_heads = config.num_attention_heads if config.num_key_value_heads is None else config.num_key_value_heads
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (num_blocks, block_size, n_kv_heads, head_dim)
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.device = device
+        self.key_blocks = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)]
+        self.value_blocks = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)]
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.block_tables = {}
+        self.seq_lens = {}
+        self.active_seqs = []
+        self.slot_mapping = None
+        self.block_table = None
+        self.kv_len = 0
+        # update()取出连续kv用的缓冲区，见_gather
+        self._buffers = {}
+
+    def add_sequence(self, seq_id):
+        assert seq_id not in self.block_tables, f"序列{seq_id}已存在"
+        self.block_tables[seq_id] = []
+        self.seq_lens[seq_id] = 0
+
+    def free_sequence(self, seq_id):
+        self.free_blocks.extend(reversed(self.block_tables.pop(seq_id)))
+        del self.seq_lens[seq_id]
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        return -(-num_tokens // self.block_size) <= len(self.free_blocks)
+
+    def select(self, seq_ids):
+        self.active_seqs = list(seq_ids)
+
+    def prepare(self, seq_length: int, batch_size: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        为active_seqs的每个序列预留seq_length个新位置，
+        返回逐行位置 [batch, seq_length] 以及bool注意力掩码 [batch, 1, seq_length, kv_len]
+        """
+        assert self.active_seqs, "PagedKVCache没有选中的序列，需要先调用select"
+        assert batch_size is None or batch_size == len(self.active_seqs), \
+            f"输入的batch大小{batch_size}与选中的序列数{len(self.active_seqs)}不一致"
+        tables, starts = [], []
+        for seq_id in self.active_seqs:
+            table, start = self.block_tables[seq_id], self.seq_lens[seq_id]
+            num_needed = -(-(start + seq_length) // self.block_size) - len(table)
+            if num_needed > len(self.free_blocks):
+                raise RuntimeError(f"PagedKVCache块不足: 需要{num_needed}, 剩余{len(self.free_blocks)}")
+            for _ in range(num_needed):
+                table.append(self.free_blocks.pop())
+            tables.append(table)
+            starts.append(start)
+        self.kv_len = max(starts) + seq_length
+        # 只取覆盖kv_len的块；块表补齐到相同长度，补齐的块在掩码中不可见
+        max_blocks = -(-self.kv_len // self.block_size)
+        self.block_table = torch.tensor([table[:max_blocks] + [0] * (max_blocks - len(table)) for table in tables],
+                                        dtype=torch.long, device=self.device)
+        position_ids = torch.tensor(starts, device=self.device)[:, None] + torch.arange(seq_length, device=self.device)
+        # 每个新token写入的slot = 所在块的编号 * block_size + 块内偏移
+        self.slot_mapping = (self.block_table.gather(1, position_ids // self.block_size) * self.block_size
+                             + position_ids % self.block_size).view(-1)
+        k_pos = torch.arange(self.kv_len, device=self.device)
+        attention_mask = (k_pos <= position_ids[:, None, :, None])
+        return position_ids, attention_mask
+
+    def _gather(self, blocks: torch.Tensor, name: str) -> torch.Tensor:
+        # 把块表中的块拷贝进复用的缓冲区 [batch, max_blocks * block_size, n_kv_heads, head_dim]；
+        # 缓冲区在各层之间共用（每层的注意力算完才会进入下一层），只在需要更大时重新分配
+        bsz, max_blocks = self.block_table.shape
+        shape = (bsz * max_blocks,) + tuple(blocks.shape[1:])
+        numel = math.prod(shape)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != blocks.dtype:
+            buffer = self._buffers[name] = torch.empty(numel, device=blocks.device, dtype=blocks.dtype)
+        out = buffer[:numel].view(shape)
+        torch.index_select(blocks, 0, self.block_table.view(-1), out=out)
+        return out.view(bsz, max_blocks * self.block_size, *blocks.shape[2:])[:, :self.kv_len]
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # 新token写入各自的slot，再只取出用到的块拼成连续的kv
+        _, _, n_kv_heads, head_dim = xk.shape
+        key_blocks, value_blocks = self.key_blocks[layer_id], self.value_blocks[layer_id]
+        key_blocks.view(-1, n_kv_heads, head_dim)[self.slot_mapping] = xk.reshape(-1, n_kv_heads, head_dim).to(key_blocks.dtype)
+        value_blocks.view(-1, n_kv_heads, head_dim)[self.slot_mapping] = xv.reshape(-1, n_kv_heads, head_dim).to(value_blocks.dtype)
+        return self._gather(key_blocks, "key"), self._gather(value_blocks, "value")
+
+    def advance(self, n: int):
+        for seq_id in self.active_seqs:
+            self.seq_lens[seq_id] += n
+
+    def stats(self) -> dict:
+        used_blocks = self.num_blocks - len(self.free_blocks)
+        live_tokens = sum(self.seq_lens.values())
+        return {
+            "num_blocks": self.num_blocks,
+            "block_size": self.block_size,
+            "used_blocks": used_blocks,
+            "free_blocks": len(self.free_blocks),
+            "num_seqs": len(self.block_tables),
+            "live_tokens": live_tokens,
+            # 已分配的位置中真正存放token的比例，剩余部分是每个序列最后一个块的内部碎片
+            "utilization": live_tokens / (used_blocks * self.block_size) if used_blocks else 0.0,
+            "bytes_per_block": sum(k[0].nelement() * k.element_size() * 2 for k in self.key_blocks),
+        }
+
+
 class Attention(nn.Module):
-    def __init__(self, args: MiniMindConfig):
+    def __init__(self, args: MiniMindConfig, layer_id: int = 0):
         super().__init__()
+        self.layer_id = layer_id
         self.num_key_value_heads = args.num_attention_heads if args.num_key_value_heads is None else args.num_key_value_heads
         assert args.num_attention_heads % self.num_key_value_heads == 0
         self.n_local_heads = args.num_attention_heads
@@ -141,6 +299,8 @@ class Attention(nn.Module):
         self.resid_dropout = nn.Dropout(args.dropout)
         self.dropout = args.dropout
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention') and args.flash_attn
+        # selective激活重计算时由MiniMindBlock设置
+        self.recompute = False
         # print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
 
     def forward(self,
@@ -156,21 +316,58 @@ class Attention(nn.Module):
         xv = xv.view(bsz, seq_len, self.n_local_kv_heads, self.head_dim)
 
         cos, sin = position_embeddings
-        xq, xk = apply_rotary_pos_emb(xq, xk, cos[:seq_len], sin[:seq_len])
+        if cos.dim() == 3:
+            # 逐行位置 [bsz, seq_len, head_dim]，在头的维度上广播
+            xq, xk = apply_rotary_pos_emb(xq, xk, cos, sin, unsqueeze_dim=2)
+        else:
+            xq, xk = apply_rotary_pos_emb(xq, xk, cos[:seq_len], sin[:seq_len])
 
         # kv_cache实现
-        if past_key_value is not None:
-            xk = torch.cat([past_key_value[0], xk], dim=1)
-            xv = torch.cat([past_key_value[1], xv], dim=1)
-        past_kv = (xk, xv) if use_cache else None
+        if isinstance(past_key_value, PagedKVCache):
+            xk, xv = past_key_value.update(self.layer_id, xk, xv)
+            past_kv = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                xk = torch.cat([past_key_value[0], xk], dim=1)
+                xv = torch.cat([past_key_value[1], xv], dim=1)
+            past_kv = (xk, xv) if use_cache else None
+
+        kv_len = xk.shape[1]
+        if seq_len > 1 and kv_len != seq_len and (attention_mask is None or attention_mask.dim() != 4):
+            # 分块prefill：当前块的query排在已缓存的历史之后，需要带偏移的因果掩码
+            causal_mask = torch.ones(seq_len, kv_len, dtype=torch.bool, device=x.device).tril(kv_len - seq_len)
+            causal_mask = causal_mask[None, None]
+            if attention_mask is not None:
+                causal_mask = causal_mask & attention_mask[:, None, None, :kv_len].bool()
+            attention_mask = causal_mask
+
+        if self.recompute and self.training and torch.is_grad_enabled():
+            # 不保存注意力分数，反向时由q/k/v重新计算
+            output = checkpoint(self._attention, xq, xk, xv, attention_mask, use_reentrant=False)
+        else:
+            output = self._attention(xq, xk, xv, attention_mask)
+        output = self.resid_dropout(self.o_proj(output))
+        return output, past_kv
 
+    def _attention(self, xq, xk, xv, attention_mask):
+        bsz, seq_len = xq.shape[:2]
         xq, xk, xv = (
             xq.transpose(1, 2),
             repeat_kv(xk, self.n_rep).transpose(1, 2),
             repeat_kv(xv, self.n_rep).transpose(1, 2)
         )
 
-        if self.flash and seq_len != 1:
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # 调用方给出了完整的bool掩码（例如分页缓存按每行位置构造的掩码）
+            if self.flash:
+                dropout_p = self.dropout if self.training else 0.0
+                output = F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attention_mask, dropout_p=dropout_p)
+            else:
+                scores = (xq @ xk.transpose(-2, -1)) / math.sqrt(self.head_dim)
+                scores = scores.masked_fill(~attention_mask, float("-inf"))
+                scores = self.attn_dropout(F.softmax(scores.float(), dim=-1).type_as(xq))
+                output = scores @ xv
+        elif self.flash and seq_len != 1:
             dropout_p = self.dropout if self.training else 0.0
             attn_mask = None
             if attention_mask is not None:
@@ -194,9 +391,7 @@ class Attention(nn.Module):
             scores = self.attn_dropout(scores)
             output = scores @ xv
 
-        output = output.transpose(1, 2).reshape(bsz, seq_len, -1)
-        output = self.resid_dropout(self.o_proj(output))
-        return output, past_kv
+        return output.transpose(1, 2).reshape(bsz, seq_len, -1)
 
 
 class FeedForward(nn.Module):
@@ -210,66 +405,20 @@ class FeedForward(nn.Module):
         self.up_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
         self.dropout = nn.Dropout(config.dropout)
         self.act_fn = ACT2FN[config.hidden_act]
+        # selective激活重计算时由MiniMindBlock设置
+        self.recompute = False
 
-    def forward(self, x):
-        return self.dropout(self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x)))
-
+    def _gated(self, gate, up):
+        return self.act_fn(gate) * up
 
-class MoEGate(nn.Module):
-    def __init__(self, config: MiniMindConfig):
-        super().__init__()
-        self.config = config
-        self.top_k = config.num_experts_per_tok
-        self.n_routed_experts = config.n_routed_experts
-
-        self.scoring_func = config.scoring_func
-        self.alpha = config.aux_loss_alpha
-        self.seq_aux = config.seq_aux
-
-        self.norm_topk_prob = config.norm_topk_prob
-        self.gating_dim = config.hidden_size
-        self.weight = nn.Parameter(torch.empty((self.n_routed_experts, self.gating_dim)))
-        self.reset_parameters()
-
-    def reset_parameters(self) -> None:
-        import torch.nn.init as init
-        init.kaiming_uniform_(self.weight, a=math.sqrt(5))
-
-    def forward(self, hidden_states):
-        bsz, seq_len, h = hidden_states.shape
-        hidden_states = hidden_states.view(-1, h)
-        logits = F.linear(hidden_states, self.weight, None)
-        if self.scoring_func == 'softmax':
-            scores = logits.softmax(dim=-1)
-        else:
-            raise NotImplementedError(f'insupportable scoring function for MoE gating: {self.scoring_func}')
-
-        topk_weight, topk_idx = torch.topk(scores, k=self.top_k, dim=-1, sorted=False)
-
-        if self.top_k > 1 and self.norm_topk_prob:
-            denominator = topk_weight.sum(dim=-1, keepdim=True) + 1e-20
-            topk_weight = topk_weight / denominator
-
-        if self.training and self.alpha > 0.0:
-            scores_for_aux = scores
-            aux_topk = self.top_k
-            topk_idx_for_aux_loss = topk_idx.view(bsz, -1)
-            if self.seq_aux:
-                scores_for_seq_aux = scores_for_aux.view(bsz, seq_len, -1)
-                ce = torch.zeros(bsz, self.n_routed_experts, device=hidden_states.device)
-                ce.scatter_add_(1, topk_idx_for_aux_loss,
-                                torch.ones(bsz, seq_len * aux_topk, device=hidden_states.device)).div_(
-                    seq_len * aux_topk / self.n_routed_experts)
-                aux_loss = (ce * scores_for_seq_aux.mean(dim=1)).sum(dim=1).mean() * self.alpha
-            else:
-                mask_ce = F.one_hot(topk_idx_for_aux_loss.view(-1), num_classes=self.n_routed_experts)
-                ce = mask_ce.float().mean(0)
-                Pi = scores_for_aux.mean(0)
-                fi = ce * self.n_routed_experts
-                aux_loss = (Pi * fi).sum() * self.alpha
+    def forward(self, x):
+        gate, up = self.gate_proj(x), self.up_proj(x)
+        if self.recompute and self.training and torch.is_grad_enabled():
+            # 只保存gate和up，激活函数的输出和乘积在反向时重算
+            hidden = checkpoint(self._gated, gate, up, use_reentrant=False)
         else:
-            aux_loss = 0
-        return topk_idx, topk_weight, aux_loss
+            hidden = self._gated(gate, up)
+        return self.dropout(self.down_proj(hidden))
 
 
 class MOEFeedForward(nn.Module):
@@ -294,16 +443,10 @@ class MOEFeedForward(nn.Module):
         # 使用门控机制选择专家
         topk_idx, topk_weight, aux_loss = self.gate(x)
         x = x.view(-1, x.shape[-1])
-        flat_topk_idx = topk_idx.view(-1)
         if self.training:
-            x = x.repeat_interleave(self.config.num_experts_per_tok, dim=0)
-            y = torch.empty_like(x, dtype=torch.float16)
-            for i, expert in enumerate(self.experts):
-                y[flat_topk_idx == i] = expert(x[flat_topk_idx == i]).to(y.dtype)  # 确保类型一致
-            y = (y.view(*topk_weight.shape, -1) * topk_weight.unsqueeze(-1)).sum(dim=1)
-            y = y.view(*orig_shape)
+            y = moe_dispatch(x, topk_idx, topk_weight, self.experts).view(*orig_shape)
         else:
-            y = self.moe_infer(x, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
+            y = self.moe_infer(x, topk_idx.view(-1), topk_weight.view(-1, 1)).view(*orig_shape)
         if self.config.n_shared_experts > 0:
             for expert in self.shared_experts:
                 y = y + expert(identity)
@@ -312,26 +455,242 @@ class MOEFeedForward(nn.Module):
 
     @torch.no_grad()
     def moe_infer(self, x, flat_expert_indices, flat_expert_weights):
-        expert_cache = torch.zeros_like(x)
-        idxs = flat_expert_indices.argsort()
-        tokens_per_expert = flat_expert_indices.bincount().cpu().numpy().cumsum(0)
-        token_idxs = idxs // self.config.num_experts_per_tok
-        # 当tokens_per_expert = [6, 15, 20, 26]，tokens_per_expert.shape[0]即为专家数量（此时为4）
-        # 且token_idxs = [3, 7, 19, 21, 24, 25,  4,  5,  6, 10, 11, 12...] 时
-        # 意味token_idxs[:6] -> [3, 7, 19, 21, 24, 25]这6个位置属于专家0处理的token（每个token有可能被多个专家处理，这取决于num_experts_per_tok）
-        # 接下来9个位置token_idxs[6:15] -> [4,  5,  6, 10, 11, 12...]属于专家1处理的token...依此类推
-        for i, end_idx in enumerate(tokens_per_expert):
-            start_idx = 0 if i == 0 else tokens_per_expert[i - 1]
-            if start_idx == end_idx:
-                continue
-            expert = self.experts[i]
-            exp_token_idx = token_idxs[start_idx:end_idx]
-            expert_tokens = x[exp_token_idx]
-            expert_out = expert(expert_tokens).to(expert_cache.dtype)
-            expert_out.mul_(flat_expert_weights[idxs[start_idx:end_idx]])
-            expert_cache.scatter_add_(0, exp_token_idx.view(-1, 1).repeat(1, x.shape[-1]), expert_out)
-
-        return expert_cache
+        top_k = self.config.num_experts_per_tok
+        return moe_dispatch(x, flat_expert_indices.view(-1, top_k), flat_expert_weights.view(-1, top_k), self.experts)
+
+
+class StackedMOEFeedForward(nn.Module):
+    """
+    专家权重堆叠存储的MoE层，与MOEFeedForward数值等价
+
+    gate_proj/up_proj: [n_experts, intermediate_size, hidden_size]，down_proj: [n_experts, hidden_size, intermediate_size]
+    （与nn.Linear的weight方向一致）。token-专家的分配按专家排序后放进 [段数, capacity, hidden_size] 的缓冲区，
+    三次bmm算完，再按权重累加回各自的token。所有形状只由token数、top_k和专家数决定，
+    计数和偏移都在设备上计算，前向中没有host同步，也没有逐专家的Python循环：
+        分配数 < 专家数（解码）: 每个用到的专家占一段，只取出这些专家的权重（每个专家一份，与token数无关），
+                                段数为分配数，计算量与专家总数无关；
+        分配数 >= 专家数（prefill/训练）: 每个专家一段，直接使用堆叠的权重。
+    capacity为每段最多的token数：gate限制了容量(capacity_factor/eval_capacity_factor)时为该容量，否则为token数。
+    不限制容量时prefill的缓冲区为 n_experts × token数，计算量最多是实际分配数的 n_experts / top_k 倍，
+    token数很多时可以设置容量因子，或者使用moe_layout='list'。
+    可以直接加载MOEFeedForward的权重（experts.{i}.*），加载时自动堆叠，也可以用stack_moe_state_dict离线转换。
+    """
+    def __init__(self, config: MiniMindConfig):
+        super().__init__()
+        self.config = config
+        if config.intermediate_size is None:
+            intermediate_size = int(config.hidden_size * 8 / 3)
+            config.intermediate_size = 64 * ((intermediate_size + 64 - 1) // 64)
+        n_experts, hidden_size, intermediate_size = config.n_routed_experts, config.hidden_size, config.intermediate_size
+        self.gate_proj = nn.Parameter(torch.empty(n_experts, intermediate_size, hidden_size))
+        self.up_proj = nn.Parameter(torch.empty(n_experts, intermediate_size, hidden_size))
+        self.down_proj = nn.Parameter(torch.empty(n_experts, hidden_size, intermediate_size))
+        for weight in (self.gate_proj, self.up_proj, self.down_proj):
+            # 与nn.Linear相同的初始化
+            for expert_weight in weight:
+                nn.init.kaiming_uniform_(expert_weight, a=math.sqrt(5))
+        self.act_fn = ACT2FN[config.hidden_act]
+        self.dropout = nn.Dropout(config.dropout)
+        self.gate = MoEGate(config)
+        if config.n_shared_experts > 0:
+            self.shared_experts = nn.ModuleList([
+                FeedForward(config)
+                for _ in range(config.n_shared_experts)
+            ])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        stack_moe_state_dict(state_dict, self.config.n_routed_experts, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _experts(self, x, gate_proj, up_proj, down_proj):
+        # x: [batch, tokens, hidden_size]，各权重的第0维与x的batch对应
+        hidden = self.act_fn(torch.bmm(x, gate_proj.transpose(1, 2))) * torch.bmm(x, up_proj.transpose(1, 2))
+        return self.dropout(torch.bmm(hidden, down_proj.transpose(1, 2)))
+
+    def _capacity(self, num_tokens: int, top_k: int) -> int:
+        # 与MoEGate._apply_capacity相同的容量；一个token不会两次选同一个专家，每段最多num_tokens个分配
+        capacity_factor = self.gate.capacity_factor if self.training else self.gate.eval_capacity_factor
+        if capacity_factor > 0:
+            return min(num_tokens, math.ceil(capacity_factor * num_tokens * top_k / self.config.n_routed_experts))
+        return num_tokens
+
+    def forward(self, x):
+        identity = x
+        orig_shape = x.shape
+        topk_idx, topk_weight, aux_loss = self.gate(x)
+        x = x.view(-1, x.shape[-1])
+        num_tokens, hidden_size = x.shape
+        n_experts = self.config.n_routed_experts
+        top_k = topk_idx.shape[-1]
+        num_assignments = num_tokens * top_k
+        capacity = self._capacity(num_tokens, top_k)
+        flat_idx = topk_idx.reshape(-1)
+        order = flat_idx.argsort(stable=True)
+        sorted_experts = flat_idx[order]
+        token_idx = order // top_k
+        # 排序后同一个专家的分配连续，is_first标记每段的开头；被丢弃的分配(编号n_experts)是最后一段
+        is_first = torch.ones_like(sorted_experts, dtype=torch.bool)
+        is_first[1:] = sorted_experts[1:] != sorted_experts[:-1]
+        positions = torch.arange(num_assignments, device=x.device)
+        # 每个分配在所属段中的序号
+        slot = positions - torch.where(is_first, positions, torch.zeros_like(positions)).cummax(0).values
+        if num_assignments < n_experts:
+            num_segments = num_assignments
+            segment = is_first.long().cumsum(0) - 1
+            segment_expert = torch.zeros_like(segment).scatter_(0, segment, sorted_experts.clamp(max=n_experts - 1))
+            weights = self.gate_proj[segment_expert], self.up_proj[segment_expert], self.down_proj[segment_expert]
+        else:
+            num_segments = n_experts
+            segment = sorted_experts
+            weights = self.gate_proj, self.up_proj, self.down_proj
+        # 被丢弃的分配写到缓冲区最后多出的一行，不参与计算，取回时为0
+        dump = num_segments * capacity
+        dest = torch.where((sorted_experts < n_experts) & (slot < capacity), segment * capacity + slot,
+                           torch.full_like(slot, dump))
+        buffer = x.new_zeros(dump + 1, hidden_size).index_put((dest,), x[token_idx])
+        expert_out = self._experts(buffer[:dump].view(num_segments, capacity, hidden_size), *weights)
+        expert_out = F.pad(expert_out.reshape(dump, hidden_size), (0, 0, 0, 1))[dest]
+        expert_out = expert_out * topk_weight.reshape(-1, 1)[order]
+        y = expert_out.new_zeros(x.shape).index_add(0, token_idx, expert_out)
+        y = y.to(x.dtype).view(*orig_shape)
+        if self.config.n_shared_experts > 0:
+            for expert in self.shared_experts:
+                y = y + expert(identity)
+        self.aux_loss = aux_loss
+        return y
+
+
+def stack_moe_state_dict(state_dict, n_routed_experts, prefix=""):
+    """
+    把MOEFeedForward的权重 {prefix}...experts.{i}.{gate,up,down}_proj.weight 原地转换成
+    StackedMOEFeedForward的 {prefix}...{gate,up,down}_proj，返回state_dict
+    """
+    pattern = re.compile(r"^(" + re.escape(prefix) + r"(?:.*\.)?)experts\.(\d+)\.(gate_proj|up_proj|down_proj)\.weight$")
+    groups = {}
+    for key in list(state_dict):
+        match = pattern.match(key)
+        if match:
+            groups.setdefault((match.group(1), match.group(3)), {})[int(match.group(2))] = key
+    for (module_prefix, name), keys in groups.items():
+        assert sorted(keys) == list(range(n_routed_experts)), f"{module_prefix}experts 的专家数与配置不一致"
+        state_dict[module_prefix + name] = torch.stack([state_dict.pop(keys[i]) for i in range(n_routed_experts)])
+    return state_dict
+
+
+class OffloadedMOEFeedForward(nn.Module):
+    """
+    路由专家权重放在内存映射文件(ExpertStore)中的MoE层，只用于推理，与MOEFeedForward数值等价
+
+    门控和共享专家常驻内存，路由专家由每层的ExpertCache按LRU最多保存expert_cache_size个。
+    本层门控选出专家后，先用下一个MoE层的门控对本层的输入打分，在后台预取下一层可能用到的专家，
+    再逐个取出本层的专家计算，预取与本层的计算重叠。相邻层的残差流变化不大，这个预测通常比较准确。
+    通过enable_expert_offload设置缓存；加载checkpoint时忽略其中的路由专家权重。
+    """
+    def __init__(self, config: MiniMindConfig):
+        super().__init__()
+        self.config = config
+        self.act_fn = ACT2FN[config.hidden_act]
+        self.gate = MoEGate(config)
+        if config.n_shared_experts > 0:
+            self.shared_experts = nn.ModuleList([
+                FeedForward(config)
+                for _ in range(config.n_shared_experts)
+            ])
+        self.cache: Optional[ExpertCache] = None
+        # 下一个MoE层，用于预取
+        self.next_moe: Optional["OffloadedMOEFeedForward"] = None
+        self.aux_loss = 0
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for key in list(state_dict):
+            name = key[len(prefix):]
+            if key.startswith(prefix) and (name.startswith('experts.') or name in ('gate_proj', 'up_proj', 'down_proj')):
+                state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _expert(self, x, weights):
+        gate_proj, up_proj, down_proj = weights
+        return F.linear(self.act_fn(F.linear(x, gate_proj)) * F.linear(x, up_proj), down_proj)
+
+    def prefetch(self, hidden_states):
+        """用本层的门控对上一层的输入打分，按被选中的次数取最多capacity个专家在后台加载"""
+        topk_idx = F.linear(hidden_states, self.gate.weight).topk(self.gate.top_k, dim=-1).indices
+        counts = torch.bincount(topk_idx.view(-1), minlength=self.config.n_routed_experts)
+        num_predicted = min(int((counts > 0).sum()), self.cache.capacity)
+        self.cache.prefetch(counts.argsort(descending=True)[:num_predicted].tolist())
+
+    @torch.no_grad()
+    def forward(self, x):
+        assert self.cache is not None, "需要先调用enable_expert_offload"
+        identity = x
+        orig_shape = x.shape
+        topk_idx, topk_weight, _ = self.gate(x)
+        x = x.view(-1, x.shape[-1])
+        if self.next_moe is not None:
+            self.next_moe.prefetch(x)
+        n_experts = self.config.n_routed_experts
+        top_k = topk_idx.shape[-1]
+        flat_idx = topk_idx.reshape(-1)
+        order = flat_idx.argsort(stable=True)
+        counts = torch.bincount(flat_idx, minlength=n_experts + 1).tolist()
+        order = order[:sum(counts[:n_experts])]
+        token_idx = order // top_k
+        sorted_x = x[token_idx]
+        y = torch.zeros_like(x)
+        if len(order) > 0:
+            # 只取出有token的专家，按专家编号逐个计算
+            chunks = sorted_x.split(counts[:n_experts])
+            expert_out = torch.cat([self._expert(chunk, self.cache.get(i)) if len(chunk) > 0 else chunk
+                                    for i, chunk in enumerate(chunks)])
+            expert_out = expert_out * topk_weight.reshape(-1, 1)[order]
+            y = y.index_add(0, token_idx, expert_out.to(y.dtype))
+        y = y.view(*orig_shape)
+        if self.config.n_shared_experts > 0:
+            for expert in self.shared_experts:
+                y = y + expert(identity)
+        return y
+
+
+MOE_LAYERS = (MOEFeedForward, StackedMOEFeedForward, OffloadedMOEFeedForward)
+
+
+def enable_expert_offload(model, store: Union[str, ExpertStore], expert_cache_size: int, prefetch: bool = True,
+                          num_threads: int = 1) -> List[ExpertCache]:
+    """
+    给moe_layout='offload'的模型的每个MoE层创建ExpertCache，返回按层排列的缓存（用于统计命中率）
+    store: ExpertStore或其文件路径（用utils/convert_moe.py --expert_store生成）
+    expert_cache_size: 每层最多常驻的路由专家数
+    prefetch: 是否用下一层的门控预取专家；num_threads为预取的后台线程数
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    store = ExpertStore(store) if isinstance(store, str) else store
+    moe_layers = _offloaded_layers(model)
+    assert len(moe_layers) == store.num_layers, "ExpertStore的层数与模型的MoE层数不一致"
+    # 重复调用时先关闭上一次创建的预取线程
+    disable_expert_offload(model)
+    executor = ThreadPoolExecutor(max_workers=num_threads) if prefetch and num_threads > 0 else None
+    caches = []
+    for layer_id, moe in enumerate(moe_layers):
+        weight = moe.gate.weight
+        moe.cache = ExpertCache(store, layer_id, expert_cache_size, weight.dtype, weight.device, executor)
+        moe.next_moe = moe_layers[layer_id + 1] if prefetch and layer_id + 1 < len(moe_layers) else None
+        caches.append(moe.cache)
+    return caches
+
+
+def _offloaded_layers(model) -> List["OffloadedMOEFeedForward"]:
+    return [layer.mlp for layer in model.modules()
+            if isinstance(layer, MiniMindBlock) and isinstance(layer.mlp, OffloadedMOEFeedForward)]
+
+
+def disable_expert_offload(model):
+    """关闭enable_expert_offload创建的预取线程并释放各层的专家缓存"""
+    executors = {moe.cache.executor for moe in _offloaded_layers(model) if moe.cache is not None}
+    for executor in executors - {None}:
+        executor.shutdown(wait=True)
+    for moe in _offloaded_layers(model):
+        moe.cache = None
+        moe.next_moe = None
 
 
 class MiniMindBlock(nn.Module):
@@ -340,12 +699,28 @@ class MiniMindBlock(nn.Module):
         self.num_attention_heads = config.num_attention_heads
         self.hidden_size = config.hidden_size
         self.head_dim = config.hidden_size // config.num_attention_heads
-        self.self_attn = Attention(config)
+        self.self_attn = Attention(config, layer_id)
 
         self.layer_id = layer_id
         self.input_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
-        self.mlp = FeedForward(config) if not config.use_moe else MOEFeedForward(config)
+        if not config.use_moe:
+            self.mlp = FeedForward(config)
+        elif config.moe_layout == 'stacked':
+            self.mlp = StackedMOEFeedForward(config)
+        elif config.moe_layout == 'offload':
+            self.mlp = OffloadedMOEFeedForward(config)
+        else:
+            self.mlp = MOEFeedForward(config)
+        # 每activation_checkpointing层中的第一层做激活重计算
+        every = config.activation_checkpointing
+        self.checkpoint_mode = config.activation_checkpointing_mode if every > 0 and layer_id % every == 0 else None
+        assert self.checkpoint_mode in (None, 'full', 'selective'), f"不支持的重计算模式: {self.checkpoint_mode}"
+        self.self_attn.recompute = self.checkpoint_mode == 'selective'
+        for module in self.mlp.modules():
+            # MoE中的每个路由专家和共享专家
+            if isinstance(module, FeedForward):
+                module.recompute = self.checkpoint_mode == 'selective'
 
     def forward(self, hidden_states, position_embeddings, past_key_value=None, use_cache=False, attention_mask=None):
         residual = hidden_states
@@ -376,39 +751,70 @@ class MiniMindModel(nn.Module):
     def forward(self,
                 input_ids: Optional[torch.Tensor] = None,
                 attention_mask: Optional[torch.Tensor] = None,
-                past_key_values: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+                past_key_values: Optional[Union[List[Tuple[torch.Tensor, torch.Tensor]], PagedKVCache]] = None,
                 use_cache: bool = False,
+                # 为True时额外返回每个MoE层的路由统计（见MoEGate._routing_stats）
+                output_router_stats: bool = False,
                 **kwargs):
         batch_size, seq_length = input_ids.shape
-        past_key_values = past_key_values or [None] * len(self.layers)
-        start_pos = past_key_values[0][0].shape[1] if past_key_values[0] is not None else 0
+        paged_cache = past_key_values if isinstance(past_key_values, PagedKVCache) else None
+        if paged_cache is not None:
+            # 分页缓存中每个序列长度不同，位置和掩码逐行构造
+            position_ids, attention_mask = paged_cache.prepare(seq_length, batch_size)
+            past_key_values = [paged_cache] * len(self.layers)
+        else:
+            past_key_values = past_key_values or [None] * len(self.layers)
+            start_pos = past_key_values[0][0].shape[1] if past_key_values[0] is not None else 0
 
         hidden_states = self.dropout(self.embed_tokens(input_ids))
 
-        position_embeddings = (
-            self.freqs_cos[start_pos:start_pos + seq_length],
-            self.freqs_sin[start_pos:start_pos + seq_length]
-        )
+        if paged_cache is not None:
+            position_embeddings = (self.freqs_cos[position_ids], self.freqs_sin[position_ids])
+        else:
+            position_embeddings = (
+                self.freqs_cos[start_pos:start_pos + seq_length],
+                self.freqs_sin[start_pos:start_pos + seq_length]
+            )
+
+        for layer in self.layers:
+            if isinstance(layer.mlp, MOE_LAYERS):
+                # 路由统计只在请求时计算
+                layer.mlp.gate.collect_stats = output_router_stats
 
         presents = []
         for layer_idx, (layer, past_key_value) in enumerate(zip(self.layers, past_key_values)):
-            hidden_states, present = layer(
-                hidden_states,
-                position_embeddings,
-                past_key_value=past_key_value,
-                use_cache=use_cache,
-                attention_mask=attention_mask
-            )
+            if layer.checkpoint_mode == 'full' and self.training and torch.is_grad_enabled() and not use_cache:
+                # 只保存层的输入，反向时重新计算整层的前向
+                hidden_states, present = checkpoint(layer, hidden_states, position_embeddings, past_key_value,
+                                                    use_cache, attention_mask, use_reentrant=False)
+            else:
+                hidden_states, present = layer(
+                    hidden_states,
+                    position_embeddings,
+                    past_key_value=past_key_value,
+                    use_cache=use_cache,
+                    attention_mask=attention_mask
+                )
             presents.append(present)
+        if paged_cache is not None:
+            paged_cache.advance(seq_length)
+            presents = paged_cache if use_cache else None
 
         hidden_states = self.norm(hidden_states)
 
         aux_loss = sum(
             layer.mlp.aux_loss
             for layer in self.layers
-            if isinstance(layer.mlp, MOEFeedForward)
+            if isinstance(layer.mlp, MOE_LAYERS)
         )
 
+        if output_router_stats:
+            router_stats = [
+                dict(layer=layer_idx, **layer.mlp.gate.routing_stats)
+                for layer_idx, layer in enumerate(self.layers)
+                if isinstance(layer.mlp, MOE_LAYERS)
+            ]
+            return hidden_states, presents, aux_loss, router_stats
         return hidden_states, presents, aux_loss
 
 
@@ -430,7 +836,7 @@ class MiniMindForCausalLM(PreTrainedModel, GenerationMixin):
                 use_cache: bool = False,
                 logits_to_keep: Union[int, torch.Tensor] = 0,
                 **args):
-        h, past_kvs, aux_loss = self.model(
+        h, past_kvs, aux_loss, *router_stats = self.model(
             input_ids=input_ids,
             attention_mask=attention_mask,
             past_key_values=past_key_values,
@@ -443,8 +849,33 @@ class MiniMindForCausalLM(PreTrainedModel, GenerationMixin):
         self.OUT.__setitem__('logits', logits)
         self.OUT.__setitem__('aux_loss', aux_loss)
         self.OUT.__setitem__('past_key_values', past_kvs)
+        if router_stats or 'router_stats' in self.OUT:
+            # self.OUT在多次调用间复用，没有请求统计时清掉上一次的结果（ModelOutput不支持pop）
+            self.OUT.__setitem__('router_stats', router_stats[0] if router_stats else None)
         return self.OUT
 
+    @torch.inference_mode()
+    def prefill(self,
+                input_ids: torch.Tensor,
+                chunk_size: int = 512,
+                attention_mask: Optional[torch.Tensor] = None,
+                past_key_values: Optional[Union[List[Tuple[torch.Tensor, torch.Tensor]], PagedKVCache]] = None):
+        """
+        分块prefill：prompt按chunk_size切块依次写入KV Cache，每块只和已缓存的历史做注意力，
+        且只计算最后一个位置的logits，峰值内存不再随prompt长度平方增长。
+        返回 (最后一个位置的logits [batch_size, vocab_size], past_key_values)
+        """
+        for start in range(0, input_ids.shape[1], chunk_size):
+            out = self(
+                input_ids=input_ids[:, start:start + chunk_size],
+                attention_mask=attention_mask[:, :start + chunk_size] if attention_mask is not None else None,
+                past_key_values=past_key_values,
+                use_cache=True,
+                logits_to_keep=1
+            )
+            past_key_values = out.past_key_values
+        return out.logits[:, -1, :], past_key_values
+
 
 import torch
 from torch import optim, nn
@@ -495,3 +926,18 @@ def save_lora(model, path):
             lora_state = {f'{name}.lora.{k}': v for k, v in module.lora.state_dict().items()}
             state_dict.update(lora_state)
     torch.save(state_dict, path)
+
+
+class SamplerLogitsProcessor(LogitsProcessor):
+    """
+    把model.Sampler.Sampler接入GenerationMixin.generate，支持逐行采样参数和重复惩罚
+    用法:
+        processor = SamplerLogitsProcessor(Sampler(temperature=[0.7, 1.0], top_p=[0.9, 0.95]))
+        model.generate(input_ids, do_sample=True, top_k=0, logits_processor=LogitsProcessorList([processor]))
+    注意generate自带的top_k默认值为50，需要显式传入top_k=0避免重复过滤
+    """
+    def __init__(self, sampler: Sampler):
+        self.sampler = sampler
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.sampler.process(scores, input_ids)
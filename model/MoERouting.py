@@ -0,0 +1,173 @@
+import math
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+'''
+MoE的门控和按专家分组的计算，MiniMind(MOEFeedForward/StackedMOEFeedForward)和MyMoE共用
+
+config需要有 hidden_size、num_experts_per_tok、n_routed_experts、scoring_func、aux_loss_alpha、seq_aux、norm_topk_prob、
+capacity_factor、eval_capacity_factor、overflow_policy（MiniMindConfig和MyLlama的LLMConfig都有）
+'''
+
+
+class MoEGate(nn.Module):
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+        self.top_k = config.num_experts_per_tok
+        self.n_routed_experts = config.n_routed_experts
+
+        self.scoring_func = config.scoring_func
+        self.alpha = config.aux_loss_alpha
+        self.seq_aux = config.seq_aux
+
+        self.norm_topk_prob = config.norm_topk_prob
+        self.capacity_factor = config.capacity_factor
+        self.eval_capacity_factor = config.eval_capacity_factor
+        self.overflow_policy = config.overflow_policy
+        assert self.overflow_policy in ('drop', 'reroute'), f"不支持的溢出策略: {self.overflow_policy}"
+        # 为True时记录最近一次前向的路由统计（见_routing_stats），由MiniMindModel.forward按output_router_stats设置
+        self.collect_stats = False
+        self.routing_stats = None
+        self.gating_dim = config.hidden_size
+        self.weight = nn.Parameter(torch.empty((self.n_routed_experts, self.gating_dim)))
+        self.reset_parameters()
+
+    def reset_parameters(self) -> None:
+        import torch.nn.init as init
+        init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+
+    def forward(self, hidden_states):
+        bsz, seq_len, h = hidden_states.shape
+        hidden_states = hidden_states.view(-1, h)
+        logits = F.linear(hidden_states, self.weight, None)
+        if self.scoring_func == 'softmax':
+            scores = logits.softmax(dim=-1)
+        else:
+            raise NotImplementedError(f'insupportable scoring function for MoE gating: {self.scoring_func}')
+
+        capacity_factor = self.capacity_factor if self.training else self.eval_capacity_factor
+        # 限制容量时按排名决定优先级，需要有序的top-k
+        topk_weight, topk_idx = torch.topk(scores, k=self.top_k, dim=-1, sorted=capacity_factor > 0)
+        # 负载均衡损失按路由器的原始选择计算
+        router_idx = topk_idx
+        num_rerouted = None
+        if capacity_factor > 0:
+            topk_idx, topk_weight, num_rerouted = self._apply_capacity(scores, topk_idx, topk_weight, capacity_factor)
+
+        if self.top_k > 1 and self.norm_topk_prob:
+            denominator = topk_weight.sum(dim=-1, keepdim=True) + 1e-20
+            topk_weight = topk_weight / denominator
+        self.routing_stats = self._routing_stats(scores, topk_idx, num_rerouted) if self.collect_stats else None
+
+        if self.training and self.alpha > 0.0:
+            scores_for_aux = scores
+            aux_topk = self.top_k
+            topk_idx_for_aux_loss = router_idx.view(bsz, -1)
+            if self.seq_aux:
+                scores_for_seq_aux = scores_for_aux.view(bsz, seq_len, -1)
+                ce = torch.zeros(bsz, self.n_routed_experts, device=hidden_states.device)
+                ce.scatter_add_(1, topk_idx_for_aux_loss,
+                                torch.ones(bsz, seq_len * aux_topk, device=hidden_states.device)).div_(
+                    seq_len * aux_topk / self.n_routed_experts)
+                aux_loss = (ce * scores_for_seq_aux.mean(dim=1)).sum(dim=1).mean() * self.alpha
+            else:
+                mask_ce = F.one_hot(topk_idx_for_aux_loss.view(-1), num_classes=self.n_routed_experts)
+                ce = mask_ce.float().mean(0)
+                Pi = scores_for_aux.mean(0)
+                fi = ce * self.n_routed_experts
+                aux_loss = (Pi * fi).sum() * self.alpha
+        else:
+            aux_loss = 0
+        return topk_idx, topk_weight, aux_loss
+
+    def _positions(self, flat_idx, offset):
+        """flat_idx中每个分配在所属专家队列中的序号（按出现顺序），加上该专家已有的负载offset"""
+        n_experts = self.n_routed_experts
+        order = flat_idx.argsort(stable=True)
+        counts = torch.bincount(flat_idx, minlength=n_experts + 1)
+        starts = counts.cumsum(0) - counts
+        sorted_positions = torch.arange(flat_idx.numel(), device=flat_idx.device) - starts[flat_idx[order]]
+        positions = torch.empty_like(sorted_positions).scatter_(0, order, sorted_positions)
+        return positions + F.pad(offset, (0, 1))[flat_idx]
+
+    def _apply_capacity(self, scores, topk_idx, topk_weight, capacity_factor):
+        """
+        限制每个专家的分配数，被丢弃的分配的专家编号记为n_routed_experts、权重为0，分组计算时直接跳过
+        所有token的第1选择优先于第2选择，同一排名内按token顺序
+        """
+        num_tokens, n_experts, top_k = scores.shape[0], self.n_routed_experts, self.top_k
+        capacity = math.ceil(capacity_factor * num_tokens * top_k / n_experts)
+        # [top_k, num_tokens] 展平，先排所有token的第1选择
+        flat_idx = topk_idx.t().reshape(-1)
+        flat_weight = topk_weight.t().reshape(-1)
+        keep = self._positions(flat_idx, scores.new_zeros(n_experts, dtype=torch.long)) < capacity
+        num_rerouted = None
+        if self.overflow_policy == 'reroute' and n_experts > top_k:
+            load = torch.bincount(flat_idx, weights=keep.float(), minlength=n_experts).long()
+            # 第j个选择溢出时改选排名第 top_k + j 的专家，各个选择的候选互不相同
+            ranked = torch.topk(scores, k=min(2 * top_k, n_experts), dim=-1).indices[:, top_k:]
+            candidates = F.pad(ranked, (0, top_k - ranked.shape[1]), value=n_experts).t().reshape(-1)
+            candidates = torch.where(keep, torch.full_like(candidates, n_experts), candidates)
+            accept = (candidates < n_experts) & (self._positions(candidates, load) < capacity)
+            token_ids = torch.arange(num_tokens, device=scores.device).repeat(top_k)
+            candidate_weight = scores[token_ids, candidates.clamp(max=n_experts - 1)]
+            flat_idx = torch.where(accept, candidates, flat_idx)
+            flat_weight = torch.where(accept, candidate_weight, flat_weight)
+            keep = keep | accept
+            num_rerouted = accept.sum()
+        flat_idx = torch.where(keep, flat_idx, torch.full_like(flat_idx, n_experts))
+        flat_weight = torch.where(keep, flat_weight, torch.zeros_like(flat_weight))
+        return (flat_idx.view(top_k, num_tokens).t().contiguous(), flat_weight.view(top_k, num_tokens).t().contiguous(),
+                num_rerouted)
+
+    @torch.no_grad()
+    def _routing_stats(self, scores, topk_idx, num_rerouted):
+        """
+        路由统计（都是设备上的张量，不触发同步）:
+            tokens_per_expert: 每个专家实际处理的分配数
+            drop_rate: 超出容量被丢弃的分配比例
+            reroute_rate: 改由其他专家处理的分配比例
+            entropy: 路由概率分布的平均熵，越小路由越确定
+        """
+        n_experts = self.n_routed_experts
+        num_assignments = topk_idx.numel()
+        tokens_per_expert = torch.bincount(topk_idx.reshape(-1), minlength=n_experts + 1)
+        entropy = -(scores * torch.log(scores.clamp(min=1e-20))).sum(dim=-1).mean()
+        return {
+            "tokens_per_expert": tokens_per_expert[:n_experts],
+            "drop_rate": tokens_per_expert[n_experts].float() / max(num_assignments, 1),
+            "reroute_rate": (num_rerouted.float() if num_rerouted is not None else scores.new_zeros(()))
+                            / max(num_assignments, 1),
+            "entropy": entropy,
+        }
+
+
+def moe_dispatch(x, topk_idx, topk_weight, experts):
+    """
+    按专家分组计算MoE，训练和推理共用
+
+    把 token-专家 的分配按专家编号排序一次，同一个专家的token在排序后是连续的一段，
+    每个专家只处理自己那一段，再按权重加权后用index_add累加回各自的token。
+    没有分到token的专家也会以空输入调用，保证所有参数都参与计算图（DDP要求）。
+
+    参数:
+        x: [num_tokens, hidden_size]
+        topk_idx / topk_weight: [num_tokens, top_k]，专家编号为len(experts)表示该分配超出容量被丢弃
+        experts: 专家列表
+    返回:
+        [num_tokens, hidden_size]
+    """
+    top_k = topk_idx.shape[-1]
+    flat_idx = topk_idx.reshape(-1)
+    order = flat_idx.argsort(stable=True)
+    # 每层只同步一次，得到每个专家的token数；被丢弃的分配排在最后
+    counts = torch.bincount(flat_idx, minlength=len(experts) + 1).tolist()
+    order = order[:sum(counts[:len(experts)])]
+    token_idx = order // top_k
+    expert_out = torch.cat([expert(chunk) for expert, chunk in zip(experts, x[token_idx].split(counts[:len(experts)]))])
+    expert_out = expert_out * topk_weight.reshape(-1, 1)[order]
+    y = expert_out.new_zeros(x.shape).index_add(0, token_idx, expert_out)
+    return y.to(x.dtype)
@@ -32,6 +32,15 @@ class LLMConfig:
             aux_loss_alpha: float = 0.1,
             seq_aux: bool = True,
             norm_topk_prob: bool = True,
+            capacity_factor: float = 0.0,
+            eval_capacity_factor: float = 0.0,
+            overflow_policy: str = 'drop',
+            ####################################################
+            # 训练相关
+            ####################################################
+            loss_chunk_size: int = 0,
+            activation_checkpointing: int = 0,
+            activation_checkpointing_mode: str = 'full',
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -60,12 +69,31 @@ class LLMConfig:
         self.aux_loss_alpha = aux_loss_alpha  # 辅助损失的alpha参数
         self.seq_aux = seq_aux  # 是否在序列级别上计算辅助损失
         self.norm_topk_prob = norm_topk_prob  # 是否标准化top-k概率
+        # 专家容量，含义同MiniMindConfig：<=0不限制，overflow_policy为'drop'或'reroute'
+        self.capacity_factor = capacity_factor
+        self.eval_capacity_factor = eval_capacity_factor
+        self.overflow_policy = overflow_policy
+        ####################################################
+        # 训练相关
+        ####################################################
+        self.loss_chunk_size = loss_chunk_size  # >0时按该token数分块计算lm_head和交叉熵，不保存完整的logits
+        # 激活重计算：>0时每activation_checkpointing层中的第一层在反向时重新计算前向
+        # 'full'重算整个DecoderLayer，只保存层的输入；'selective'只重算注意力分数和MLP的中间结果，不重算线性层
+        self.activation_checkpointing = activation_checkpointing
+        self.activation_checkpointing_mode = activation_checkpointing_mode
+
+    @property
+    def num_experts_per_tok(self) -> int:
+        # 与MiniMindConfig同名，供model.MoERouting.MoEGate使用
+        return self.top_k
 
 import math
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from typing import Optional, Tuple, List, Union
+from model.Sampler import Sampler
 
 class RMSNorm(torch.nn.Module):
     def __init__(self, dim: int, eps: float = 1e-5):
@@ -100,6 +128,11 @@ def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     
     # 断言，确保1在x的维度范围内
     assert 0 <= 1 < ndim
+
+    # 每个样本位置不同时freqs_cis为 [batch_size, seq_len, dim]，只在头的维度上广播
+    if freqs_cis.ndim == 3:
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis.view(x.shape[0], x.shape[1], 1, x.shape[-1])
     
     # 断言，确保freqs_cis的形状与x的第二维和最后一维相同
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
@@ -151,10 +184,191 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
         .expand(bs, slen, n_kv_heads, n_rep, head_dim)  # 将新添加的维度扩展到n_rep大小，实现重复的效果
         .reshape(bs, slen, n_kv_heads * n_rep, head_dim)  # 重新塑形，合并键/值对头的数量和重复次数的维度
     )
+def _cross_entropy_sum(hidden_states: torch.Tensor, weight: torch.Tensor, labels: torch.Tensor, ignore_index: int):
+    logits = F.linear(hidden_states, weight).float()
+    return F.cross_entropy(logits, labels, ignore_index=ignore_index, reduction='sum')
+
+def chunked_cross_entropy(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    labels: torch.Tensor,
+    chunk_size: int = 1024,
+    ignore_index: int = -100
+) -> torch.Tensor:
+    """
+    分块计算 lm_head + 交叉熵，结果等价于对完整logits求平均交叉熵。
+
+    hidden_states: [num_tokens, hidden_size]，weight: lm_head的权重 [vocab_size, hidden_size]，labels: [num_tokens]
+    每块在前向时算完loss就释放logits，反向时通过checkpoint重新计算这一块的logits，
+    因此激活内存只有一块的 [chunk_size, vocab_size]，不再随 token数 × 词表大小 增长。
+    """
+    total_loss = hidden_states.new_zeros((), dtype=torch.float32)
+    for start in range(0, hidden_states.shape[0], chunk_size):
+        total_loss = total_loss + checkpoint(
+            _cross_entropy_sum,
+            hidden_states[start:start + chunk_size], weight, labels[start:start + chunk_size], ignore_index,
+            use_reentrant=False
+        )
+    return total_loss / (labels != ignore_index).sum().clamp(min=1)
+
+def build_attention_mask(
+    seq_len: int,
+    kv_len: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    device: Optional[torch.device] = None,
+    position_ids: Optional[torch.Tensor] = None,
+    segment_ids: Optional[torch.Tensor] = None
+) -> Optional[torch.Tensor]:
+    """
+    构造bool类型的注意力掩码，True表示可见。
+
+    当前的seq_len个query对应kv序列中最后seq_len个位置，因此第i个query可以看到前 kv_len - seq_len + i + 1 个位置。
+    position_ids为 [batch_size, seq_len] 时每一行使用自己的位置（kv缓冲区的下标即位置），query只能看到不超过自身位置的key。
+    segment_ids为 [batch_size, seq_len] 的文档编号（序列打包训练），query只能看到同一文档内的key，得到块对角的因果掩码。
+    attention_mask为 [batch_size, >=kv_len] 的padding掩码，只取前kv_len列。
+    不需要掩码（纯因果且无padding、没有历史kv）时返回None，调用方可以直接使用is_causal=True。
+    """
+    if position_ids is not None:
+        q_pos = position_ids[:, None, :, None]
+        k_pos = torch.arange(kv_len, device=device)
+        mask = k_pos <= q_pos
+    else:
+        past_len = kv_len - seq_len
+        if attention_mask is None and segment_ids is None and past_len == 0:
+            return None
+        q_pos = torch.arange(past_len, kv_len, device=device)[:, None]
+        k_pos = torch.arange(kv_len, device=device)[None, :]
+        mask = (k_pos <= q_pos)[None, None]
+    if attention_mask is not None:
+        # 每个query至少能看到自己，避免全padding的行在softmax后产生NaN
+        key_mask = attention_mask[:, None, None, :kv_len].bool() | (k_pos == q_pos)
+        mask = mask & key_mask
+    if segment_ids is not None:
+        assert kv_len == seq_len, "segment_ids只用于没有KV Cache的训练"
+        mask = mask & (segment_ids[:, None, :, None] == segment_ids[:, None, None, :])
+    return mask
+
+class StaticKVCache:
+    """
+    预分配的静态KV Cache
+
+    每层一次性分配 [batch_size, max_len, n_kv_heads, head_dim] 的K/V缓冲区，
+    每次前向把新位置原地写入缓冲区，返回有效前缀的视图，
+    避免torch.cat在每个解码步重新分配并拷贝整段历史。
+    """
+    def __init__(self,
+                 config: LLMConfig,
+                 batch_size: int,
+                 max_len: int,
+                 device: Optional[torch.device] = None,
+                 dtype: torch.dtype = torch.float32):
+        n_kv_heads = config.num_heads if config.num_key_value_heads is None else config.num_key_value_heads
+        head_dim = config.hidden_size // config.num_heads
+        shape = (batch_size, max_len, n_kv_heads, head_dim)
+        self.max_len = max_len
+        self.key_cache = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)]
+        self.value_cache = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)]
+        # 已写入的位置数，也是下一次写入的起始位置
+        self.seq_len = 0
+        # 参与计算的行数，compact之后只使用前num_rows行
+        self.num_rows = batch_size
+
+    @property
+    def batch_size(self) -> int:
+        return self.key_cache[0].shape[0]
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        start, end = self.seq_len, self.seq_len + xk.shape[1]
+        assert end <= self.max_len, f"StaticKVCache容量不足: 需要{end}, 最大{self.max_len}"
+        key_cache = self.key_cache[layer_id][:self.num_rows]
+        value_cache = self.value_cache[layer_id][:self.num_rows]
+        key_cache[:, start:end] = xk
+        value_cache[:, start:end] = xv
+        return key_cache[:, :end], value_cache[:, :end]
+
+    def advance(self, n: int):
+        # 所有层都写完之后由Transformer.forward调用
+        self.seq_len += n
+
+    def compact(self, rows: torch.Tensor):
+        # 只保留rows对应的行并原地移到缓冲区前部，已结束的序列不再参与计算
+        for key_cache, value_cache in zip(self.key_cache, self.value_cache):
+            key_cache[:len(rows), :self.seq_len] = key_cache[rows, :self.seq_len]
+            value_cache[:len(rows), :self.seq_len] = value_cache[rows, :self.seq_len]
+        self.num_rows = len(rows)
+
+    def reset(self):
+        # 缓冲区不需要清零，seq_len之后的位置在注意力中不可见
+        self.seq_len = 0
+        self.num_rows = self.batch_size
+
+class SlotKVCache(StaticKVCache):
+    """
+    按slot管理的静态KV Cache，用于连续批处理
+
+    每一行(slot)是一个独立的序列，各自记录已写入的长度，新token写在各自的位置上。
+    前向之前通过select选择参与计算的连续行区间 [start, stop)，Transformer.forward会调用prepare得到逐行的位置。
+    """
+    def __init__(self,
+                 config: LLMConfig,
+                 num_slots: int,
+                 max_len: int,
+                 device: Optional[torch.device] = None,
+                 dtype: torch.dtype = torch.float32):
+        super().__init__(config, num_slots, max_len, device=device, dtype=dtype)
+        self.seq_lens = torch.zeros(num_slots, dtype=torch.long, device=device)
+        # 长度在host上的副本，计算kv_len时不需要设备同步
+        self.host_seq_lens = [0] * num_slots
+        self.rows = slice(0, num_slots)
+        self.position_ids = None
+        self.kv_len = 0
+
+    def select(self, start: int, stop: int):
+        self.rows = slice(start, stop)
+
+    def prepare(self, seq_length: int) -> Tuple[torch.Tensor, int]:
+        self.position_ids = self.seq_lens[self.rows, None] + torch.arange(seq_length, device=self.seq_lens.device)
+        self.kv_len = max(self.host_seq_lens[self.rows]) + seq_length
+        assert self.kv_len <= self.max_len, f"SlotKVCache容量不足: 需要{self.kv_len}, 最大{self.max_len}"
+        return self.position_ids, self.kv_len
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        key_cache = self.key_cache[layer_id][self.rows]
+        value_cache = self.value_cache[layer_id][self.rows]
+        row_idx = torch.arange(key_cache.shape[0], device=key_cache.device)[:, None]
+        key_cache[row_idx, self.position_ids] = xk.to(key_cache.dtype)
+        value_cache[row_idx, self.position_ids] = xv.to(value_cache.dtype)
+        return key_cache[:, :self.kv_len], value_cache[:, :self.kv_len]
+
+    def advance(self, n: int):
+        self.seq_lens[self.rows] += n
+        for i in range(*self.rows.indices(len(self.host_seq_lens))):
+            self.host_seq_lens[i] += n
+
+    def reset(self):
+        super().reset()
+        self.seq_lens.zero_()
+        self.host_seq_lens = [0] * len(self.host_seq_lens)
+
+    def reset_slot(self, slot: int):
+        self.seq_lens[slot] = 0
+        self.host_seq_lens[slot] = 0
+
+    def move(self, src: int, dst: int):
+        # 把src行的有效前缀拷贝到dst行，用于释放slot后保持活跃序列连续
+        length = self.host_seq_lens[src]
+        for key_cache, value_cache in zip(self.key_cache, self.value_cache):
+            key_cache[dst, :length] = key_cache[src, :length]
+            value_cache[dst, :length] = value_cache[src, :length]
+        self.seq_lens[dst] = length
+        self.host_seq_lens[dst] = length
+        self.reset_slot(src)
+
 # GQA
 class Attention(nn.Module):
-    def __init__(self, args: LLMConfig):
+    def __init__(self, args: LLMConfig, layer_id: int = 0):
         super().__init__()
+        self.layer_id = layer_id
         self.num_key_value_heads = args.num_heads if args.num_key_value_heads is None else args.num_key_value_heads
         assert args.num_heads % self.num_key_value_heads == 0
         # 模型并行处理大小，默认为1。
@@ -175,21 +389,18 @@ class Attention(nn.Module):
         self.attn_dropout = nn.Dropout(args.dropout)
         self.resid_dropout = nn.Dropout(args.dropout)
         self.dropout = args.dropout
+        # selective激活重计算时由DecoderLayer设置
+        self.recompute = False
         # 检查是否使用Flash Attention（需要PyTorch >= 2.0）。
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
         if not self.flash:
             # 若不支持Flash Attention，则使用手动实现的注意力机制，并设置mask。
             print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
-            # 创建一个上三角矩阵，用于遮蔽未来信息。
-            mask = torch.full((1, 1, args.max_seq_len, args.max_seq_len), float("-inf"))
-            mask = torch.triu(mask, diagonal=1)
-            # 注册为模型的缓冲区
-            self.register_buffer("mask", mask)
 
     def forward(self,
                 x: torch.Tensor,
                 position_embeddings: Tuple[torch.Tensor, torch.Tensor],
-                past_key_value: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+                past_key_value: Optional[Union[Tuple[torch.Tensor, torch.Tensor], StaticKVCache]] = None,
                 use_cache=False,
                 attention_mask: Optional[torch.Tensor] = None):
         bsz, seq_len, _ = x.shape
@@ -203,11 +414,35 @@ class Attention(nn.Module):
         xq, xk = apply_rotary_emb(xq, xk, cos, sin)
 
         # kv_cache实现
-        if past_key_value is not None:
-            xk = torch.cat([past_key_value[0], xk], dim=1)
-            xv = torch.cat([past_key_value[1], xv], dim=1)
-        past_kv = (xk, xv) if use_cache else None
+        if isinstance(past_key_value, StaticKVCache):
+            # 静态缓存原地写入，返回的是缓冲区有效前缀的视图
+            xk, xv = past_key_value.update(self.layer_id, xk, xv)
+            past_kv = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                xk = torch.cat([past_key_value[0], xk], dim=1)
+                xv = torch.cat([past_key_value[1], xv], dim=1)
+            past_kv = (xk, xv) if use_cache else None
+        kv_len = xk.shape[1]
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # Transformer.forward已经为所有层构造好了掩码
+            attn_mask = attention_mask
+        else:
+            attn_mask = build_attention_mask(seq_len, kv_len, attention_mask, device=x.device)
+
+        if self.recompute and self.training and torch.is_grad_enabled():
+            # 不保存注意力分数，反向时由q/k/v重新计算
+            output = checkpoint(self._attention, xq, xk, xv, attn_mask, use_reentrant=False)
+        else:
+            output = self._attention(xq, xk, xv, attn_mask)
+        # 最终投影回残差流。
+        output = self.o_proj(output)
+        output = self.resid_dropout(output)
+        return output, past_kv
 
+    def _attention(self, xq, xk, xv, attn_mask):
+        bsz, seq_len = xq.shape[:2]
+        kv_len = xk.shape[1]
         # 对键和值进行扩展以适应重复次数。
         xk = repeat_kv(xk, self.n_rep)
         xv = repeat_kv(xv, self.n_rep)
@@ -219,31 +454,19 @@ class Attention(nn.Module):
 
         if self.flash:
             dropout_p = self.dropout if self.training else 0.0
-            attn_mask = None
-            if attention_mask is not None:
-                attn_mask = attention_mask.view(bsz, 1, 1, -1).expand(bsz, self.n_local_heads, seq_len, -1)
-                attn_mask = attn_mask.bool() if attention_mask is not None else None
-
-            output = F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=True)
+            output = F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attn_mask, dropout_p=dropout_p,
+                                                    is_causal=attn_mask is None)
         else:
             scores = torch.matmul(xq, xk.transpose(2, 3)) / math.sqrt(self.head_dim)
-            assert hasattr(self, 'mask')
-            scores = scores + self.mask[:, :, :seq_len, :seq_len]
-
-            if attention_mask is not None:
-                extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-                extended_attention_mask = (1.0 - extended_attention_mask) * -1e9
-                scores = scores + extended_attention_mask
+            if attn_mask is None:
+                attn_mask = torch.ones(seq_len, kv_len, dtype=torch.bool, device=xq.device).tril()[None, None]
+            scores = scores.masked_fill(~attn_mask, float("-inf"))
 
             scores = F.softmax(scores.float(), dim=-1).type_as(xq)
             scores = self.attn_dropout(scores)
             output = torch.matmul(scores, xv)
 
-        output = output.transpose(1, 2).contiguous().view(bsz, seq_len, -1)
-        # 最终投影回残差流。
-        output = self.o_proj(output)
-        output = self.resid_dropout(output)
-        return output, past_kv
+        return output.transpose(1, 2).contiguous().view(bsz, seq_len, -1)
     
 class FeedForward(nn.Module):
     def __init__(self, config: LLMConfig):
@@ -256,22 +479,42 @@ class FeedForward(nn.Module):
         self.up_proj = nn.Linear(config.hidden_size, config.intermediate_size, bias=False)
         self.dropout = nn.Dropout(config.dropout)
         self.act_fn = F.silu
+        # selective激活重计算时由DecoderLayer设置
+        self.recompute = False
+
+    def _gated(self, gate, up):
+        return self.act_fn(gate) * up
 
     def forward(self, x):
-        return self.dropout(self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x)))
+        gate, up = self.gate_proj(x), self.up_proj(x)
+        if self.recompute and self.training and torch.is_grad_enabled():
+            # 只保存gate和up，激活函数的输出和乘积在反向时重算
+            hidden = checkpoint(self._gated, gate, up, use_reentrant=False)
+        else:
+            hidden = self._gated(gate, up)
+        return self.dropout(self.down_proj(hidden))
 
 class DecoderLayer(nn.Module):
-    def __init__(self, layer_id: int, config: LLMConfig):
+    def __init__(self, layer_id: int, config: LLMConfig, mlp: Optional[nn.Module] = None):
         super().__init__()
         self.num_heads = config.num_heads
         self.hidden_size = config.hidden_size
         self.head_dim = config.hidden_size // config.num_heads
-        self.self_attn = Attention(config)
+        self.self_attn = Attention(config, layer_id)
 
         self.layer_id = layer_id
         self.attention_norm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.ffn_norm  = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
-        self.mlp = FeedForward(config)
+        # mlp为None时使用稠密的FeedForward，MoE模型传入自己的MLP
+        self.mlp = mlp if mlp is not None else FeedForward(config)
+        # 每activation_checkpointing层中的第一层做激活重计算
+        every = config.activation_checkpointing
+        self.checkpoint_mode = config.activation_checkpointing_mode if every > 0 and layer_id % every == 0 else None
+        assert self.checkpoint_mode in (None, 'full', 'selective'), f"不支持的重计算模式: {self.checkpoint_mode}"
+        self.self_attn.recompute = self.checkpoint_mode == 'selective'
+        for module in self.mlp.modules():
+            if isinstance(module, FeedForward):
+                module.recompute = self.checkpoint_mode == 'selective'
 
     def forward(self, hidden_states, position_embeddings, past_key_value=None, use_cache=False, attention_mask=None):
         residual = hidden_states
@@ -285,11 +528,13 @@ class DecoderLayer(nn.Module):
 
 
 class Transformer(nn.Module):
-    def __init__(self, config: LLMConfig):
+    def __init__(self, config: LLMConfig, mlp_factory=None):
+        """mlp_factory(config)返回每层的MLP，为None时使用FeedForward"""
         super().__init__()
         self.args = config
         self.embedding= nn.Embedding(config.vocab_size, config.hidden_size)
-        self.layers = nn.ModuleList([DecoderLayer(l, config) for l in range(config.num_hidden_layers)])
+        self.layers = nn.ModuleList([DecoderLayer(l, config, mlp_factory(config) if mlp_factory else None)
+                                     for l in range(config.num_hidden_layers)])
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
 
         self.dropout = nn.Dropout(config.dropout)
@@ -305,46 +550,128 @@ class Transformer(nn.Module):
                 input_ids: Optional[torch.Tensor] = None,
                 attention_mask: Optional[torch.Tensor] = None,
                 labels: Optional[torch.Tensor] = None,
-                # kv cache
-                past_key_values: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
-                use_cache: bool = False
+                # kv cache，可以是每层(k, v)的列表，也可以是StaticKVCache
+                past_key_values: Optional[Union[List[Tuple[torch.Tensor, torch.Tensor]], StaticKVCache]] = None,
+                use_cache: bool = False,
+                # int表示只计算最后logits_to_keep个位置的logits（0表示全部），张量表示要保留的位置下标
+                logits_to_keep: Union[int, torch.Tensor] = 0,
+                # 训练时不需要logits可以设为False：只对labels不为-100的位置计算lm_head和loss，不返回logits，
+                # 配置了loss_chunk_size时再分块计算，不保存完整的logits
+                return_logits: bool = True,
+                # 序列打包训练：每个token在所属文档内的位置，以及所属文档的编号
+                position_ids: Optional[torch.Tensor] = None,
+                segment_ids: Optional[torch.Tensor] = None
             ):
         batch_size, seq_length = input_ids.shape
 
-        if past_key_values is None:
+        static_cache = past_key_values if isinstance(past_key_values, StaticKVCache) else None
+        # 缓冲区下标即位置时，掩码也按逐行位置构造
+        mask_position_ids = None
+        if isinstance(static_cache, SlotKVCache):
+            # 每个slot的长度不同，位置逐行计算
+            position_ids, kv_len = static_cache.prepare(seq_length)
+            mask_position_ids = position_ids
+            past_key_values = [static_cache] * self.args.num_hidden_layers
+        elif static_cache is not None:
+            # 静态缓存的所有层共享同一个对象，由各层按layer_id写入自己的缓冲区
+            start_pos = static_cache.seq_len
+            past_key_values = [static_cache] * self.args.num_hidden_layers
+        elif past_key_values is None:
             past_key_values = [None] * self.args.num_hidden_layers
+            start_pos = 0
         else:
             # 如果有past_key_values，当前序列长度应为1（自回归生成）
             assert seq_length == 1, "当使用past_key_values时,输入序列长度应为1"
-        start_pos = past_key_values[0][0].shape[1] if past_key_values[0] is not None else 0
+            start_pos = past_key_values[0][0].shape[1]
+        if mask_position_ids is None:
+            kv_len = start_pos + seq_length
 
         hidden_states = self.embedding(input_ids)
         hidden_states = self.dropout(hidden_states)
-        position_embeddings = (
-            self.freqs_cos[start_pos:start_pos+seq_length],#在推理的时候只计算新的token
-            self.freqs_sin[start_pos:start_pos+seq_length]
-        )
+        if position_ids is not None:
+            position_embeddings = (self.freqs_cos[position_ids], self.freqs_sin[position_ids])
+        else:
+            position_embeddings = (
+                self.freqs_cos[start_pos:start_pos+seq_length],#在推理的时候只计算新的token
+                self.freqs_sin[start_pos:start_pos+seq_length]
+            )
+        # 所有层共享同一个掩码，只构造一次
+        attention_mask = build_attention_mask(seq_length, kv_len, attention_mask, device=input_ids.device,
+                                              position_ids=mask_position_ids, segment_ids=segment_ids)
         present_kv_cache = []
         for layer_id, layer in enumerate(self.layers):
             past_key_value = past_key_values[layer_id]
-            hidden_states, past_kv = layer(
-                hidden_states, 
-                position_embeddings, 
-                attention_mask=attention_mask,
-                past_key_value=past_key_value,
-                use_cache=use_cache
-            )
+            if layer.checkpoint_mode == 'full' and self.training and torch.is_grad_enabled() and not use_cache:
+                # 只保存层的输入，反向时重新计算整层的前向
+                hidden_states, past_kv = checkpoint(layer, hidden_states, position_embeddings, past_key_value,
+                                                    use_cache, attention_mask, use_reentrant=False)
+            else:
+                hidden_states, past_kv = layer(
+                    hidden_states, 
+                    position_embeddings, 
+                    attention_mask=attention_mask,
+                    past_key_value=past_key_value,
+                    use_cache=use_cache
+                )
             present_kv_cache.append(past_kv)
+        if static_cache is not None:
+            static_cache.advance(seq_length)
+            present_kv_cache = static_cache if use_cache else None
 
         hidden_states = self.norm(hidden_states)
-        logits = self.lm_head(hidden_states)
-        loss = self.criterion(logits.view(-1, logits.size(-1)), labels.view(-1)) if labels is not None else None
+        if labels is not None and not return_logits:
+            # 被忽略的位置不需要词表大小的logits，先挑出有效位置再过lm_head
+            valid = labels != self.criterion.ignore_index
+            logits = None
+            if self.args.loss_chunk_size > 0:
+                loss = chunked_cross_entropy(hidden_states[valid], self.lm_head.weight, labels[valid],
+                                             self.args.loss_chunk_size, self.criterion.ignore_index)
+            else:
+                # 求和再除以有效token数（至少为1），整行都是prompt时loss为0而不是对空集取平均得到NaN
+                loss = F.cross_entropy(self.lm_head(hidden_states[valid]), labels[valid], reduction="sum")
+                loss = loss / valid.sum().clamp(min=1)
+        else:
+            slice_indices = slice(-logits_to_keep, None) if isinstance(logits_to_keep, int) else logits_to_keep
+            logits = self.lm_head(hidden_states[:, slice_indices, :])
+            loss = self.criterion(logits.view(-1, logits.size(-1)), labels.view(-1)) if labels is not None else None
         return {
             "loss": loss,
             "logits": logits,
             "past_key_values": present_kv_cache
         }
 
+    @torch.inference_mode()
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: StaticKVCache,
+        attention_mask: Optional[torch.Tensor] = None,
+        chunk_size: int = 512
+    ) -> torch.Tensor:
+        """
+        分块prefill：把prompt按chunk_size切块，依次写入KV Cache，每块只和已缓存的历史做注意力，
+        注意力分数的峰值为 [bsz, heads, chunk_size, seq_len] 而不是 [bsz, heads, seq_len, seq_len]，
+        并且只计算最后一个位置的logits。
+
+        参数:
+            input_ids: prompt [batch_size, seq_len]，从past_key_values.seq_len的位置开始写入
+            past_key_values: StaticKVCache
+            attention_mask: 覆盖整个缓存长度的padding掩码 [batch_size, >=seq_len]
+            chunk_size: 每块的token数
+
+        返回:
+            最后一个位置的logits [batch_size, vocab_size]
+        """
+        for start in range(0, input_ids.shape[1], chunk_size):
+            logits = self(
+                input_ids=input_ids[:, start:start + chunk_size],
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                use_cache=True,
+                logits_to_keep=1
+            )["logits"]
+        return logits[:, -1, :]
+
     @torch.inference_mode()
     def generate(
         self,
@@ -355,91 +682,138 @@ class Transformer(nn.Module):
         do_sample: bool = True,
         top_k: Optional[int] = None,
         top_p: Optional[float] = None,
+        min_p: Optional[float] = None,
+        repetition_penalty: Optional[float] = None,
+        presence_penalty: Optional[float] = None,
+        frequency_penalty: Optional[float] = None,
         pad_token_id: Optional[int] = None,
         eos_token_id: Optional[int] = None,
+        past_key_values: Optional[StaticKVCache] = None,
+        prefix_cache=None,
+        return_lengths: bool = False,
+        prefill_chunk_size: Optional[int] = None,
         **kwargs
-    ) -> torch.Tensor:
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         """
         使用KV Cache的生成函数
         
         参数:
             input_ids: 起始输入序列 [batch_size, seq_len]
+            attention_mask: 输入序列的padding掩码 [batch_size, seq_len]
             max_length: 生成的最大长度
             temperature: 温度参数，控制随机性
             do_sample: 是否采样
             top_k: top-k采样参数
             top_p: top-p(核)采样参数
-            pad_token_id: 填充token ID
-            eos_token_id: 结束token ID
+            min_p: min-p采样参数
+            repetition_penalty / presence_penalty / frequency_penalty: 对已出现token的惩罚
+            以上采样参数都可以是标量或长度为batch_size的序列，见model.Sampler.Sampler
+            pad_token_id: 填充token ID，提前结束的行在EOS之后用它填充，默认与eos_token_id相同
+            eos_token_id: 结束token ID，每行生成EOS后立即退出batch，不再参与后续计算
+            past_key_values: 可复用的StaticKVCache，不提供时按 seq_len + max_length 新建
+            prefix_cache: 可选的model.PrefixCache.PrefixCache，命中的前缀直接从缓存加载K/V，只prefill剩余部分
+            return_lengths: 是否同时返回每行的有效长度（包含prompt和EOS）
+            prefill_chunk_size: 设置后prompt按该大小分块prefill，限制长prompt的峰值内存
             
         返回:
-            生成的序列 [batch_size, generated_seq_len]
+            生成的序列 [batch_size, generated_seq_len]，return_lengths为True时返回 (序列, 长度[batch_size])
         """
-        index = input_ids.shape[1]
-        # 初始化生成的序列和注意力掩码
-        generated = input_ids
-        past_key_values = None
+        batch_size, index = input_ids.shape
+        total_len = index + max_length
+        # 预分配KV Cache，生成过程中只做原地写入
+        if past_key_values is None:
+            past_key_values = StaticKVCache(self.args, batch_size, total_len,
+                                            device=input_ids.device, dtype=self.embedding.weight.dtype)
+        else:
+            assert past_key_values.batch_size == batch_size and past_key_values.max_len >= total_len
+            past_key_values.reset()
+        # 注意力掩码同样预分配到最终长度，新生成的位置总是可见
+        if attention_mask is not None:
+            full_attention_mask = attention_mask.new_ones(batch_size, total_len)
+            full_attention_mask[:, :index] = attention_mask
+            attention_mask = full_attention_mask
+        # 预分配输出缓冲区，记录每行的有效长度
+        if pad_token_id is None:
+            pad_token_id = eos_token_id if eos_token_id is not None else 0
+        output = input_ids.new_full((batch_size, total_len), pad_token_id)
+        output[:, :index] = input_ids
+        lengths = input_ids.new_full((batch_size,), index)
+        # active[i]表示压缩后的第i行对应原batch中的哪一行
+        active = torch.arange(batch_size, device=input_ids.device)
+        sampler = Sampler(temperature, top_k, top_p, min_p,
+                          repetition_penalty, presence_penalty, frequency_penalty, do_sample=do_sample)
+        use_penalty = any(p is not None for p in (repetition_penalty, presence_penalty, frequency_penalty))
+
+        # 从前缀缓存加载已缓存的K/V，batch内取各行命中长度的最小值；至少保留最后一个token用于计算logits
+        if prefix_cache is not None:
+            assert attention_mask is None, "前缀缓存不支持padding的输入"
+            prompts = input_ids.tolist()
+            matches = [prefix_cache.match(prompt[:-1]) for prompt in prompts]
+            num_cached = min(num_tokens for _, num_tokens in matches)
+            for row, (path, _) in enumerate(matches):
+                prefix_cache.load(path,
+                                  [k[row] for k in past_key_values.key_cache],
+                                  [v[row] for v in past_key_values.value_cache],
+                                  num_cached)
+                prefix_cache.record(index, num_cached)
+            past_key_values.seq_len = num_cached
+            input_ids = input_ids[:, num_cached:]
         
         # 如果没有提供eos_token_id，则一直生成直到max_length
         stopping_criteria = eos_token_id is not None
         
         # 生成循环
-        for _ in range(max_length):
-            # 准备当前输入（只使用最后一个token）
-            if past_key_values is not None:
-                # 如果有past_key_values，只需要最后一个token
-                input_ids = generated[:, -1].unsqueeze(-1)
-            
-            # 前向传播，使用past_key_values
-            outputs = self(
-                input_ids=input_ids,
-                past_key_values=past_key_values,
-                attention_mask = attention_mask,
-                use_cache=True,
-            )
-            
-            # 更新past_key_values
-            past_key_values = outputs["past_key_values"]
-            
-            # 获取下一个token的logits
-            next_token_logits = outputs["logits"][:, -1, :] / temperature
-            
-            # 应用top-k/top-p过滤
-            if top_k is not None:
-                # top-k过滤
-                indices_to_remove = next_token_logits < torch.topk(next_token_logits, top_k)[0][..., -1, None]
-                next_token_logits[indices_to_remove] = -float("Inf")
-            
-            if top_p is not None and top_p < 1.0:
-                # top-p（核）过滤
-                sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
-                cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
-                
-                # 移除累积概率高于top_p的token
-                sorted_indices_to_remove = cumulative_probs > top_p
-                # shift右移，保证第一个token总被保留
-                sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-                sorted_indices_to_remove[..., 0] = 0
-                
-                for idx in range(next_token_logits.shape[0]):
-                    indices_to_remove = sorted_indices[idx, sorted_indices_to_remove[idx]]
-                    next_token_logits[idx, indices_to_remove] = -float("Inf")
-            
-            # 采样下一个token
-            if do_sample:
-                probs = torch.softmax(next_token_logits, dim=-1)
-                next_tokens = torch.multinomial(probs, num_samples=1)
+        for step in range(max_length):
+            # 前向传播，prefill之后input_ids只包含每个未结束行的最后一个token，只需要最后一个位置的logits
+            if step == 0 and prefill_chunk_size is not None:
+                next_token_logits = self.prefill(input_ids, past_key_values, attention_mask, prefill_chunk_size)
             else:
-                next_tokens = torch.argmax(next_token_logits, dim=-1, keepdim=True)
+                next_token_logits = self(
+                    input_ids=input_ids,
+                    past_key_values=past_key_values,
+                    attention_mask = attention_mask,
+                    use_cache=True,
+                    logits_to_keep=1
+                )["logits"][:, -1, :]
+            
+            # prefill之后把prompt的K/V加入前缀缓存
+            if step == 0 and prefix_cache is not None:
+                for row, prompt in enumerate(prompts):
+                    prefix_cache.insert(prompt,
+                                        [k[row] for k in past_key_values.key_cache],
+                                        [v[row] for v in past_key_values.value_cache])
+
+            # 获取下一个token的logits并采样
+            cur_len = index + step
+            token_ids = None
+            if use_penalty:
+                # padding位置不计入惩罚
+                token_ids = output[active, :cur_len]
+                if attention_mask is not None:
+                    token_ids = token_ids.masked_fill(attention_mask[:, :cur_len] == 0, -1)
+            next_tokens = sampler(next_token_logits, token_ids)
             
-            # 将新token添加到生成的序列中
-            generated = torch.cat([generated, next_tokens], dim=-1)
+            # 未结束的行同步前进，新token写在同一列
+            output[active, cur_len] = next_tokens.view(-1)
+            lengths[active] += 1
+            input_ids = next_tokens
             
-            # 检查是否应该停止生成
-            if stopping_criteria and (next_tokens == eos_token_id).all():
-                break
+            # 生成EOS的行退出batch，压缩KV Cache、注意力掩码和采样参数
+            if stopping_criteria:
+                unfinished = next_tokens.view(-1) != eos_token_id
+                if not unfinished.all():
+                    if not unfinished.any():
+                        break
+                    keep = unfinished.nonzero().view(-1)
+                    active = active[keep]
+                    input_ids = input_ids[keep]
+                    past_key_values.compact(keep)
+                    if attention_mask is not None:
+                        attention_mask = attention_mask[keep]
+                    sampler = sampler.select_rows(keep)
         
-        return generated
+        output = output[:, :lengths.max()]
+        return (output, lengths) if return_lengths else output
 
 if __name__ == "__main__":
     config = LLMConfig()
@@ -0,0 +1,177 @@
+from typing import List
+
+import torch
+from torch import nn
+import torch.distributed as dist
+
+from model.MyLlama import LLMConfig, Transformer, FeedForward
+from model.MoERouting import MoEGate, moe_dispatch
+
+'''
+基于MyLlama的MoE模型
+
+MoETransformer沿用Transformer和DecoderLayer，use_moe=True时把每层的FeedForward换成MoEFeedForward：
+n_routed_experts个路由专家（每个token选top_k个）加上n_shared_experts个所有token共享的专家。
+
+专家并行(expert parallelism)：传入ep_group时，路由专家按rank均分，每个rank只保存
+n_routed_experts / world_size 个专家，门控和共享专家在各rank上是完整的副本。
+每层前向时按目标专家所在的rank用all-to-all交换token，专家计算完再用all-to-all送回，
+反向传播时梯度沿相反方向交换。NCCL上用all_to_all_single，gloo（CPU）上用点对点的isend/irecv。
+
+专家参数在各个rank上不同，不能用DDP包装整个模型（DDP会对所有参数做all-reduce）。
+直接训练未包装的模型，backward之后调用allreduce_dense_grads对其余参数的梯度取平均；
+专家参数的梯度已经包含了所有rank的token，反向时再除以world_size，与其余参数取平均的尺度一致。
+门控的容量限制(capacity_factor)和路由统计与MiniMind相同，见model.MoERouting。
+'''
+
+
+def all_to_all(x: torch.Tensor, output_splits: List[int], input_splits: List[int], group=None) -> torch.Tensor:
+    """把x沿第0维按input_splits切块，第i块发给rank i；返回从各rank收到的、按output_splits拼接的结果"""
+    group = group or dist.group.WORLD
+    output = x.new_empty((sum(output_splits),) + tuple(x.shape[1:]))
+    if dist.get_backend(group) != dist.Backend.GLOO:
+        dist.all_to_all_single(output, x, output_splits, input_splits, group=group)
+        return output
+    # gloo不支持不等长的all_to_all，改成成对的点对点通信；长度为0的块双方都跳过
+    rank = dist.get_rank(group)
+    inputs, outputs = x.split(input_splits), output.split(output_splits)
+    ops = []
+    for peer in range(dist.get_world_size(group)):
+        if peer == rank:
+            outputs[peer].copy_(inputs[peer])
+            continue
+        global_peer = dist.get_global_rank(group, peer)
+        if input_splits[peer] > 0:
+            ops.append(dist.P2POp(dist.isend, inputs[peer].contiguous(), global_peer, group))
+        if output_splits[peer] > 0:
+            ops.append(dist.P2POp(dist.irecv, outputs[peer], global_peer, group))
+    if ops:
+        for request in dist.batch_isend_irecv(ops):
+            request.wait()
+    return output
+
+
+class AllToAll(torch.autograd.Function):
+    """可求导的all_to_all，反向时交换输入输出的切分把梯度送回"""
+    @staticmethod
+    def forward(ctx, x, output_splits, input_splits, group):
+        ctx.output_splits, ctx.input_splits, ctx.group = output_splits, input_splits, group
+        return all_to_all(x.contiguous(), output_splits, input_splits, group)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return all_to_all(grad_output.contiguous(), ctx.input_splits, ctx.output_splits, ctx.group), None, None, None
+
+
+class MoEFeedForward(nn.Module):
+    def __init__(self, config: LLMConfig, ep_group=None):
+        super().__init__()
+        self.config = config
+        self.ep_group = ep_group
+        self.ep_size = dist.get_world_size(ep_group) if ep_group is not None else 1
+        assert config.n_routed_experts % self.ep_size == 0, "n_routed_experts必须能被专家并行的rank数整除"
+        self.num_local_experts = config.n_routed_experts // self.ep_size
+        # 本rank负责的第一个专家的全局编号
+        self.expert_offset = dist.get_rank(ep_group) * self.num_local_experts if ep_group is not None else 0
+        self.experts = nn.ModuleList([FeedForward(config) for _ in range(self.num_local_experts)])
+        self.gate = MoEGate(config)
+        self.shared_experts = nn.ModuleList([FeedForward(config) for _ in range(config.n_shared_experts)])
+        if self.ep_size > 1:
+            for param in self.experts.parameters():
+                param.expert_parallel = True
+                param.register_hook(lambda grad: grad / self.ep_size)
+
+    def forward(self, x):
+        identity = x
+        orig_shape = x.shape
+        topk_idx, topk_weight, aux_loss = self.gate(x)
+        x = x.view(-1, x.shape[-1])
+        if self.ep_size == 1:
+            y = moe_dispatch(x, topk_idx, topk_weight, self.experts)
+        else:
+            y = self._expert_parallel(x, topk_idx, topk_weight)
+        y = y.view(*orig_shape)
+        for expert in self.shared_experts:
+            y = y + expert(identity)
+        self.aux_loss = aux_loss
+        return y
+
+    def _expert_parallel(self, x, topk_idx, topk_weight):
+        n_experts = self.config.n_routed_experts
+        top_k = topk_idx.shape[-1]
+        flat_idx = topk_idx.reshape(-1)
+        # token-专家分配按全局专家编号排序一次，发往同一个rank、同一个专家的token连续；
+        # 超出容量被丢弃的分配（编号为n_routed_experts）排在最后，不发送
+        order = flat_idx.argsort(stable=True)
+        counts = torch.bincount(flat_idx, minlength=n_experts + 1)
+        send_counts = counts[:n_experts].view(self.ep_size, self.num_local_experts)
+        # 先交换每个专家的token数：recv_counts[i, e]为rank i发给本rank第e个专家的token数
+        recv_counts = all_to_all(send_counts, [1] * self.ep_size, [1] * self.ep_size, self.ep_group)
+        input_splits = send_counts.sum(dim=1).tolist()
+        output_splits = recv_counts.sum(dim=1).tolist()
+        order = order[:sum(input_splits)]
+        token_idx = order // top_k
+        recv_x = AllToAll.apply(x[token_idx], output_splits, input_splits, self.ep_group)
+        # 收到的token按来源rank分段，段内按本地专家排序；每个token只交给一个本地专家，权重在送回后再乘
+        local_expert = torch.arange(self.num_local_experts, device=recv_x.device).repeat(self.ep_size)
+        local_expert = local_expert.repeat_interleave(recv_counts.view(-1)).view(-1, 1)
+        out = moe_dispatch(recv_x, local_expert, recv_x.new_ones(local_expert.shape), self.experts)
+        out = AllToAll.apply(out, input_splits, output_splits, self.ep_group)
+        out = out * topk_weight.reshape(-1, 1)[order]
+        return out.new_zeros(x.shape).index_add(0, token_idx, out).to(x.dtype)
+
+
+class MoETransformer(Transformer):
+    """
+    MyLlama的MoE版本，use_moe=False时与Transformer相同
+    ep_group为专家并行的进程组（例如dist.group.WORLD），None表示每个rank保存全部专家
+    """
+    def __init__(self, config: LLMConfig, ep_group=None):
+        super().__init__(config, (lambda c: MoEFeedForward(c, ep_group)) if config.use_moe else None)
+
+    def forward(self, *args, **kwargs):
+        output = super().forward(*args, **kwargs)
+        aux_loss = sum(layer.mlp.aux_loss for layer in self.layers if isinstance(layer.mlp, MoEFeedForward))
+        if output["loss"] is not None:
+            output["loss"] = output["loss"] + aux_loss
+        output["aux_loss"] = aux_loss
+        return output
+
+    def expert_parameter_names(self) -> List[str]:
+        return [name for name, param in self.named_parameters() if getattr(param, "expert_parallel", False)]
+
+
+def allreduce_dense_grads(model: nn.Module, group=None):
+    """
+    在backward之后、optimizer.step之前调用，代替DDP对非专家参数的梯度取所有rank的平均
+
+    专家参数（expert_parallel=True）在各rank上不同，不参与；没有梯度的参数按0处理，保证各rank的通信一致。
+    同一dtype的梯度拼成一个张量只做一次all_reduce。
+    """
+    world_size = dist.get_world_size(group)
+    params = [p for p in model.parameters() if p.requires_grad and not getattr(p, "expert_parallel", False)]
+    for dtype in sorted({p.dtype for p in params}, key=str):
+        group_params = [p for p in params if p.dtype == dtype]
+        flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in group_params])
+        dist.all_reduce(flat, group=group)
+        flat.div_(world_size)
+        for p, grad in zip(group_params, flat.split([p.numel() for p in group_params])):
+            if p.grad is None:
+                p.grad = grad.view_as(p).clone()
+            else:
+                p.grad.copy_(grad.view_as(p))
+
+
+def load_expert_parallel_state_dict(model: MoETransformer, state_dict: dict):
+    """从全部专家的state_dict（例如单进程训练的checkpoint）中加载本rank负责的专家"""
+    state_dict = dict(state_dict)
+    for name, module in model.named_modules():
+        if isinstance(module, MoEFeedForward) and module.ep_size > 1:
+            prefix = f"{name}.experts."
+            for key in [k for k in state_dict if k.startswith(prefix)]:
+                expert_id, rest = key[len(prefix):].split(".", 1)
+                local_id = int(expert_id) - module.expert_offset
+                value = state_dict.pop(key)
+                if 0 <= local_id < module.num_local_experts:
+                    state_dict[f"{prefix}{local_id}.{rest}"] = value
+    return model.load_state_dict(state_dict)
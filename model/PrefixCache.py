@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+
+
+class PrefixCacheNode:
+    __slots__ = ("tokens", "parent", "children", "keys", "values", "nbytes")
+
+    def __init__(self, tokens: Tuple[int, ...] = (), parent: Optional["PrefixCacheNode"] = None,
+                 keys: Optional[List[torch.Tensor]] = None, values: Optional[List[torch.Tensor]] = None):
+        self.tokens = tokens
+        self.parent = parent
+        self.children = {}
+        # 每层一个 [len(tokens), n_kv_heads, head_dim] 的K/V块；不满block_size的块只作为叶子
+        self.keys = keys or []
+        self.values = values or []
+        self.nbytes = sum(t.nelement() * t.element_size() for t in self.keys + self.values)
+
+
+class PrefixCache:
+    """
+    前缀(prompt)缓存
+
+    以block_size个token为一个块组织成前缀树，子节点以块内token的元组为key（即按token哈希查找），
+    每个节点保存该块在所有层的K/V。prompt末尾不满一块的部分作为叶子节点保存，
+    因此比block_size短的ChatML系统提示词也能命中。
+    生成时先沿整块匹配，再在最后一层子节点中找与剩余token公共前缀最长的一个，使用它的前若干个位置
+    （因果注意力下K/V只依赖前缀），把匹配到的K/V拷贝进KV Cache，只需要prefill剩余的后缀；
+    prefill之后再把prompt插入树中。
+    总字节数超过max_bytes时按LRU淘汰叶子节点（内部节点被更长的前缀依赖，不能先于子节点淘汰）。
+
+    适用于所有请求共享的ChatML系统提示词以及多轮对话中重复发送的历史。
+    """
+    def __init__(self, block_size: int = 16, max_bytes: int = 256 * 1024 ** 2):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.root = PrefixCacheNode()
+        # 按访问顺序排列的节点，最早访问的在前
+        self.lru = OrderedDict()
+        self.total_bytes = 0
+        # 统计信息
+        self.num_queries = 0
+        self.num_hits = 0
+        self.query_tokens = 0
+        self.saved_tokens = 0
+
+    def _blocks(self, token_ids: List[int]):
+        """按block_size切分token_ids，最后不满一块的部分也作为一块"""
+        for start in range(0, len(token_ids), self.block_size):
+            yield tuple(token_ids[start:start + self.block_size])
+
+    def _touch(self, node: PrefixCacheNode):
+        self.lru[node] = None
+        self.lru.move_to_end(node)
+
+    def _remove(self, node: PrefixCacheNode):
+        del self.lru[node]
+        del node.parent.children[node.tokens]
+        self.total_bytes -= node.nbytes
+
+    @staticmethod
+    def _common_prefix(a: Tuple[int, ...], b: Tuple[int, ...]) -> int:
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def match(self, token_ids: List[int]) -> Tuple[List[PrefixCacheNode], int]:
+        """
+        返回 (节点路径, 命中的token数)
+        路径上除最后一个节点外都是完整使用的整块，最后一个节点可能只用到前面一部分
+        """
+        node, path, num_tokens = self.root, [], 0
+        for block in self._blocks(token_ids):
+            child = node.children.get(block) if len(block) == self.block_size else None
+            if child is None:
+                # 整块没有命中：在子节点（整块或不满一块的叶子）中找公共前缀最长的
+                best, best_len = None, 0
+                for key, candidate in node.children.items():
+                    common = self._common_prefix(key, block)
+                    if common > best_len:
+                        best, best_len = candidate, common
+                if best is not None:
+                    self._touch(best)
+                    path.append(best)
+                    num_tokens += best_len
+                break
+            self._touch(child)
+            path.append(child)
+            num_tokens += self.block_size
+            node = child
+        return path, num_tokens
+
+    def insert(self, token_ids: List[int], key_cache: List[torch.Tensor], value_cache: List[torch.Tensor]):
+        """
+        把token_ids插入前缀树，最后不满一块的部分作为叶子节点
+        key_cache/value_cache为每层 [>=len(token_ids), n_kv_heads, head_dim] 的K/V，第i个位置对应token_ids[i]
+        """
+        node = self.root
+        for i, block in enumerate(self._blocks(token_ids)):
+            child = node.children.get(block)
+            if child is None:
+                if len(block) < self.block_size and any(key[:len(block)] == block for key in node.children):
+                    # 已有更长的节点覆盖了这段前缀
+                    break
+                # 被新节点覆盖的、更短的不满一块的叶子不再需要
+                for key in [key for key in node.children if len(key) < len(block) and block[:len(key)] == key]:
+                    self._remove(node.children[key])
+                span = slice(i * self.block_size, i * self.block_size + len(block))
+                child = PrefixCacheNode(block, node,
+                                        keys=[k[span].clone() for k in key_cache],
+                                        values=[v[span].clone() for v in value_cache])
+                node.children[block] = child
+                self.total_bytes += child.nbytes
+            self._touch(child)
+            node = child
+        self.evict()
+
+    def load(self, path: List[PrefixCacheNode], key_cache: List[torch.Tensor], value_cache: List[torch.Tensor],
+             num_tokens: int):
+        """把匹配到的节点路径的前num_tokens个位置按顺序写入每层 [>=num_tokens, n_kv_heads, head_dim] 的缓冲区"""
+        for i, node in enumerate(path):
+            start = i * self.block_size
+            length = min(len(node.tokens), num_tokens - start)
+            if length <= 0:
+                break
+            for layer_id, (k, v) in enumerate(zip(node.keys, node.values)):
+                key_cache[layer_id][start:start + length] = k[:length]
+                value_cache[layer_id][start:start + length] = v[:length]
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            leaf = next((node for node in self.lru if not node.children), None)
+            if leaf is None:
+                break
+            self._remove(leaf)
+
+    def record(self, num_tokens: int, num_cached: int):
+        self.num_queries += 1
+        self.num_hits += int(num_cached > 0)
+        self.query_tokens += num_tokens
+        self.saved_tokens += num_cached
+
+    def stats(self) -> dict:
+        return {
+            "num_nodes": len(self.lru),
+            "total_bytes": self.total_bytes,
+            "num_queries": self.num_queries,
+            "hit_rate": self.num_hits / self.num_queries if self.num_queries else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "token_hit_rate": self.saved_tokens / self.query_tokens if self.query_tokens else 0.0,
+        }
+
+    def clear(self):
+        self.root = PrefixCacheNode()
+        self.lru.clear()
+        self.total_bytes = 0
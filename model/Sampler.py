@@ -0,0 +1,140 @@
+from typing import Optional, Sequence, Union
+
+import torch
+
+# 每个采样参数可以是一个标量（整个batch共用），也可以是长度为batch_size的序列/张量（逐行设置）
+RowParam = Optional[Union[float, int, Sequence[float], torch.Tensor]]
+
+
+def _is_enabled(value: RowParam, disabled_value) -> bool:
+    if value is None:
+        return False
+    if isinstance(value, (int, float)):
+        return value != disabled_value
+    return True
+
+
+def _row_param(value: RowParam, batch_size: int, device: torch.device, dtype=torch.float32) -> torch.Tensor:
+    # 转成 [batch_size, 1]，便于与 [batch_size, vocab_size] 的logits广播
+    if isinstance(value, torch.Tensor):
+        value = value.to(device=device, dtype=dtype)
+    else:
+        value = torch.tensor(value, device=device, dtype=dtype)
+    if value.numel() == 1:
+        return value.view(1, 1).expand(batch_size, 1)
+    return value.view(batch_size, 1)
+
+
+class Sampler:
+    """
+    批量采样器
+
+    对 [batch_size, vocab_size] 的logits依次应用:
+        repetition/presence/frequency惩罚 -> temperature -> top-k -> top-p -> min-p
+    所有参数都支持逐行设置，整个过程只用sort/scatter等批量算子，不在batch维度上做Python循环。
+    temperature <= 0 的行使用贪心解码。
+
+    参数:
+        temperature: 温度，<=0表示贪心
+        top_k: 只保留概率最高的k个token，<=0表示不限制
+        top_p: 核采样阈值，1.0表示不限制
+        min_p: 丢弃概率小于 min_p * 最大概率 的token，0表示不限制
+        repetition_penalty: 对已出现token的logits，正数除以、负数乘以该系数，1.0表示不惩罚
+        presence_penalty: 已出现的token减去该值
+        frequency_penalty: 每个token减去 出现次数 * 该值
+        do_sample: False时对所有行取argmax
+    """
+    def __init__(self,
+                 temperature: RowParam = 1.0,
+                 top_k: RowParam = None,
+                 top_p: RowParam = None,
+                 min_p: RowParam = None,
+                 repetition_penalty: RowParam = None,
+                 presence_penalty: RowParam = None,
+                 frequency_penalty: RowParam = None,
+                 do_sample: bool = True):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        self.do_sample = do_sample
+
+    def select_rows(self, rows: torch.Tensor) -> "Sampler":
+        """只保留rows对应行的参数，用于生成过程中压缩batch"""
+        def select(value):
+            if value is None or isinstance(value, (int, float)):
+                return value
+            value = value if isinstance(value, torch.Tensor) else torch.tensor(value)
+            return value if value.numel() == 1 else value.to(rows.device)[rows]
+        return Sampler(select(self.temperature), select(self.top_k), select(self.top_p), select(self.min_p),
+                       select(self.repetition_penalty), select(self.presence_penalty),
+                       select(self.frequency_penalty), do_sample=self.do_sample)
+
+    def apply_penalties(self, logits: torch.Tensor, token_ids: torch.Tensor) -> torch.Tensor:
+        """token_ids为 [batch_size, seq_len] 的历史token（prompt和已生成部分），负数表示padding"""
+        batch_size = logits.shape[0]
+        valid = token_ids >= 0
+        counts = torch.zeros_like(logits).scatter_add_(1, token_ids.clamp(min=0), valid.to(logits.dtype))
+        present = counts > 0
+        if _is_enabled(self.repetition_penalty, 1.0):
+            penalty = _row_param(self.repetition_penalty, batch_size, logits.device)
+            logits = torch.where(present, torch.where(logits > 0, logits / penalty, logits * penalty), logits)
+        if _is_enabled(self.presence_penalty, 0.0):
+            logits = logits - _row_param(self.presence_penalty, batch_size, logits.device) * present
+        if _is_enabled(self.frequency_penalty, 0.0):
+            logits = logits - _row_param(self.frequency_penalty, batch_size, logits.device) * counts
+        return logits
+
+    def process(self, logits: torch.Tensor, token_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """返回处理后的logits，被过滤的token为-inf，贪心的行只保留argmax"""
+        logits = logits.float()
+        batch_size, vocab_size = logits.shape
+        device = logits.device
+
+        if token_ids is not None:
+            logits = self.apply_penalties(logits, token_ids)
+
+        greedy = None
+        if _is_enabled(self.temperature, 1.0):
+            temperature = _row_param(self.temperature, batch_size, device)
+            greedy = temperature <= 0
+            logits = logits / torch.where(greedy, torch.ones_like(temperature), temperature)
+
+        use_top_k = _is_enabled(self.top_k, 0)
+        use_top_p = _is_enabled(self.top_p, 1.0)
+        use_min_p = _is_enabled(self.min_p, 0.0)
+        if use_top_k or use_top_p or use_min_p:
+            # 只排序一次，在排序后的空间里构造要移除的token，再scatter回原来的顺序
+            sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+            sorted_remove = torch.zeros_like(sorted_logits, dtype=torch.bool)
+            if use_top_k:
+                top_k = _row_param(self.top_k, batch_size, device, dtype=torch.long)
+                ranks = torch.arange(vocab_size, device=device)[None, :]
+                sorted_remove |= (top_k > 0) & (ranks >= top_k)
+            if use_top_p or use_min_p:
+                sorted_probs = sorted_logits.masked_fill(sorted_remove, float("-inf")).softmax(dim=-1)
+                if use_top_p:
+                    # 前面token的累积概率已经超过top_p的token被移除，第一个token总被保留
+                    exclusive_cumsum = sorted_probs.cumsum(dim=-1) - sorted_probs
+                    sorted_remove |= exclusive_cumsum > _row_param(self.top_p, batch_size, device)
+                if use_min_p:
+                    sorted_remove |= sorted_probs < _row_param(self.min_p, batch_size, device) * sorted_probs[:, :1]
+            remove = torch.zeros_like(sorted_remove).scatter(1, sorted_indices, sorted_remove)
+            logits = logits.masked_fill(remove, float("-inf"))
+
+        if greedy is not None:
+            is_best = torch.zeros_like(logits, dtype=torch.bool).scatter(1, logits.argmax(dim=-1, keepdim=True), True)
+            logits = logits.masked_fill(greedy & ~is_best, float("-inf"))
+        return logits
+
+    def sample(self, logits: torch.Tensor, token_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """根据最后一个位置的logits [batch_size, vocab_size] 选出下一个token，返回 [batch_size, 1]"""
+        logits = self.process(logits, token_ids)
+        if not self.do_sample:
+            return logits.argmax(dim=-1, keepdim=True)
+        return torch.multinomial(logits.softmax(dim=-1), num_samples=1)
+
+    __call__ = sample
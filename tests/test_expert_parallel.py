@@ -0,0 +1,88 @@
+import os
+import sys
+__package__ = "tests"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import socket
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.distributed as dist
+import torch.multiprocessing as mp
+if not (dist.is_available() and dist.is_gloo_available()):
+    pytest.skip("torch.distributed或gloo后端不可用", allow_module_level=True)
+from model.MyLlama import LLMConfig
+from model.MyMoE import MoETransformer, MoEFeedForward, load_expert_parallel_state_dict, allreduce_dense_grads
+
+'''
+专家并行的MoETransformer与单进程保存全部专家的模型对比（CPU + gloo）
+    torchrun --nproc_per_node 2 tests/test_expert_parallel.py
+    python -m pytest tests/test_expert_parallel.py   # 用mp.spawn启动2个进程
+每个rank用不同的输入，检查:
+    loss与参考模型在本rank输入上的loss相同
+    allreduce_dense_grads之后非专家参数的梯度等于参考模型各rank梯度的平均
+    本rank专家参数的梯度等于参考模型对应专家各rank梯度的平均
+'''
+
+WORLD_SIZE = 2
+
+
+def check_expert_parallel(rank: int, world_size: int):
+    config = LLMConfig(use_moe=True, top_k=2, n_routed_experts=4, hidden_size=64, num_heads=4,
+                       num_key_value_heads=2, num_hidden_layers=2, vocab_size=128, flash_attn=False)
+    torch.manual_seed(0)
+    ref_model = MoETransformer(config)
+    ep_model = MoETransformer(config, ep_group=dist.group.WORLD)
+    load_expert_parallel_state_dict(ep_model, ref_model.state_dict())
+
+    torch.manual_seed(rank + 1)
+    input_ids = torch.randint(0, config.vocab_size, (2, 16))
+    ref_loss = ref_model(input_ids=input_ids, labels=input_ids)["loss"]
+    ep_loss = ep_model(input_ids=input_ids, labels=input_ids)["loss"]
+    torch.testing.assert_close(ep_loss, ref_loss, rtol=1e-5, atol=1e-5)
+    ref_loss.backward()
+    ep_loss.backward()
+    allreduce_dense_grads(ep_model)
+
+    ref_grads = {}
+    for name, param in ref_model.named_parameters():
+        grad = param.grad.clone() if param.grad is not None else torch.zeros_like(param)
+        dist.all_reduce(grad)
+        ref_grads[name] = grad / world_size
+    for name, module in ep_model.named_modules():
+        if not isinstance(module, MoEFeedForward):
+            continue
+        assert module.num_local_experts == config.n_routed_experts // world_size
+        for i in range(module.num_local_experts):
+            for pname, param in module.experts[i].named_parameters():
+                ref = ref_grads[f"{name}.experts.{module.expert_offset + i}.{pname}"]
+                torch.testing.assert_close(param.grad, ref, rtol=1e-4, atol=1e-5)
+    for name, param in ep_model.named_parameters():
+        if not getattr(param, "expert_parallel", False):
+            torch.testing.assert_close(param.grad, ref_grads[name], rtol=1e-4, atol=1e-5)
+
+
+def _worker(rank: int, world_size: int, port: int):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        check_expert_parallel(rank, world_size)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_expert_parallel():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    mp.spawn(_worker, args=(WORLD_SIZE, port), nprocs=WORLD_SIZE, join=True)
+
+
+if __name__ == "__main__":
+    # torchrun启动时环境变量中已有RANK/WORLD_SIZE
+    dist.init_process_group("gloo")
+    check_expert_parallel(dist.get_rank(), dist.get_world_size())
+    if dist.get_rank() == 0:
+        print("expert parallel matches the single-process model")
+    dist.destroy_process_group()
@@ -0,0 +1,68 @@
+import os
+import sys
+__package__ = "tests"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+from model.MyLlama import LLMConfig, Transformer
+from model.PrefixCache import PrefixCache
+from llm_tokenizer.utils import ChatMLSFT
+
+'''
+前缀缓存命中比block_size短的ChatML系统提示词，且命中后生成结果不变
+    python -m pytest tests/test_prefix_cache.py
+'''
+
+TOKENIZER_PATH = os.path.join(os.path.dirname(__file__), '..', 'llm_tokenizer')
+
+
+def _model():
+    torch.manual_seed(0)
+    config = LLMConfig(hidden_size=64, num_heads=4, num_key_value_heads=2, num_hidden_layers=2, flash_attn=False)
+    return Transformer(config).eval()
+
+
+def _generate(model, input_ids, prefix_cache=None):
+    return model.generate(input_ids, max_length=4, temperature=0.0, do_sample=False, prefix_cache=prefix_cache)
+
+
+def test_chatml_preamble_hits():
+    tokenizer = transformers.AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+    preamble = tokenizer(ChatMLSFT([]), return_tensors="pt")["input_ids"]
+    cache = PrefixCache(block_size=16)
+    assert preamble.shape[1] < cache.block_size
+    model = _model()
+    expected = _generate(model, preamble)
+    _generate(model, preamble, cache)
+    assert cache.stats()["saved_tokens"] == 0
+    torch.testing.assert_close(_generate(model, preamble, cache), expected)
+    assert cache.stats()["saved_tokens"] > 0
+
+    # 系统提示词后面接上用户消息，同样命中系统提示词的部分
+    prompt = tokenizer(ChatMLSFT([{"role": "user", "content": "你好"}], inference=True),
+                       return_tensors="pt")["input_ids"]
+    saved = cache.stats()["saved_tokens"]
+    torch.testing.assert_close(_generate(model, prompt, cache), _generate(model, prompt))
+    assert cache.stats()["saved_tokens"] - saved >= preamble.shape[1] - 1
+
+
+def test_partial_block_match():
+    cache = PrefixCache(block_size=4)
+    tokens = list(range(10))
+    key_cache = [torch.arange(10, dtype=torch.float).view(10, 1, 1)]
+    cache.insert(tokens, key_cache, key_cache)
+    # 两个整块加一个2个token的叶子
+    assert cache.stats()["num_nodes"] == 3
+    path, num_tokens = cache.match(tokens[:9] + [99])
+    assert num_tokens == 9 and len(path) == 3
+    path, num_tokens = cache.match(tokens[:6])
+    assert num_tokens == 6
+    out = [torch.zeros(10, 1, 1)]
+    cache.load(path, out, out, num_tokens)
+    torch.testing.assert_close(out[0][:6], key_cache[0][:6])
+    # 整块覆盖了原来的叶子，叶子被移除
+    cache.insert(tokens + [10, 11], [torch.zeros(12, 1, 1)], [torch.zeros(12, 1, 1)])
+    assert cache.stats()["num_nodes"] == 3
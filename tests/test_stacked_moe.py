@@ -0,0 +1,73 @@
+import os
+import sys
+__package__ = "tests"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from contextlib import ExitStack
+from unittest import mock
+
+import pytest
+
+torch = pytest.importorskip("torch")
+from model.MiniMind import MiniMindConfig, MOEFeedForward, StackedMOEFeedForward
+
+'''
+StackedMOEFeedForward与MOEFeedForward输出一致，解码时前向中没有host同步
+    python -m pytest tests/test_stacked_moe.py
+'''
+
+SYNC_METHODS = ("item", "tolist", "cpu", "numpy", "__bool__", "__int__", "__float__")
+
+
+def _layers(**kwargs):
+    config = MiniMindConfig(use_moe=True, hidden_size=64, n_routed_experts=8, num_experts_per_tok=2, **kwargs)
+    torch.manual_seed(0)
+    moe = MOEFeedForward(config).eval()
+    stacked = StackedMOEFeedForward(config).eval()
+    stacked.load_state_dict(moe.state_dict())
+    return moe, stacked
+
+
+def _no_sync():
+    """任何把张量的值读回Python的调用都报错；有GPU时再用CUDA的同步检查"""
+    stack = ExitStack()
+    for name in SYNC_METHODS:
+        def fail(*args, _name=name, **kwargs):
+            raise AssertionError(f"前向中调用了Tensor.{_name}")
+        stack.enter_context(mock.patch.object(torch.Tensor, name, fail))
+    if torch.cuda.is_available():
+        torch.cuda.set_sync_debug_mode("error")
+        stack.callback(torch.cuda.set_sync_debug_mode, "default")
+    return stack
+
+
+def test_matches_list_layout():
+    for kwargs in ({}, {"eval_capacity_factor": 1.0}, {"eval_capacity_factor": 1.0, "overflow_policy": "reroute"}):
+        moe, stacked = _layers(**kwargs)
+        # 1个token（分配数小于专家数）和32个token（每个专家一段）
+        for seq_len in (1, 3, 32):
+            x = torch.randn(2, seq_len, 64)
+            with torch.no_grad():
+                torch.testing.assert_close(stacked(x), moe(x), rtol=1e-5, atol=1e-5)
+
+
+def test_decode_without_host_sync():
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    _, stacked = _layers()
+    stacked = stacked.to(device)
+    for seq_len in (1, 32):
+        x = torch.randn(1, seq_len, 64, device=device)
+        with torch.no_grad(), _no_sync():
+            stacked(x)
+
+
+def test_backward():
+    moe, stacked = _layers(capacity_factor=1.0)
+    moe.train()
+    stacked.train()
+    x = torch.randn(2, 16, 64)
+    moe(x).sum().backward()
+    stacked(x).sum().backward()
+    for name in ("gate_proj", "up_proj", "down_proj"):
+        ref = torch.stack([getattr(expert, name).weight.grad for expert in moe.experts])
+        torch.testing.assert_close(getattr(stacked, name).grad, ref, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,62 @@
+import os
+import sys
+__package__ = "tests"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+from torch.utils.data import DataLoader
+from utils.llm_dataset import StreamingPretrainDataset
+
+'''
+StreamingPretrainDataset多次断点恢复后与不中断时读到的batch完全相同
+    python -m pytest tests/test_streaming_dataset.py
+'''
+
+TOKENIZER_PATH = os.path.join(os.path.dirname(__file__), '..', 'llm_tokenizer')
+BATCH_SIZE = 2
+NUM_WORKERS = 2
+
+
+def _dataset(data_path, cache_dir):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+    return StreamingPretrainDataset(data_path, tokenizer, max_length=16, batch_size=BATCH_SIZE,
+                                    num_workers=NUM_WORKERS, rank=0, world_size=1, shuffle_buffer=4,
+                                    chunk_bytes=128, cache_dir=cache_dir)
+
+
+def _batches(dataset, limit=None):
+    batches = []
+    for batch in DataLoader(dataset, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS):
+        if limit is not None and len(batches) == limit:
+            break
+        batches.append(batch["input_ids"])
+    return batches
+
+
+def test_resume_twice(tmp_path):
+    data_path = str(tmp_path / "data.jsonl")
+    with open(data_path, "w", encoding="utf-8") as f:
+        for i in range(37):
+            f.write(json.dumps({"text": f"第{i}条样本 sample {i}"}, ensure_ascii=False) + "\n")
+    cache_dir = str(tmp_path / "cache")
+    expected = _batches(_dataset(data_path, cache_dir))
+
+    # 在奇数步（不能被num_workers整除）恢复两次
+    dataset = _dataset(data_path, cache_dir)
+    batches = _batches(dataset, limit=3)
+    state = dataset.state_dict(len(batches))
+    dataset = _dataset(data_path, cache_dir)
+    dataset.load_state_dict(state)
+    batches += _batches(dataset, limit=4)
+    state = dataset.state_dict(len(batches))
+    dataset = _dataset(data_path, cache_dir)
+    dataset.load_state_dict(state)
+    batches += _batches(dataset)
+
+    assert len(batches) == len(expected)
+    for batch, ref in zip(batches, expected):
+        torch.testing.assert_close(batch, ref)
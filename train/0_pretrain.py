@@ -12,28 +12,56 @@ import torch
 import torch.distributed as dist
 from torch import optim, nn
 from torch.nn.parallel import DistributedDataParallel
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader
 from contextlib import nullcontext
 from transformers import AutoTokenizer
-from utils.llm_dataset import PretrainDataset
-
-def get_lr(current_step, total_steps, lr):
-    return lr / 10 + 0.5 * lr * (1 + math.cos(math.pi * current_step / total_steps))
+from utils.llm_dataset import PretrainDataset, MMapPretrainDataset, PackedPretrainDataset, StreamingPretrainDataset, \
+    ResumableDistributedSampler
+from utils.checkpoint import CheckpointManager, gather_rng_state, set_rng_state
+from utils.utils import get_rank, get_world_size
+from utils.metrics import TrainMetrics, MetricsSink
+from utils.optim import build_optimizer
+from utils.scheduler import LRScheduler
 
 def init_distributed_mode():
-    dist.init_process_group(backend="nccl")
-    ddp_local_rank = int(os.environ["LOCAL_RANK"])
-    DEVICE = f"cuda:{ddp_local_rank}"
-    torch.cuda.set_device(DEVICE)
+    """
+    返回训练使用的device
+    torchrun启动且WORLD_SIZE>1时初始化进程组：有GPU用nccl，否则用gloo在多个CPU进程间做数据并行；
+    直接用python运行时（单进程）不创建进程组
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if torch.cuda.is_available():
+        device = f"cuda:{local_rank}"
+        torch.cuda.set_device(device)
+    else:
+        device = "cpu"
+        # 同一台机器上的多个CPU进程平分核数，避免线程数超额
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(os.cpu_count() // local_world_size, 1))
+    if world_size > 1:
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+    return device
+
+def get_autocast_ctx(device, dtype):
+    """CUDA上按--dtype使用bf16/fp16的autocast；CPU的autocast只使用bf16；float32不使用autocast"""
+    if dtype == "float32":
+        return nullcontext()
+    device_type = "cuda" if device.startswith("cuda") else "cpu"
+    if device_type == "cpu":
+        return torch.amp.autocast("cpu", dtype=torch.bfloat16)
+    return torch.amp.autocast("cuda", dtype=torch.float16 if dtype == "float16" else torch.bfloat16)
 
-def get_model_tokenizer(device):
-    config = LLMConfig()
+def get_model_tokenizer(device, args):
+    config = LLMConfig(loss_chunk_size=args.loss_chunk_size,
+                       activation_checkpointing=args.activation_checkpointing,
+                       activation_checkpointing_mode=args.activation_checkpointing_mode)
     model = Transformer(config).to(device)
     tokenizer = AutoTokenizer.from_pretrained("../llm_tokenizer")
     return model, tokenizer
 
 def save_model(model, epoch,output_dir="../checkpoints"):
-    if dist.get_rank() == 0:
+    if get_rank() == 0:
         model.eval()
         os.makedirs(output_dir, exist_ok=True)
         save_path = os.path.join(output_dir, f"model_epoch_{epoch}.pth")
@@ -46,16 +74,29 @@ def save_model(model, epoch,output_dir="../checkpoints"):
         torch.save(state_dict, save_path)
         model.train()
 
-def set_optimizer(model, args):
-    return optim.AdamW(model.parameters(), lr=args.learning_rate)
-
 def get_dataloader(args, tokenizer):
-    train_ds = PretrainDataset(args.data_path, tokenizer, max_length=args.max_seq_len)
-    train_sampler = DistributedSampler(train_ds) if dist.get_world_size()>1 else None
+    if args.streaming:
+        # 流式读取，各rank、各worker只读全局行顺序中自己负责的一段，由数据集自己分片，不需要DistributedSampler
+        train_ds = StreamingPretrainDataset(args.data_path, tokenizer, max_length=args.max_seq_len,
+                                            batch_size=args.batch_size, num_workers=args.num_workers,
+                                            shuffle_buffer=args.shuffle_buffer)
+        return DataLoader(train_ds, batch_size=args.batch_size, pin_memory=torch.cuda.is_available(),
+                          num_workers=args.num_workers)
+    if args.data_path.endswith(".bin") and args.packing:
+        # 多个文档打包成一行，文档之间通过segment_ids互相不可见
+        train_ds = PackedPretrainDataset(args.data_path, max_length=args.max_seq_len,
+                                         pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+    elif args.data_path.endswith(".bin"):
+        # utils/pretokenize.py 离线分词后的数据，按需从memmap读取
+        train_ds = MMapPretrainDataset(args.data_path, max_length=args.max_seq_len, pad_token_id=tokenizer.pad_token_id)
+    else:
+        train_ds = PretrainDataset(args.data_path, tokenizer, max_length=args.max_seq_len)
+    # 单进程时按顺序读取；断点恢复时由sampler在索引上跳过已训练的样本，不读取它们
+    train_sampler = ResumableDistributedSampler(train_ds, shuffle=get_world_size() > 1)
     train_loader = DataLoader(
         train_ds,
         batch_size=args.batch_size,
-        pin_memory=True,
+        pin_memory=torch.cuda.is_available(),
         drop_last=False,
         shuffle=False,
         num_workers=args.num_workers,
@@ -63,36 +104,115 @@ def get_dataloader(args, tokenizer):
     )
     return train_loader
 
-def train_one_epoch(model:Transformer, optimizer, data_loader, device, ctx, scaler, epoch,args):
+def set_epoch(data_loader, epoch):
+    # DistributedSampler和StreamingPretrainDataset都按epoch重新打乱
+    if isinstance(data_loader.sampler, ResumableDistributedSampler):
+        data_loader.sampler.set_epoch(epoch)
+    if isinstance(data_loader.dataset, StreamingPretrainDataset):
+        data_loader.dataset.set_epoch(epoch)
+
+def save_checkpoint(checkpointer, model, optimizer, scheduler, scaler, data_loader, epoch, step, args):
+    """保存完整的训练状态，所有rank都要调用（收集RNG状态是集合通信），只有rank 0写盘"""
+    rng_state = gather_rng_state()
+    if hasattr(optimizer, "consolidate_state_dict"):
+        # ZeRO的优化器状态分散在各个rank上，先汇总到rank 0
+        optimizer.consolidate_state_dict(to=0)
+    if get_rank() != 0:
+        return
+    iter_per_epoch = len(data_loader)
+    model = model.module if isinstance(model, DistributedDataParallel) else model
+    state = {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scaler": scaler.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "epoch": epoch,
+        "step": step,
+        "rng_state": rng_state,
+        "data_state": data_loader.dataset.state_dict(step)
+                      if isinstance(data_loader.dataset, StreamingPretrainDataset) else None,
+        "args": vars(args),
+    }
+    checkpointer.save((epoch - 1) * iter_per_epoch + step, state)
+
+def load_checkpoint(checkpointer, model, optimizer, scheduler, scaler, data_loader, args):
+    """恢复训练状态，返回继续训练的 (epoch, step)"""
+    checkpoint = checkpointer.load(None if args.resume == "latest" else args.resume)
+    if checkpoint is None:
+        return 1, 0
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    scaler.load_state_dict(checkpoint["scaler"])
+    scheduler.load_state_dict(checkpoint["scheduler"])
+    rng_state = checkpoint["rng_state"]
+    set_rng_state(rng_state[get_rank()] if len(rng_state) == get_world_size() else rng_state[0])
+    epoch, step = checkpoint["epoch"], checkpoint["step"]
+    if checkpoint["data_state"] is not None:
+        data_loader.dataset.load_state_dict(checkpoint["data_state"])
+    if step >= len(data_loader):
+        epoch, step = epoch + 1, 0
+    if isinstance(data_loader.sampler, ResumableDistributedSampler):
+        # sampler的顺序只由epoch决定，从已训练的batch之后的样本开始；流式数据集由load_state_dict恢复
+        data_loader.sampler.set_start(epoch, step * args.batch_size)
+    if get_rank() == 0:
+        print(f"从 epoch {epoch} step {step} 继续训练")
+    return epoch, step
+
+def train_one_epoch(model:Transformer, optimizer, scheduler, data_loader, device, ctx, scaler, epoch, args,
+                    checkpointer=None, start_step=0, metrics=None):
     start_time = time.time()
     iter_per_epoch = len(data_loader)
     model.train()
-    for step, batch in enumerate(data_loader):
+    # 断点恢复时sampler或流式数据集已经跳过了前start_step个batch
+    batches = data_loader
+    if metrics is not None:
+        metrics.reset()
+        batches = metrics.timed(batches)
+    phase = metrics.phase if metrics is not None else lambda name: nullcontext()
+    for step, batch in enumerate(batches, start=start_step):
         input_ids = batch['input_ids'].to(device)
         attention_mask = batch['attention_mask'].to(device)
         labels = batch['labels'].to(device)
-        lr = get_lr(epoch * iter_per_epoch + step, args.epochs * iter_per_epoch, args.learning_rate)
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
-        
-        with ctx:
-            loss = model(input_ids, attention_mask, labels)["loss"]
+        # 序列打包时数据中带有文档内位置和文档编号
+        packing_kwargs = {k: batch[k].to(device) for k in ("position_ids", "segment_ids") if k in batch}
+
+        with phase("forward"), ctx:
+            # 训练只需要loss，不返回完整的logits
+            loss = model(input_ids, attention_mask, labels, return_logits=False, **packing_kwargs)["loss"]
             loss = loss / args.accumulation_steps
-        scaler.scale(loss).backward()
+        with phase("backward"):
+            scaler.scale(loss).backward()
 
         if (step + 1) % args.accumulation_steps == 0:
-            scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
+            with phase("optimizer"):
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
 
-            scaler.step(optimizer)
-            scaler.update()
+                scaler.step(optimizer)
+                scaler.update()
 
-            optimizer.zero_grad(set_to_none=True)
+                optimizer.zero_grad(set_to_none=True)
+                lr = scheduler.lr
+                # 学习率按参数更新次数调度，梯度累积中的micro-batch不改变学习率
+                scheduler.step()
 
-            if dist.get_rank() == 0:
-                print(f"Epoch [{epoch}/{args.epochs}] Step [{step+1}/{iter_per_epoch}] "
-                      f"Loss: {loss.item()*args.accumulation_steps:.4f} "
-                      f"Time: {time.time() - start_time:.2f}s")
+            update = (step + 1) // args.accumulation_steps
+            if update % args.log_interval == 0:
+                message = (f"Epoch [{epoch}/{args.epochs}] Step [{step+1}/{iter_per_epoch}] "
+                           f"Loss: {loss.item()*args.accumulation_steps:.4f} "
+                           f"Time: {time.time() - start_time:.2f}s")
+                if metrics is not None:
+                    record = metrics.log(epoch=epoch, step=step + 1, loss=loss.item() * args.accumulation_steps, lr=lr)
+                    mfu = f"{record['mfu']:.2%}" if record["mfu"] is not None else "n/a"
+                    message += (f" Tokens/s: {record['tokens_per_sec']:.0f} MFU: {mfu} "
+                                f"data/fwd/bwd/opt: {record['data_time_ms']:.0f}/{record['forward_time_ms']:.0f}/"
+                                f"{record['backward_time_ms']:.0f}/{record['optimizer_time_ms']:.0f}ms "
+                                f"Mem: {record['peak_memory_mb']:.0f}MB")
+                if get_rank() == 0:
+                    print(message)
+
+            if checkpointer is not None and args.save_interval > 0 and (step + 1) % args.save_interval == 0:
+                save_checkpoint(checkpointer, model, optimizer, scheduler, scaler, data_loader, epoch, step + 1, args)
 
         
 if __name__ == "__main__":
@@ -102,34 +222,91 @@ if __name__ == "__main__":
     parser.add_argument("--epochs", type=int, default=6)
     parser.add_argument("--batch_size", type=int, default=32)
     parser.add_argument("--learning_rate", type=float, default=5e-4)
+    # 只作用于二维权重，norm/bias/embedding不做weight decay
+    parser.add_argument("--weight_decay", type=float, default=0.01)
+    # 学习率调度，单位都是参数更新次数；min_lr默认为learning_rate的1/10
+    parser.add_argument("--warmup_steps", type=int, default=0)
+    parser.add_argument("--lr_decay", type=str, default="cosine", choices=["cosine", "linear", "wsd"])
+    parser.add_argument("--min_lr", type=float, default=None)
+    parser.add_argument("--optimizer_impl", type=str, default="auto", choices=["auto", "fused", "foreach", "for-loop"])
+    # ZeRO-1：优化器状态按rank切分
+    parser.add_argument("--zero", action="store_true")
+    # bfloat16 / float16 / float32，CPU上只支持bfloat16的autocast
     parser.add_argument("--dtype", type=str, default="bfloat16")
     parser.add_argument("--num_workers", type=int, default=1)
     parser.add_argument("--accumulation_steps", type=int, default=8)
     parser.add_argument("--grad_clip", type=float, default=1.0)
     parser.add_argument('--max_seq_len', default=512, type=int)
+    # >0时分块计算lm_head和交叉熵，激活内存不再随 token数 × 词表大小 增长
+    parser.add_argument("--loss_chunk_size", type=int, default=0)
+    # >0时每k层重计算一层的激活，用时间换显存；selective只重算注意力分数和MLP中间结果
+    parser.add_argument("--activation_checkpointing", type=int, default=0)
+    parser.add_argument("--activation_checkpointing_mode", type=str, default="full", choices=["full", "selective"])
+    # 把多个文档打包成满长度的行，需要 --data_path 指向 utils/pretokenize.py 生成的 .bin 文件
+    parser.add_argument("--packing", action="store_true")
     parser.add_argument("--data_path", type=str, default="../dataset/pretrain_hq.jsonl")
+    # 流式读取jsonl文件或目录，各rank不再加载整个语料
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000)
+    # 完整训练状态的checkpoint，save_interval按batch计，应为accumulation_steps的整数倍，<=0表示不保存
+    parser.add_argument("--checkpoint_dir", type=str, default="../checkpoints/pretrain")
+    parser.add_argument("--save_interval", type=int, default=1000)
+    parser.add_argument("--keep_checkpoints", type=int, default=3)
+    # 不带路径时从checkpoint_dir中最新的checkpoint恢复
+    parser.add_argument("--resume", type=str, nargs="?", const="latest", default=None)
+    # 每log_interval次参数更新打印一次，并把吞吐/MFU等统计写入metrics_path（.jsonl或.csv）
+    parser.add_argument("--log_interval", type=int, default=1)
+    parser.add_argument("--metrics_path", type=str, default=None)
+    # 计算MFU用的单卡峰值算力，不指定时按GPU型号估计
+    parser.add_argument("--peak_tflops", type=float, default=None)
     args = parser.parse_args()
 
-    ctx = torch.amp.autocast('cuda')
-
-    init_distributed_mode()
+    device = init_distributed_mode()
+    ctx = get_autocast_ctx(device, args.dtype)
 
-    model,tokenizer = get_model_tokenizer(device=f"cuda:{dist.get_rank()}")
-    if dist.get_rank() == 0:
+    model,tokenizer = get_model_tokenizer(device=device, args=args)
+    if get_rank() == 0:
         print(f'LLM可训练总参数量:{sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e6:.3f} 百万')
-    ddp_model = DistributedDataParallel(model, device_ids=[dist.get_rank()])
-
     dataloader = get_dataloader(args, tokenizer)
-    for epoch in range(1, args.epochs + 1):
+    # 优化器和GradScaler在整个训练过程中只创建一次，动量等状态跨epoch保留
+    optimizer = build_optimizer(model, args.learning_rate, weight_decay=args.weight_decay,
+                                impl=args.optimizer_impl, zero=args.zero)
+    # 只有fp16需要loss scaling，bf16和CPU上GradScaler不生效
+    scaler = torch.amp.GradScaler("cuda", enabled=args.dtype == "float16" and device.startswith("cuda"))
+    total_updates = args.epochs * (len(dataloader) // args.accumulation_steps)
+    scheduler = LRScheduler(optimizer, args.learning_rate, total_updates, warmup_steps=args.warmup_steps,
+                            decay=args.lr_decay,
+                            min_lr=args.learning_rate / 10 if args.min_lr is None else args.min_lr)
+    checkpointer = CheckpointManager(args.checkpoint_dir, keep_last=args.keep_checkpoints)
+    start_epoch, start_step = 1, 0
+    if args.resume is not None:
+        start_epoch, start_step = load_checkpoint(checkpointer, model, optimizer, scheduler, scaler, dataloader, args)
+    if get_world_size() > 1:
+        # CPU(gloo)上device_ids为None
+        ddp_model = DistributedDataParallel(model, device_ids=[device] if device.startswith("cuda") else None)
+    else:
+        ddp_model = model
+
+    metrics = TrainMetrics(model.args, device, peak_tflops=args.peak_tflops, world_size=get_world_size(),
+                           sink=MetricsSink(args.metrics_path) if args.metrics_path and get_rank() == 0 else None)
+
+    for epoch in range(start_epoch, args.epochs + 1):
+        set_epoch(dataloader, epoch)
         train_one_epoch(
             ddp_model,
-            set_optimizer(ddp_model, args),
+            optimizer,
+            scheduler,
             dataloader,
-            device=f"cuda:{dist.get_rank()}",
+            device=device,
             ctx=ctx,
-            scaler=torch.amp.GradScaler('cuda'),
+            scaler=scaler,
             epoch=epoch,
-            args=args
+            args=args,
+            checkpointer=checkpointer,
+            start_step=start_step if epoch == start_epoch else 0,
+            metrics=metrics
         )
         save_model(ddp_model, epoch)
-    dist.destroy_process_group()
\ No newline at end of file
+    checkpointer.wait()
+    if dist.is_initialized():
+        dist.destroy_process_group()
\ No newline at end of file
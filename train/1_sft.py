@@ -1,4 +1,115 @@
-from datasets import load_dataset
+import os
+import sys
+__package__ = "train"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-# Login using e.g. `huggingface-cli login` to access this dataset
-ds = load_dataset("Million/Chinese-Poems")
+import argparse
+import importlib
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from utils.llm_dataset import SFTDataset, SFTCollator, LengthBucketBatchSampler, ResumableDistributedSampler
+from utils.utils import get_rank, get_world_size
+from utils.metrics import TrainMetrics, MetricsSink
+from utils.optim import build_optimizer
+from utils.scheduler import LRScheduler
+
+# 分布式初始化、autocast、模型构建和训练循环与预训练相同
+pretrain = importlib.import_module("train.0_pretrain")
+
+'''
+监督微调(SFT)，在预训练权重上用ChatML格式的多轮对话训练，只对assistant的回复计算loss
+    python train/1_sft.py --init_weight ../checkpoints/model_epoch_6.pth --data_path ../dataset/sft_mini_512.jsonl
+    torchrun --nproc_per_node 2 train/1_sft.py ...
+默认按长度分桶组batch（LengthBucketBatchSampler），每个batch只padding到batch内的最大长度
+再向上取整到pad_to_multiple_of的倍数（SFTCollator），短对话为主的数据不再全部padding到max_seq_len；
+--no_bucketing 时恢复为打乱顺序并padding到max_seq_len。
+'''
+
+
+def get_dataloader(args, tokenizer):
+    train_ds = SFTDataset(args.data_path, tokenizer, max_length=args.max_seq_len,
+                          dynamic_padding=not args.no_bucketing)
+    if args.no_bucketing:
+        train_sampler = ResumableDistributedSampler(train_ds, shuffle=True)
+        return DataLoader(train_ds, batch_size=args.batch_size, pin_memory=torch.cuda.is_available(),
+                          num_workers=args.num_workers, sampler=train_sampler)
+    # 样本长度只在第一次使用时统计一次并缓存；各rank同一步拿到的batch长度相近
+    batch_sampler = LengthBucketBatchSampler(train_ds.lengths, args.batch_size, bucket_size=args.bucket_size)
+    return DataLoader(train_ds, batch_sampler=batch_sampler, pin_memory=torch.cuda.is_available(),
+                      num_workers=args.num_workers,
+                      collate_fn=SFTCollator(tokenizer.pad_token_id, pad_to_multiple_of=args.pad_to_multiple_of))
+
+
+def set_epoch(data_loader, epoch):
+    sampler = data_loader.batch_sampler if isinstance(data_loader.batch_sampler, LengthBucketBatchSampler) \
+        else data_loader.sampler
+    sampler.set_epoch(epoch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MiniMind SFT")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--learning_rate", type=float, default=5e-5)
+    parser.add_argument("--weight_decay", type=float, default=0.01)
+    parser.add_argument("--warmup_steps", type=int, default=0)
+    parser.add_argument("--lr_decay", type=str, default="cosine", choices=["cosine", "linear", "wsd"])
+    parser.add_argument("--min_lr", type=float, default=None)
+    parser.add_argument("--optimizer_impl", type=str, default="auto", choices=["auto", "fused", "foreach", "for-loop"])
+    parser.add_argument("--zero", action="store_true")
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--accumulation_steps", type=int, default=1)
+    parser.add_argument("--grad_clip", type=float, default=1.0)
+    parser.add_argument('--max_seq_len', default=1024, type=int)
+    parser.add_argument("--loss_chunk_size", type=int, default=0)
+    parser.add_argument("--activation_checkpointing", type=int, default=0)
+    parser.add_argument("--activation_checkpointing_mode", type=str, default="full", choices=["full", "selective"])
+    parser.add_argument("--data_path", type=str, default="../dataset/sft_mini_512.jsonl")
+    # 预训练得到的权重（train/0_pretrain.py的save_model），不指定时从随机初始化开始
+    parser.add_argument("--init_weight", type=str, default=None)
+    parser.add_argument("--out_dir", type=str, default="../checkpoints/sft")
+    # 长度分桶：每个桶包含 batch_size * world_size * bucket_size 个样本
+    parser.add_argument("--no_bucketing", action="store_true")
+    parser.add_argument("--bucket_size", type=int, default=100)
+    parser.add_argument("--pad_to_multiple_of", type=int, default=64)
+    parser.add_argument("--log_interval", type=int, default=1)
+    parser.add_argument("--metrics_path", type=str, default=None)
+    parser.add_argument("--peak_tflops", type=float, default=None)
+    args = parser.parse_args()
+    # SFT只在每个epoch结束时保存权重，不保存完整的训练状态
+    args.save_interval = 0
+
+    device = pretrain.init_distributed_mode()
+    ctx = pretrain.get_autocast_ctx(device, args.dtype)
+    model, tokenizer = pretrain.get_model_tokenizer(device=device, args=args)
+    if args.init_weight:
+        model.load_state_dict(torch.load(args.init_weight, map_location=device))
+    if get_rank() == 0:
+        print(f'LLM可训练总参数量:{sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e6:.3f} 百万')
+    dataloader = get_dataloader(args, tokenizer)
+    optimizer = build_optimizer(model, args.learning_rate, weight_decay=args.weight_decay,
+                                impl=args.optimizer_impl, zero=args.zero)
+    scaler = torch.amp.GradScaler("cuda", enabled=args.dtype == "float16" and device.startswith("cuda"))
+    total_updates = args.epochs * (len(dataloader) // args.accumulation_steps)
+    scheduler = LRScheduler(optimizer, args.learning_rate, total_updates, warmup_steps=args.warmup_steps,
+                            decay=args.lr_decay,
+                            min_lr=args.learning_rate / 10 if args.min_lr is None else args.min_lr)
+    if get_world_size() > 1:
+        ddp_model = DistributedDataParallel(model, device_ids=[device] if device.startswith("cuda") else None)
+    else:
+        ddp_model = model
+
+    # 动态padding时tokens/s只统计非padding的token，可以直接与--no_bucketing对比
+    metrics = TrainMetrics(model.args, device, peak_tflops=args.peak_tflops, world_size=get_world_size(),
+                           sink=MetricsSink(args.metrics_path) if args.metrics_path and get_rank() == 0 else None)
+
+    for epoch in range(1, args.epochs + 1):
+        set_epoch(dataloader, epoch)
+        pretrain.train_one_epoch(ddp_model, optimizer, scheduler, dataloader, device=device, ctx=ctx, scaler=scaler,
+                                 epoch=epoch, args=args, metrics=metrics)
+        pretrain.save_model(ddp_model, epoch, output_dir=args.out_dir)
+    if dist.is_initialized():
+        dist.destroy_process_group()
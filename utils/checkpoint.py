@@ -0,0 +1,127 @@
+import os
+import re
+import random
+import threading
+import numpy as np
+import torch
+import torch.distributed as dist
+
+'''
+训练状态的完整checkpoint：模型、优化器、GradScaler、学习率调度位置、各rank的RNG状态和数据游标
+
+保存分两步：主线程先把state中的所有张量拷贝到CPU（快照，之后训练可以继续修改参数），
+再由后台线程写入磁盘，写到临时文件后通过os.replace原子地重命名，进程中途被杀也不会留下损坏的checkpoint。
+只保留最近keep_last个checkpoint。
+'''
+
+CHECKPOINT_PATTERN = re.compile(r"^ckpt_(\d+)\.pth$")
+
+
+def to_cpu(state):
+    """递归地把state中的张量拷贝到CPU，返回与训练解耦的快照"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and "cuda" in state:
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def gather_rng_state():
+    """收集所有rank的RNG状态（集合通信，每个rank都要调用），返回按rank排列的列表"""
+    state = get_rng_state()
+    if not (dist.is_available() and dist.is_initialized()):
+        return [state]
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, state)
+    return states
+
+
+class CheckpointManager:
+    def __init__(self, output_dir, keep_last=3, async_save=True):
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self.async_save = async_save
+        self._thread = None
+        self._error = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path(self, step):
+        return os.path.join(self.output_dir, f"ckpt_{step:09d}.pth")
+
+    def checkpoints(self):
+        """按step从小到大返回已有的 (step, path)"""
+        found = []
+        for name in os.listdir(self.output_dir):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.output_dir, name)))
+        return sorted(found)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def save(self, step, state):
+        # 同一时间只有一个保存线程，上一次还没写完时在这里等待
+        self.wait()
+        snapshot = to_cpu(state)
+        if self.async_save:
+            self._thread = threading.Thread(target=self._write, args=(step, snapshot), daemon=False)
+            self._thread.start()
+        else:
+            self._write(step, snapshot)
+            self._raise_error()
+
+    def _write(self, step, snapshot):
+        try:
+            path = self.path(step)
+            tmp_path = path + ".tmp"
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, path)
+            self._prune()
+        except Exception as e:
+            self._error = e
+
+    def _prune(self):
+        if self.keep_last is None or self.keep_last <= 0:
+            return
+        for _, path in self.checkpoints()[:-self.keep_last]:
+            os.remove(path)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("保存checkpoint失败") from error
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def load(self, path=None, map_location="cpu"):
+        path = path or self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
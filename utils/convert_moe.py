@@ -0,0 +1,43 @@
+import os
+import sys
+__package__ = "utils"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import torch
+from model.MiniMind import stack_moe_state_dict
+from model.ExpertCache import ExpertStore, LIST_EXPERT_PATTERN, STACKED_EXPERT_PATTERN
+
+'''
+把MiniMind MoE模型(moe_layout='list')的checkpoint转换成堆叠专家权重的格式(moe_layout='stacked')
+    python convert_moe.py --input ../out/moe_512.pth --output ../out/moe_512_stacked.pth --n_routed_experts 4
+StackedMOEFeedForward加载时也会自动转换，离线转换只是省去每次加载时的拷贝
+
+指定--expert_store时改为导出专家卸载(moe_layout='offload')用的文件：路由专家写入内存映射文件，
+--output只保存其余的权重；checkpoint以mmap方式读取，转换不需要把整个模型放进内存
+    python convert_moe.py --input ../out/moe_512.pth --output ../out/moe_512_offload.pth --expert_store ../out/moe_512_experts.bin
+'''
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert MoE checkpoint to stacked or offloaded expert layout")
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--n_routed_experts", type=int, default=4)
+    parser.add_argument("--expert_store", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "float32"])
+    args = parser.parse_args()
+
+    if args.expert_store:
+        state_dict = torch.load(args.input, map_location="cpu", mmap=True, weights_only=True)
+        store = ExpertStore.write(state_dict, args.expert_store, args.dtype)
+        rest = {k: v for k, v in state_dict.items()
+                if not (LIST_EXPERT_PATTERN.search(k) or STACKED_EXPERT_PATTERN.search(k))}
+        torch.save(rest, args.output)
+        print(f"{store.num_layers} layers x {store.n_experts} experts ({store.expert_bytes / 1024 ** 2:.1f}MB each) "
+              f"-> {args.expert_store}, {len(rest)} other tensors -> {args.output}")
+    else:
+        state_dict = torch.load(args.input, map_location="cpu")
+        num_keys = len(state_dict)
+        stack_moe_state_dict(state_dict, args.n_routed_experts)
+        torch.save(state_dict, args.output)
+        print(f"{num_keys} -> {len(state_dict)} tensors, saved to {args.output}")
@@ -1,9 +1,39 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, DistributedSampler, get_worker_info
+import torch.distributed as dist
+import os
 import json
+import bisect
+import hashlib
+import glob
+import random
+import itertools
+import numpy as np
+import torch
 from llm_tokenizer.utils import ChatMLSFT
-'''
-TODO: 优化不要一次性全部加载,使用MMAP技术,支持分布式数据集
-'''
+def run_on_rank0(fn):
+    '''
+    只在rank 0上调用fn()，结果广播给其他rank（fn的返回值需要能被pickle）
+    用于统计数据集的元信息：只读一遍数据，缓存文件也只由一个进程写入
+    '''
+    if not (dist.is_available() and dist.is_initialized()):
+        return fn()
+    result = [fn() if dist.get_rank() == 0 else None]
+    dist.broadcast_object_list(result, src=0)
+    return result[0]
+
+
+def atomic_save_npy(path, array):
+    '''写到临时文件再os.replace，其他进程不会读到写了一半的文件；目录不可写时跳过缓存'''
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"无法写入缓存 {path}: {e}")
+
+
 class PretrainDataset(Dataset):
     def __init__(self, data_path, tokenizer, max_length=512):
         super().__init__()
@@ -23,31 +53,375 @@ class PretrainDataset(Dataset):
         return len(self.samples)
 
     def __getitem__(self, index):
-        sample = self.samples[index]
-        encoding = self.tokenizer(
-            str(sample['text']),
-            max_length=self.max_length,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        ids = encoding.input_ids.squeeze()
-        attention_mask = (ids != self.tokenizer.pad_token_id)
-
-        input_ids = ids[:-1].detach().clone()
-        label = ids[1:].detach().clone()
-        attention_mask = attention_mask[1:].detach().clone().type_as(label)
+        return encode_pretrain_sample(self.tokenizer, str(self.samples[index]['text']), self.max_length)
+
+
+def encode_pretrain_sample(tokenizer, text, max_length):
+    encoding = tokenizer(
+        text,
+        max_length=max_length,
+        padding='max_length',
+        truncation=True,
+        return_tensors='pt'
+    )
+    ids = encoding.input_ids.squeeze()
+    attention_mask = (ids != tokenizer.pad_token_id)
+
+    input_ids = ids[:-1].detach().clone()
+    label = ids[1:].detach().clone()
+    attention_mask = attention_mask[1:].detach().clone().type_as(label)
+    return {
+        "input_ids":input_ids,
+        "attention_mask":attention_mask,
+        "labels":label
+    }
+
+
+class StreamingPretrainDataset(IterableDataset):
+    '''
+    流式读取jsonl预训练数据，每个进程只持有shuffle缓冲区大小的内存，而不是整个语料
+
+    data_path可以是一个jsonl文件、一个目录（其中所有的.jsonl文件）或文件列表。
+    所有文件按chunk_bytes切成字节区间，每个区间负责起始位置落在区间内的行。
+    每个区间的行数只统计一次：由rank 0读一遍语料，结果缓存在cache_dir中（按文件的路径、大小、修改时间和chunk_bytes区分），
+    再广播给其他rank，之后启动时不再读整个语料。
+
+    每个epoch用seed + epoch打乱区间的顺序，得到全局的行顺序，总行数补齐到 worker总数 × samples_per_worker
+    （与DistributedSampler一样从开头回绕补齐，samples_per_worker是batch_size的整数倍），
+    第 rank * num_workers + worker_id 个worker按顺序读取其中连续的samples_per_worker行。
+    各worker的行数完全相同、互不重叠，一个epoch恰好覆盖整个语料（只有补齐的不超过 worker总数 × batch_size 行重复），
+    DDP的各个rank步数相同。worker读到的行经过大小为shuffle_buffer的缓冲区随机打乱后再分词。
+
+    DataLoader按顺序轮流从各个worker取batch，本epoch的第i个batch总是来自第 i % num_workers 个逻辑worker，
+    因此已训练的batch数就能确定每个逻辑worker消费到了哪里。DataLoader每次新建迭代器都从0号worker开始取，
+    恢复时把0号worker映射为第 consumed_batches % num_workers 个逻辑worker，多次恢复后这个对应关系仍然成立。
+    state_dict(consumed_batches)记录游标，load_state_dict之后各worker重放同样的随机序列并跳过已消费的样本（跳过的行不分词），
+    从中断的那条样本继续。恢复时num_workers、batch_size和rank数必须与保存时相同。
+    '''
+    def __init__(self, data_path, tokenizer, max_length=512, batch_size=32, num_workers=0,
+                 rank=None, world_size=None, shuffle_buffer=10000, chunk_bytes=64 * 1024 ** 2, seed=0,
+                 cache_dir=None):
+        super().__init__()
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if world_size is None:
+            world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if isinstance(data_path, str):
+            data_path = sorted(glob.glob(os.path.join(data_path, '*.jsonl'))) if os.path.isdir(data_path) else [data_path]
+        self.files = list(data_path)
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle_buffer = shuffle_buffer
+        self.chunk_bytes = chunk_bytes
+        self.seed = seed
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'minimind')
+        self.epoch = 0
+        self.consumed_batches = 0
+
+        num_shards = self.world_size * self.num_workers
+        self.chunks = [(path, start, min(start + chunk_bytes, os.path.getsize(path)))
+                       for path in self.files for start in range(0, os.path.getsize(path), chunk_bytes)]
+        self.chunk_lines = run_on_rank0(self._count_chunk_lines)
+        self.num_samples = int(sum(self.chunk_lines))
+        assert self.num_samples > 0, "数据集中没有样本"
+        self.samples_per_worker = -(-self.num_samples // (num_shards * batch_size)) * batch_size
+
+    def _count_chunk_lines(self):
+        '''每个区间负责的行数，缓存在cache_dir中'''
+        key = json.dumps([self.chunk_bytes] + [(os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns)
+                                               for path in self.files])
+        cache_path = os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.chunk_lines.npy')
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+        counts = np.array([sum(1 for _ in self._read_chunk(*chunk)) for chunk in self.chunks], dtype=np.int64)
+        atomic_save_npy(cache_path, counts)
+        return counts
+
+    @staticmethod
+    def _read_chunk(path, start, end):
+        with open(path, 'rb') as f:
+            if start > 0:
+                # 跳过上一个区间负责的半行；start恰好是行首时只读掉前一个换行符
+                f.seek(start - 1)
+                f.readline()
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield line
+
+    def _lines(self, chunks, chunk_lines, start, count):
+        '''按chunks的顺序，从全局第start行开始读取count行，读到末尾时回到第一个区间'''
+        offsets = [0] + list(itertools.accumulate(chunk_lines))
+        start %= offsets[-1]
+        index = bisect.bisect_right(offsets, start) - 1
+        skip = start - offsets[index]
+        while count > 0:
+            n = min(chunk_lines[index] - skip, count)
+            if n > 0:
+                # 跳过的行只读不解析
+                yield from itertools.islice(self._read_chunk(*chunks[index]), skip, skip + n)
+                count -= n
+            skip = 0
+            index = (index + 1) % len(chunks)
+
+    def _shuffle(self, lines, rng):
+        buffer = []
+        for line in lines:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(line)
+                continue
+            index = rng.randrange(self.shuffle_buffer)
+            yield buffer[index]
+            buffer[index] = line
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def set_epoch(self, epoch):
+        # 恢复时load_state_dict已经设置了当前epoch的游标，进入下一个epoch才从头开始
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.consumed_batches = 0
+
+    def state_dict(self, consumed_batches):
+        '''consumed_batches为本epoch内当前rank已经训练过的batch数'''
+        return {"epoch": self.epoch, "consumed_batches": consumed_batches, "seed": self.seed,
+                "num_workers": self.num_workers, "batch_size": self.batch_size, "world_size": self.world_size}
+
+    def load_state_dict(self, state):
+        for key in ("seed", "num_workers", "batch_size", "world_size"):
+            assert state[key] == getattr(self, key), f"{key}与保存时不同，无法恢复数据位置"
+        self.epoch = state["epoch"]
+        self.consumed_batches = state["consumed_batches"]
+
+    def __len__(self):
+        return self.samples_per_worker * self.num_workers
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        assert num_workers == self.num_workers, "num_workers与DataLoader不一致"
+        # 逻辑worker编号：接下来的第一个batch（全局第consumed_batches个）由DataLoader的0号worker提供
+        worker_id = ((worker_info.id if worker_info is not None else 0) + self.consumed_batches) % num_workers
+        shard = self.rank * num_workers + worker_id
+        num_shards = self.world_size * num_workers
+
+        order = list(range(len(self.chunks)))
+        random.Random(self.seed + self.epoch).shuffle(order)
+        chunks = [self.chunks[i] for i in order]
+        chunk_lines = [int(self.chunk_lines[i]) for i in order]
+        rng = random.Random((self.seed + self.epoch) * num_shards + shard)
+        lines = self._lines(chunks, chunk_lines, shard * self.samples_per_worker, self.samples_per_worker)
+        stream = self._shuffle(lines, rng)
+        # 第i个batch来自第 i % num_workers 个逻辑worker
+        consumed = max(-(-(self.consumed_batches - worker_id) // num_workers), 0) * self.batch_size
+        next(itertools.islice(stream, consumed, consumed), None)
+        for line in stream:
+            yield encode_pretrain_sample(self.tokenizer, str(json.loads(line)['text']), self.max_length)
+
+def build_mmap_dataset(data_path, tokenizer, output_path, batch_size=1000):
+    '''
+    离线分词：把jsonl中每条样本的text分词后顺序写入一个扁平的uint16 token文件(output_path，一般以.bin结尾)，
+    同时写出int64的偏移索引(.idx)，第i条样本的token为 tokens[offsets[i]:offsets[i+1]]
+    '''
+    assert len(tokenizer) <= np.iinfo(np.uint16).max + 1, "词表太大，无法用uint16存储"
+    offsets = [0]
+
+    def flush(texts, f):
+        for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+            f.write(np.asarray(ids, dtype=np.uint16).tobytes())
+            offsets.append(offsets[-1] + len(ids))
+
+    with open(data_path, 'r', encoding='utf-8') as fin, open(output_path, 'wb') as fout:
+        texts = []
+        for line in fin:
+            texts.append(str(json.loads(line.strip())['text']))
+            if len(texts) == batch_size:
+                flush(texts, fout)
+                texts = []
+        if texts:
+            flush(texts, fout)
+    np.asarray(offsets, dtype=np.int64).tofile(MMapPretrainDataset.index_path(output_path))
+    return len(offsets) - 1, offsets[-1]
+
+
+class MMapPretrainDataset(Dataset):
+    '''
+    读取build_mmap_dataset生成的token文件，通过numpy.memmap按需读取样本，__getitem__中不再调用tokenizer。
+    文件在每个DataLoader worker中第一次访问时才打开，各worker共享操作系统的page cache。
+    返回格式与PretrainDataset一致。
+    '''
+    def __init__(self, data_path, max_length=512, pad_token_id=0):
+        super().__init__()
+        self.data_path = data_path
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self._tokens = None
+        self._offsets = None
+        self.num_samples = os.path.getsize(self.index_path(data_path)) // np.dtype(np.int64).itemsize - 1
+
+    @staticmethod
+    def index_path(data_path):
+        return os.path.splitext(data_path)[0] + '.idx'
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = np.memmap(self.data_path, dtype=np.uint16, mode='r')
+        return self._tokens
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.memmap(self.index_path(self.data_path), dtype=np.int64, mode='r')
+        return self._offsets
+
+    def __getstate__(self):
+        # memmap被pickle时会拷贝全部数据，传给worker之前去掉，由worker重新打开
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        state['_offsets'] = None
+        return state
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        start = int(self.offsets[index])
+        end = min(int(self.offsets[index + 1]), start + self.max_length)
+        ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+        ids[:end - start] = torch.from_numpy(self.tokens[start:end].astype(np.int64))
+        attention_mask = (ids != self.pad_token_id)
+
+        input_ids = ids[:-1].clone()
+        label = ids[1:].clone()
+        attention_mask = attention_mask[1:].clone().type_as(label)
         return {
             "input_ids":input_ids,
             "attention_mask":attention_mask,
             "labels":label
         }
-    
+
+
+class PackedPretrainDataset(MMapPretrainDataset):
+    '''
+    序列打包：把build_mmap_dataset生成的文档按顺序首尾相接（每个文档后面加eos_token_id）组成一条连续的token流，
+    再按max_length切成行，除最后一行外没有padding。
+    每个token附带所属文档在本行内的编号segment_ids和文档内的位置position_ids，
+    模型据此构造块对角的因果掩码，文档之间互相不可见；跨行的长文档在新的一行中从位置0重新开始。
+    跨文档的预测（eos之后的下一个文档）和padding的label为-100。
+    '''
+    def __init__(self, data_path, max_length=512, pad_token_id=0, eos_token_id=2):
+        super().__init__(data_path, max_length=max_length, pad_token_id=pad_token_id)
+        self.eos_token_id = eos_token_id
+        num_tokens = os.path.getsize(data_path) // np.dtype(np.uint16).itemsize
+        # 每个文档多一个eos
+        self.stream_length = num_tokens + self.num_samples
+        self.num_rows = -(-self.stream_length // max_length)
+
+    def stream_start(self, doc):
+        # 第doc个文档在token流中的起始位置：前面每个文档都多了一个eos
+        return int(self.offsets[doc]) + doc
+
+    def padding_stats(self):
+        '''对比逐条padding到max_length（PretrainDataset）与打包之后的padding比例'''
+        lengths = np.diff(np.asarray(self.offsets))
+        kept = np.minimum(lengths, self.max_length)
+        return {
+            "rows_before": len(lengths),
+            "padding_ratio_before": 1 - kept.sum() / (len(lengths) * self.max_length),
+            "truncated_tokens_before": int((lengths - kept).sum()),
+            "rows_after": self.num_rows,
+            "padding_ratio_after": 1 - self.stream_length / (self.num_rows * self.max_length),
+        }
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, index):
+        start = index * self.max_length
+        end = min(start + self.max_length, self.stream_length)
+        ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+        segment_ids = torch.full((self.max_length,), -1, dtype=torch.long)
+        position_ids = torch.zeros(self.max_length, dtype=torch.long)
+
+        doc = bisect.bisect_right(range(self.num_samples), start, key=self.stream_start) - 1
+        pos, segment = start, 0
+        while pos < end:
+            doc_start = self.stream_start(doc)
+            doc_len = int(self.offsets[doc + 1] - self.offsets[doc])
+            seg_end = min(end, doc_start + doc_len + 1)
+            # 本段中的真实token，段末可能是该文档的eos
+            num_tokens = max(min(seg_end, doc_start + doc_len) - pos, 0)
+            if num_tokens > 0:
+                token_start = int(self.offsets[doc]) + pos - doc_start
+                ids[pos - start:pos - start + num_tokens] = torch.from_numpy(
+                    self.tokens[token_start:token_start + num_tokens].astype(np.int64))
+            if seg_end == doc_start + doc_len + 1:
+                ids[seg_end - 1 - start] = self.eos_token_id
+            segment_ids[pos - start:seg_end - start] = segment
+            position_ids[pos - start:seg_end - start] = torch.arange(seg_end - pos)
+            pos, segment, doc = seg_end, segment + 1, doc + 1
+
+        input_ids = ids[:-1].clone()
+        label = ids[1:].clone()
+        label[(segment_ids[1:] != segment_ids[:-1]) | (segment_ids[1:] < 0)] = -100
+        return {
+            "input_ids":input_ids,
+            "attention_mask":(segment_ids[:-1] >= 0).long(),
+            "labels":label,
+            "position_ids":position_ids[:-1].clone(),
+            "segment_ids":segment_ids[:-1].clone()
+        }
+
+
+def find_subsequence(ids, pattern):
+    '''返回pattern在ids中所有出现的起始位置（向量化的滑动窗口比较）'''
+    pattern = np.asarray(pattern, dtype=ids.dtype)
+    if len(ids) < len(pattern):
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(ids, len(pattern))
+    return np.flatnonzero((windows == pattern).all(axis=1))
+
+
+def assistant_mask(ids, bos_id, eos_id):
+    '''
+    返回ids中需要计算loss的位置：每个bos_id（<|im_start|>assistant）之后的回答内容以及结尾的eos_id（<|im_end|>）
+    被截断、没有eos_id的回答一直到序列末尾
+    '''
+    starts = find_subsequence(ids, bos_id) + len(bos_id)
+    eos_starts = find_subsequence(ids, eos_id)
+    # 每个回答之后第一个eos_id
+    next_eos = np.searchsorted(eos_starts, starts)
+    ends = np.full(len(starts), len(ids), dtype=np.int64)
+    found = next_eos < len(eos_starts)
+    ends[found] = eos_starts[next_eos[found]] + len(eos_id)
+    # 区间的差分再求前缀和，一次得到整个mask
+    delta = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.add.at(delta, np.minimum(starts, len(ids)), 1)
+    np.add.at(delta, ends, -1)
+    return np.cumsum(delta[:-1]) > 0
+
+
 class SFTDataset(Dataset):
-    def __init__(self, data_path, tokenizer, max_length = 1024):
+    '''
+    dynamic_padding=True时不再padding到max_length，只截断，由SFTCollator按batch内的最大长度padding，
+    配合LengthBucketBatchSampler使用，batch内的样本长度相近。
+    '''
+    def __init__(self, data_path, tokenizer, max_length = 1024, dynamic_padding = False, cache_dir = None):
         super().__init__()
         self.tokenizer = tokenizer
         self.max_length = max_length
+        self.dynamic_padding = dynamic_padding
+        self.data_path = data_path
+        # 样本长度的缓存目录，默认 ~/.cache/minimind，数据集所在的目录可以是只读的
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'minimind')
+        self._lengths = None
         self.conversations = []
         with open(data_path,'r', encoding="utf-8") as f:
             for line_no, line in enumerate(f,start=1):
@@ -60,35 +434,63 @@ class SFTDataset(Dataset):
     def _creat_prompt(self, sample):
         conversations = sample["conversations"]
         return ChatMLSFT(conversations,False)
-    
+
+    def _loss_mask(self, input_ids):
+        return torch.from_numpy(assistant_mask(input_ids.numpy(), self.bos_id, self.eos_id))
+
+    def _lengths_cache_path(self):
+        '''
+        缓存文件名包含数据文件（路径、大小、修改时间）、分词器（名称和词表的哈希）以及第一条样本的prompt的哈希，
+        数据、分词器或_creat_prompt的模板变化时都会重新计算
+        '''
+        stat = os.stat(self.data_path)
+        vocab = sorted(self.tokenizer.get_vocab().items())
+        key = json.dumps([
+            os.path.abspath(self.data_path), stat.st_size, stat.st_mtime_ns,
+            getattr(self.tokenizer, 'name_or_path', ''),
+            hashlib.sha1(json.dumps(vocab, ensure_ascii=False).encode('utf-8')).hexdigest(),
+            self._creat_prompt(self.conversations[0]) if self.conversations else '',
+        ], ensure_ascii=False)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        name = os.path.basename(self.data_path)
+        return os.path.join(self.cache_dir, f"{name}.{digest}.lengths.npy")
+
+    def _compute_lengths(self):
+        cache_path = self._lengths_cache_path()
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+        lengths = np.zeros(len(self.conversations), dtype=np.int64)
+        for start in range(0, len(self.conversations), 1000):
+            prompts = [self._creat_prompt(sample) for sample in self.conversations[start:start + 1000]]
+            input_ids = self.tokenizer(prompts)["input_ids"]
+            lengths[start:start + len(input_ids)] = [len(ids) for ids in input_ids]
+        atomic_save_npy(cache_path, lengths)
+        return lengths
+
+    @property
+    def lengths(self):
+        '''
+        每条样本__getitem__返回的序列长度，整个数据集只分词一次。
+        未截断的长度缓存在cache_dir中（见_lengths_cache_path）；分布式训练时只由rank 0计算和写缓存，再广播给其他rank。
+        '''
+        if self._lengths is None:
+            lengths = run_on_rank0(self._compute_lengths)
+            # 截断到max_length，再去掉错位之后的一个token
+            self._lengths = np.minimum(lengths, self.max_length) - 1
+        return self._lengths
+
     def __getitem__(self, index):
         sample = self.conversations[index]
         prompt = self._creat_prompt(sample)
         encoded  = self.tokenizer(prompt,
                                     max_length=self.max_length,
-                                    padding='max_length',
+                                    padding=False if self.dynamic_padding else 'max_length',
                                     truncation=True,
                                     return_tensors='pt')
         input_ids = encoded["input_ids"].flatten()
         attention_mask = encoded["attention_mask"].flatten()
         label = input_ids.clone()
-
-        loss_mask = [0] * len(label)
-        i = 0
-        while i < len(label):
-            if label[i:i+len(self.bos_id)] == self.bos_id:# find the assistant part
-                start = i+len(self.bos_id)
-                end = start
-                while end < len(label):
-                    if label[end:end+len(self.eos_id)] == self.eos_id:# find the end of assistant part
-                        break
-                    end += 1
-                for j in range(start+1, min(end + len(self.eos_id) + 1, self.max_length)): # make assistant part be seen by model
-                    loss_mask[j] = 1
-                i = end + len(self.eos_id) if end < len(label) else len(label)
-            else:
-                i += 1
-        label[loss_mask == 0] = -100# 屏蔽gpt不需要回答的部分。
+        label[~self._loss_mask(input_ids)] = -100# 屏蔽gpt不需要回答的部分。
 
         input_ids = input_ids[:-1].detach().clone()
         label = label[1:].detach().clone()
@@ -102,7 +504,118 @@ class SFTDataset(Dataset):
 
     def __len__(self):
         return len(self.conversations)
-    
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    '''
+    与DistributedSampler相同，另外可以从某个epoch的中间继续：set_start(epoch, index)之后，
+    该epoch只从本rank的第index个样本开始产出，跳过的样本不会被DataLoader读取和collate。
+    __len__仍是整个epoch的样本数，训练时的步数按完整的epoch计算。
+    '''
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, drop_last=drop_last)
+        self.start_epoch = None
+        self.start_index = 0
+
+    def set_start(self, epoch, index):
+        self.start_epoch = epoch
+        self.start_index = index
+
+    def __iter__(self):
+        indices = super().__iter__()
+        if self.epoch == self.start_epoch and self.start_index > 0:
+            indices = itertools.islice(indices, self.start_index, None)
+        return iter(indices)
+
+
+class LengthBucketBatchSampler(Sampler):
+    '''
+    按长度分桶的batch sampler，用法与DistributedSampler相同（每个epoch前调用set_epoch）
+
+    每个epoch先用seed + epoch打乱全部样本，按 batch_size * num_replicas * bucket_size 切成若干个桶，
+    桶内按长度排序后切成batch，再把相邻的num_replicas个batch作为一组，打乱组的顺序。
+    同一步里各个rank拿到的batch长度相近，不会互相等待。
+    与DistributedSampler一样，样本不够整除时重复开头的样本补齐，保证每个rank的batch数相同；
+    drop_last=True时丢掉凑不满的batch。
+    '''
+    def __init__(self, lengths, batch_size, num_replicas=None, rank=None, shuffle=True, seed=0,
+                 drop_last=False, bucket_size=100):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        group_size = batch_size * num_replicas
+        if drop_last:
+            self.num_batches = len(self.lengths) // group_size
+        else:
+            self.num_batches = -(-len(self.lengths) // group_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = np.random.default_rng(self.seed + self.epoch)
+            indices = generator.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        total_size = self.num_batches * self.batch_size * self.num_replicas
+        if total_size > len(indices):
+            indices = np.resize(indices, total_size)
+        indices = indices[:total_size]
+
+        group_size = self.batch_size * self.num_replicas
+        chunk_size = group_size * self.bucket_size
+        groups = []
+        for start in range(0, total_size, chunk_size):
+            chunk = indices[start:start + chunk_size]
+            # 稳定排序，长度相同的样本保持打乱后的顺序
+            chunk = chunk[np.argsort(self.lengths[chunk], kind='stable')]
+            groups += [chunk[i:i + group_size] for i in range(0, len(chunk), group_size)]
+        if self.shuffle:
+            groups = [groups[i] for i in generator.permutation(len(groups))]
+        for group in groups:
+            yield group[self.rank * self.batch_size:(self.rank + 1) * self.batch_size].tolist()
+
+
+class SFTCollator:
+    '''
+    动态padding：把batch中的样本padding到batch内最大长度，并向上取整到pad_to_multiple_of的倍数（tensor core友好）
+    input_ids用pad_token_id填充，attention_mask为0，labels为-100
+    '''
+    def __init__(self, pad_token_id=0, pad_to_multiple_of=8):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, batch):
+        max_len = max(len(sample["input_ids"]) for sample in batch)
+        if self.pad_to_multiple_of:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        pad_values = {"input_ids": self.pad_token_id, "attention_mask": 0, "labels": -100}
+        output = {}
+        for key, pad_value in pad_values.items():
+            output[key] = torch.full((len(batch), max_len), pad_value, dtype=torch.long)
+            for i, sample in enumerate(batch):
+                output[key][i, :len(sample[key])] = sample[key]
+        return output
+
+
 
 class VLLMDataset(Dataset):
     def __init__():
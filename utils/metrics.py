@@ -0,0 +1,197 @@
+import os
+import csv
+import json
+import time
+import resource
+from contextlib import contextmanager
+import torch
+
+'''
+训练吞吐与MFU统计
+
+每个step记录:
+    data:      等待DataLoader返回batch的时间（CPU计时）
+    forward / backward / optimizer: 用CUDA event计时，不在每个阶段同步，只在汇总时同步一次；CPU上用perf_counter
+每log_interval次汇总一次，输出tokens/s（按attention_mask统计，不含padding）、samples/s、各阶段平均耗时、
+MFU（按实际计算的token数，包含padding）和本区间的峰值内存（CPU上为各阶段结束时采样的常驻内存），并写入jsonl或csv文件（按后缀区分）。
+'''
+
+# 常见GPU的bf16/fp16稠密峰值算力(TFLOPS)，按设备名匹配；其他设备用 --peak_tflops 指定
+PEAK_TFLOPS = {
+    "H100": 989.0,
+    "A100": 312.0,
+    "A800": 312.0,
+    "H800": 989.0,
+    "L40": 181.0,
+    "4090": 165.0,
+    "3090": 71.0,
+    "V100": 125.0,
+    "T4": 65.0,
+}
+
+
+def get_peak_tflops(device):
+    if not str(device).startswith("cuda") or not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name(device)
+    for key, tflops in PEAK_TFLOPS.items():
+        if key in name:
+            return tflops
+    return None
+
+
+def flops_per_token(config, seq_len):
+    """
+    训练时每个token的FLOPs（前向+反向 = 3 × 前向）
+    矩阵乘部分为 6 × 每个token参与计算的参数量（MoE只计入top_k个路由专家和共享专家），
+    注意力的 QK^T 和 PV 为 12 × 层数 × hidden_size × seq_len（按未使用因果掩码的稠密计算估计）
+    """
+    hidden_size = config.hidden_size
+    head_dim = hidden_size // config.num_heads
+    num_kv_heads = config.num_heads if config.num_key_value_heads is None else config.num_key_value_heads
+    intermediate_size = config.intermediate_size
+    if intermediate_size is None:
+        intermediate_size = 64 * ((int(hidden_size * 8 / 3) + 64 - 1) // 64)
+    attention = 2 * hidden_size * hidden_size + 2 * hidden_size * num_kv_heads * head_dim
+    mlp = 3 * hidden_size * intermediate_size
+    if getattr(config, "use_moe", False):
+        mlp *= config.top_k + config.n_shared_experts
+    params = config.num_hidden_layers * (attention + mlp) + hidden_size * config.vocab_size
+    return 6 * params + 12 * config.num_hidden_layers * hidden_size * seq_len
+
+
+def peak_memory_mb(device):
+    """CUDA上为reset_peak_memory_stats之后的显存峰值；CPU上为进程整个生命周期的最大常驻内存，不能重置"""
+    if str(device).startswith("cuda"):
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    """当前的常驻内存，从/proc/self/statm读取；没有/proc的系统上退回生命周期峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MetricsSink:
+    """把每条记录追加到jsonl或csv文件，csv的列以第一条记录为准"""
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.endswith(".csv")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fields = None
+
+    def write(self, record):
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            if not self.is_csv:
+                f.write(json.dumps(record) + "\n")
+                return
+            if self._fields is None:
+                self._fields = list(record)
+                write_header = f.tell() == 0
+            else:
+                write_header = False
+            writer = csv.DictWriter(f, fieldnames=self._fields, extrasaction="ignore")
+            if write_header:
+                writer.writeheader()
+            writer.writerow(record)
+
+
+class TrainMetrics:
+    def __init__(self, config, device, peak_tflops=None, world_size=1, sink=None):
+        self.config = config
+        self.device = str(device)
+        self.use_cuda = self.device.startswith("cuda")
+        self.peak_tflops = peak_tflops if peak_tflops is not None else get_peak_tflops(device)
+        self.world_size = world_size
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.data_time = 0.0
+        self.samples = 0
+        self.tokens = 0
+        self.flops = 0.0
+        # 每个阶段的 (开始, 结束) 计时点，汇总时再计算耗时
+        self.phase_marks = {"forward": [], "backward": [], "optimizer": []}
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        # CPU上ru_maxrss无法按区间重置，改为在每个阶段结束时采样当前的常驻内存
+        self.sampled_peak_mb = 0.0
+
+    def timed(self, batches):
+        """包装DataLoader，记录等待每个batch的时间"""
+        iterator = iter(batches)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_time += time.perf_counter() - start
+            self.count(batch)
+            yield batch
+
+    def count(self, batch):
+        input_ids = batch["input_ids"]
+        batch_size, seq_len = input_ids.shape
+        self.samples += batch_size
+        self.tokens += int(batch["attention_mask"].sum()) if "attention_mask" in batch else input_ids.numel()
+        self.flops += flops_per_token(self.config, seq_len) * input_ids.numel()
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = self._mark()
+        yield
+        self.phase_marks[name].append((start, self._mark()))
+        if not self.use_cuda:
+            self.sampled_peak_mb = max(self.sampled_peak_mb, current_rss_mb())
+
+    def _elapsed(self, name):
+        marks = self.phase_marks[name]
+        if self.use_cuda:
+            return sum(start.elapsed_time(end) for start, end in marks) / 1000
+        return sum(end - start for start, end in marks)
+
+    def log(self, **extra):
+        """汇总上次log以来的统计，返回记录并写入sink，然后重新开始统计"""
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - self.start_time
+        num_steps = max(len(self.phase_marks["forward"]), 1)
+        record = dict(extra)
+        record.update({
+            "tokens_per_sec": self.tokens / elapsed,
+            "global_tokens_per_sec": self.tokens / elapsed * self.world_size,
+            "samples_per_sec": self.samples / elapsed,
+            "step_time_ms": elapsed / num_steps * 1000,
+            "data_time_ms": self.data_time / num_steps * 1000,
+        })
+        for name in self.phase_marks:
+            record[f"{name}_time_ms"] = self._elapsed(name) / num_steps * 1000
+        achieved_tflops = self.flops / elapsed / 1e12
+        record["tflops"] = achieved_tflops
+        record["mfu"] = achieved_tflops / self.peak_tflops if self.peak_tflops else None
+        if self.use_cuda:
+            record["peak_memory_mb"] = peak_memory_mb(self.device)
+        else:
+            # 区间内采样到的最大常驻内存，以及进程生命周期的峰值
+            record["peak_memory_mb"] = self.sampled_peak_mb
+            record["lifetime_peak_memory_mb"] = peak_memory_mb(self.device)
+        if self.sink is not None:
+            self.sink.write(record)
+        self.reset()
+        return record
@@ -0,0 +1,62 @@
+import inspect
+import torch
+from torch import nn, optim
+from utils.utils import get_world_size
+
+
+def param_groups(model, weight_decay):
+    """
+    把参数分成两组：二维及以上的权重做weight decay；
+    RMSNorm等一维参数、bias以及Embedding（包括与lm_head共享的权重）不做weight decay
+    """
+    no_decay_ids = set()
+    for module in model.modules():
+        for param in module.parameters(recurse=False):
+            if isinstance(module, nn.Embedding) or param.dim() < 2:
+                no_decay_ids.add(id(param))
+    decay, no_decay, seen = [], [], set()
+    # model.parameters()对共享的参数只返回一次
+    for param in model.parameters():
+        if not param.requires_grad or id(param) in seen:
+            continue
+        seen.add(id(param))
+        (no_decay if id(param) in no_decay_ids else decay).append(param)
+    return [
+        {"params": decay, "weight_decay": weight_decay},
+        {"params": no_decay, "weight_decay": 0.0},
+    ]
+
+
+def adamw_kwargs(model, impl="auto"):
+    """
+    选择AdamW的实现：
+        fused:    单个CUDA kernel更新所有参数，要求参数都在CUDA上
+        foreach:  用_foreach_*算子批量更新
+        for-loop: 逐个参数更新
+        auto:     参数都在CUDA上且支持时用fused，否则用foreach
+    """
+    supports_fused = "fused" in inspect.signature(optim.AdamW).parameters
+    on_cuda = all(p.is_cuda for p in model.parameters())
+    if impl == "auto":
+        impl = "fused" if supports_fused and on_cuda else "foreach"
+    if impl == "fused":
+        assert supports_fused and on_cuda, "fused AdamW需要较新的PyTorch并且参数都在CUDA上"
+        return {"fused": True}
+    if impl == "foreach":
+        return {"foreach": True}
+    assert impl == "for-loop", f"不支持的AdamW实现: {impl}"
+    return {"foreach": False}
+
+
+def build_optimizer(model, lr, weight_decay=0.01, betas=(0.9, 0.999), eps=1e-8, impl="auto", zero=False):
+    """
+    创建AdamW，整个训练过程只调用一次
+    zero=True且有多个rank时使用ZeroRedundancyOptimizer(ZeRO-1)：每个rank只保存和更新自己那份参数的优化器状态，
+    更新后再广播参数，优化器状态的显存降为 1/world_size；保存checkpoint前需要在所有rank上调用consolidate_state_dict
+    """
+    groups = param_groups(model, weight_decay)
+    kwargs = dict(lr=lr, betas=betas, eps=eps, **adamw_kwargs(model, impl))
+    if zero and get_world_size() > 1:
+        from torch.distributed.optim import ZeroRedundancyOptimizer
+        return ZeroRedundancyOptimizer(groups, optimizer_class=optim.AdamW, **kwargs)
+    return optim.AdamW(groups, **kwargs)
@@ -0,0 +1,36 @@
+import os
+import sys
+__package__ = "utils"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import time
+from transformers import AutoTokenizer
+from utils.llm_dataset import build_mmap_dataset, PackedPretrainDataset
+
+'''
+离线分词，生成MMapPretrainDataset使用的 .bin/.idx 文件
+    python pretokenize.py --data_path ../dataset/pretrain_hq.jsonl --output_path ../dataset/pretrain_hq.bin
+训练时把 --data_path 指向生成的 .bin 文件即可
+'''
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pretokenize pretraining corpus")
+    parser.add_argument("--data_path", type=str, default="../dataset/pretrain_hq.jsonl")
+    parser.add_argument("--output_path", type=str, default="../dataset/pretrain_hq.bin")
+    parser.add_argument("--tokenizer_path", type=str, default="../llm_tokenizer")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    # 用于统计逐条padding与序列打包的padding比例
+    parser.add_argument("--max_seq_len", type=int, default=512)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    num_samples, num_tokens = build_mmap_dataset(args.data_path, tokenizer, args.output_path, args.batch_size)
+    print(f"samples: {num_samples}, tokens: {num_tokens}, time: {time.time() - start_time:.2f}s")
+
+    stats = PackedPretrainDataset(args.output_path, max_length=args.max_seq_len,
+                                  pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id).padding_stats()
+    print(f"padding: {stats['rows_before']} rows, padding ratio {stats['padding_ratio_before']:.2%}, "
+          f"truncated tokens {stats['truncated_tokens_before']}")
+    print(f"packing: {stats['rows_after']} rows, padding ratio {stats['padding_ratio_after']:.2%}")
@@ -0,0 +1,65 @@
+import math
+
+
+class LRScheduler:
+    """
+    按参数更新次数（而不是micro-batch）调度学习率，所有训练阶段共用
+
+    先在warmup_steps次更新内从0线性升到max_lr，之后按decay衰减到min_lr：
+        cosine: 余弦衰减
+        linear: 线性衰减
+        wsd:    warmup-stable-decay，保持max_lr，最后decay_ratio比例的更新内线性衰减到min_lr
+    超过total_steps之后保持min_lr。
+    每次optimizer.step()之后调用step()，构造时设置第0次更新的学习率。
+    state_dict/load_state_dict用于断点恢复。
+    """
+    def __init__(self, optimizer, max_lr, total_steps, warmup_steps=0, decay="cosine", min_lr=0.0, decay_ratio=0.1):
+        assert decay in ("cosine", "linear", "wsd"), f"不支持的学习率衰减方式: {decay}"
+        self.optimizer = optimizer
+        self.max_lr = max_lr
+        self.total_steps = total_steps
+        self.warmup_steps = warmup_steps
+        self.decay = decay
+        self.min_lr = min_lr
+        self.decay_ratio = decay_ratio
+        self.current_step = 0
+        self._apply()
+
+    def get_lr(self, step):
+        if step < self.warmup_steps:
+            return self.max_lr * (step + 1) / self.warmup_steps
+        if step >= self.total_steps:
+            return self.min_lr
+        if self.decay == "wsd":
+            decay_steps = max(int((self.total_steps - self.warmup_steps) * self.decay_ratio), 1)
+            decay_start = self.total_steps - decay_steps
+            if step < decay_start:
+                return self.max_lr
+            progress = (step - decay_start) / decay_steps
+        else:
+            progress = (step - self.warmup_steps) / max(self.total_steps - self.warmup_steps, 1)
+        if self.decay == "cosine":
+            coeff = 0.5 * (1 + math.cos(math.pi * progress))
+        else:
+            coeff = 1 - progress
+        return self.min_lr + coeff * (self.max_lr - self.min_lr)
+
+    @property
+    def lr(self):
+        return self.get_lr(self.current_step)
+
+    def _apply(self):
+        lr = self.lr
+        for param_group in self.optimizer.param_groups:
+            param_group["lr"] = lr
+
+    def step(self):
+        self.current_step += 1
+        self._apply()
+
+    def state_dict(self):
+        return {"current_step": self.current_step}
+
+    def load_state_dict(self, state):
+        self.current_step = state["current_step"]
+        self._apply()
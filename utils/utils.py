@@ -1,22 +1,10 @@
 import math
 import logging
 import torch
+import torch.distributed as dist
 import os
 import random
 import numpy as np
-def cosine_learning_rate(current_round, total_rounds, initial_lr=0.001, min_lr=0):
-    """
-    Compute the learning rate based on a cosine schedule.
-
-    :param current_round: The current training round (0-indexed).
-    :param total_rounds: The total number of training rounds.
-    :param initial_lr: The initial learning rate.
-    :param min_lr: The minimum learning rate.
-    :return: The computed learning rate for the current round.
-    """
-    # Compute the cosine learning rate
-    cosine_lr = min_lr + 0.5 * (initial_lr - min_lr) * (1 + math.cos(math.pi * current_round / total_rounds))
-    return cosine_lr
 
 
 def setup_logger(name, log_file, level=logging.INFO):
@@ -46,6 +34,13 @@ def setup_logger(name, log_file, level=logging.INFO):
     
     return logger
 
+def get_rank():
+    # 没有初始化进程组（单进程运行）时视为rank 0
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
 def setup_seed(seed):
     torch.manual_seed(1+seed)
     torch.cuda.manual_seed_all(12+seed)